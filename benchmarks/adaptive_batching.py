@@ -0,0 +1,68 @@
+# Replays a bursty arrival trace through HttpClient with fixed and adaptive batching.
+# Run from the repository root: python -m benchmarks.adaptive_batching
+
+import asyncio
+import random
+import time
+from aiohttp import web
+from blest import HttpClient
+
+def bursty_trace(seed=7):
+  rng = random.Random(seed)
+  arrivals = []
+  now = 0.0
+  for _ in range(6):
+    for _ in range(20):
+      now += rng.uniform(0.02, 0.06)
+      arrivals.append(now)
+    for _ in range(300):
+      now += rng.expovariate(1 / 0.0002)
+      arrivals.append(now)
+  return arrivals
+
+class StubServer:
+  def __init__(self):
+    self.posts = 0
+
+  async def index(self, request):
+    batch = await request.json()
+    self.posts += 1
+    await asyncio.sleep(0.002 + 0.0001 * len(batch))
+    return web.json_response([[item[0], item[1], {'ok': True}, None] for item in batch])
+
+  async def start(self):
+    app = web.Application()
+    app.router.add_post('/', self.index)
+    self.runner = web.AppRunner(app)
+    await self.runner.setup()
+    site = web.TCPSite(self.runner, '127.0.0.1', 0)
+    await site.start()
+    return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+
+async def replay(client, arrivals):
+  latencies = []
+  async def send(at):
+    await asyncio.sleep(max(0, at - (time.perf_counter() - origin)))
+    start = time.perf_counter()
+    await client.request('ping')
+    latencies.append((time.perf_counter() - start) * 1000)
+  origin = time.perf_counter()
+  await asyncio.gather(*[send(at) for at in arrivals])
+  latencies.sort()
+  return sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.95)]
+
+async def main():
+  arrivals = bursty_trace()
+  server = StubServer()
+  url = await server.start()
+  try:
+    for name, options in (('fixed', {}), ('adaptive', {'adaptive': True, 'batch_size_ceiling': 100})):
+      server.posts = 0
+      async with HttpClient(url, max_batch_size=25, batch_delay=10, **options) as client:
+        mean, p95 = await replay(client, arrivals)
+      print(f'{name:>8}: mean {mean:6.2f} ms  p95 {p95:6.2f} ms  posts {server.posts}')
+  finally:
+    await server.runner.cleanup()
+
+if __name__ == '__main__':
+  asyncio.run(main())
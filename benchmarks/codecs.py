@@ -0,0 +1,50 @@
+# Payload size and encode/decode times for each available codec on a realistic batch response.
+# Run from the repository root: python -m benchmarks.codecs
+
+import time
+from blest import get_codec, MsgpackCodec
+
+ITERATIONS = 200
+
+batch = [
+  [
+    f'id-{i}',
+    'catalog/products',
+    {
+      'products': [
+        {'id': j, 'name': f'Product {j}', 'price': j * 1.25, 'available': j % 3 != 0, 'tags': ['new', 'sale'], 'dimensions': {'width': 10, 'height': 20, 'depth': 5}}
+        for j in range(20)
+      ],
+      'total': 20,
+      'cursor': None
+    },
+    None
+  ]
+  for i in range(100)
+]
+
+def measure(codec):
+  encoded = codec.encode(batch)
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    codec.encode(batch)
+  encode = (time.perf_counter() - start) / ITERATIONS * 1000
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    codec.decode(encoded)
+  decode = (time.perf_counter() - start) / ITERATIONS * 1000
+  return len(encoded), encode, decode
+
+if __name__ == '__main__':
+  codecs = []
+  for name in ('json', 'orjson', 'msgspec', 'msgpack'):
+    try:
+      codecs.append((name, get_codec(name)))
+    except ValueError:
+      print(f'{name:>15}: not installed')
+  codecs.append(('msgpack (pure)', MsgpackCodec(pure=True)))
+  for name, codec in codecs:
+    if name == 'msgpack' and codec.pure:
+      continue
+    size, encode, decode = measure(codec)
+    print(f'{name:>15}: {size} bytes  encode {encode:.3f} ms  decode {decode:.3f} ms')
@@ -0,0 +1,62 @@
+# Event-loop cost of reporting a failing route: synchronous tracebacks versus the rate-limited reporter.
+# Run from the repository root: python -m benchmarks.error_reporting
+
+import asyncio
+import io
+import logging
+import sys
+import time
+import traceback
+from blest import Router, ErrorReporter
+
+BATCHES = 200
+BATCH = [[str(i), 'broken'] for i in range(25)]
+
+def broken_router(options=None):
+  router = Router(options)
+
+  @router.route('broken')
+  async def broken(body, context):
+    raise Exception('Broken')
+
+  return router
+
+async def measure(router):
+  start = time.perf_counter()
+  for _ in range(BATCHES):
+    await router.handle(BATCH)
+  return (time.perf_counter() - start) / BATCHES * 1000
+
+async def main():
+  stream = io.StringIO()
+  logger = logging.getLogger('blest.benchmark')
+  logger.addHandler(logging.StreamHandler(stream))
+  logger.propagate = False
+
+  # What every failure used to cost: a traceback formatted and written on the event loop
+  silent = logging.getLogger('blest.benchmark.silent')
+  silent.setLevel(logging.CRITICAL)
+  legacy = Router({'error_reporter': ErrorReporter(silent)})
+
+  @legacy.route('broken')
+  async def broken(body, context):
+    try:
+      raise Exception('Broken')
+    except Exception:
+      traceback.print_exc(file=stream)
+      raise
+
+  unlimited = broken_router({'error_reporter': ErrorReporter(logger, rate_limit=None, background=False)})
+  reporter = ErrorReporter(logger)
+  limited = broken_router({'error_reporter': reporter})
+
+  before = await measure(legacy)
+  inline = await measure(unlimited)
+  after = await measure(limited)
+  reporter.flush()
+  print(f'print_exc on the loop:        {before:.2f} ms/batch')
+  print(f'logging, unlimited, inline:   {inline:.2f} ms/batch')
+  print(f'rate-limited, background:     {after:.2f} ms/batch ({before / after:.2f}x)')
+
+if __name__ == '__main__':
+  asyncio.run(main())
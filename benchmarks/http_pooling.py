@@ -0,0 +1,46 @@
+# Requests per second through HttpClient with and without connection reuse.
+# Run from the repository root: python -m benchmarks.http_pooling
+
+import asyncio
+import time
+from aiohttp import web
+from blest import HttpClient
+
+REQUESTS = 500
+CONCURRENCY = 10
+
+async def index(request):
+  batch = await request.json()
+  return web.json_response([[item[0], item[1], {'ok': True}, None] for item in batch])
+
+async def start_server():
+  app = web.Application()
+  app.router.add_post('/', index)
+  runner = web.AppRunner(app)
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  port = site._server.sockets[0].getsockname()[1]
+  return runner, f'http://127.0.0.1:{port}/'
+
+async def measure(url, keepalive_timeout):
+  async with HttpClient(url, batch_delay=0, keepalive_timeout=keepalive_timeout) as client:
+    async def worker():
+      for _ in range(REQUESTS // CONCURRENCY):
+        await client.request('ping')
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+    return REQUESTS / (time.perf_counter() - start)
+
+async def main():
+  runner, url = await start_server()
+  try:
+    without_pooling = await measure(url, 0)
+    with_pooling = await measure(url, 15)
+    print(f'new connection per batch: {without_pooling:>8.0f} req/s')
+    print(f'pooled keep-alive:        {with_pooling:>8.0f} req/s')
+  finally:
+    await runner.cleanup()
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,44 @@
+# Per-batch cost of metrics, latency histograms and hooks versus an uninstrumented router.
+# Run from the repository root: python -m benchmarks.instrumentation
+
+import asyncio
+import time
+from blest import Router
+
+ITERATIONS = 2000
+BATCH = [[str(i), 'greet', {'name': 'Ada'}] for i in range(25)]
+
+def build(options=None, hooks=False):
+  router = Router(options)
+
+  @router.before_request()
+  async def middleware(body, context):
+    pass
+
+  @router.route('greet')
+  async def greet(body, context):
+    return {'greeting': 'Hi, ' + body['name']}
+
+  if hooks:
+    router.add_hook('step_end', lambda event: None)
+    router.add_hook('item_completed', lambda event: None)
+  return router
+
+async def measure(router):
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    await router.handle(BATCH)
+  return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+async def main():
+  baseline = await measure(build({'metrics': False}))
+  metrics = await measure(build())
+  histograms = await measure(build({'histograms': True}))
+  hooks = await measure(build({'histograms': True}, hooks=True))
+  print(f'no instrumentation: {baseline:.1f} us/batch')
+  print(f'metrics:            {metrics:.1f} us/batch ({metrics / baseline:.2f}x)')
+  print(f'histograms:         {histograms:.1f} us/batch ({histograms / baseline:.2f}x)')
+  print(f'histograms + hooks: {hooks:.1f} us/batch ({hooks / baseline:.2f}x)')
+
+if __name__ == '__main__':
+  asyncio.run(main())
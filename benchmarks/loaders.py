@@ -0,0 +1,50 @@
+# A batch of profile lookups with one simulated query per item versus a batch loader.
+# Run from the repository root: python -m benchmarks.loaders
+
+import asyncio
+import time
+from blest import Router
+
+ITERATIONS = 20
+BATCH = [[str(i), 'profile', {'id': i % 20}] for i in range(50)]
+ROUND_TRIP = 0.002
+
+queries = 0
+
+async def query(ids):
+  global queries
+  queries += 1
+  await asyncio.sleep(ROUND_TRIP)
+  return {id: {'id': id, 'name': f'User {id}'} for id in ids}
+
+def build(use_loader):
+  router = Router()
+
+  @router.loader('users')
+  async def load_users(keys, context):
+    return await query(keys)
+
+  @router.route('profile')
+  async def profile(body, context):
+    if use_loader:
+      return {'user': await context['loaders']['users'].load(body['id'])}
+    return {'user': (await query([body['id']]))[body['id']]}
+
+  return router
+
+async def measure(router):
+  global queries
+  queries = 0
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    await router.handle(BATCH)
+  return (time.perf_counter() - start) / ITERATIONS * 1000, queries / ITERATIONS
+
+async def main():
+  before, before_queries = await measure(build(False))
+  after, after_queries = await measure(build(True))
+  print(f'query per item: {before:.2f} ms/batch, {before_queries:.0f} queries')
+  print(f'batch loader:   {after:.2f} ms/batch, {after_queries:.0f} queries ({before / after:.2f}x)')
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,46 @@
+# Cost of building per-item request contexts for a batch.
+# Run from the repository root: python -m benchmarks.request_context
+
+import copy
+import time
+from uuid import uuid1 as uuid
+from blest import RequestContext, freeze_context
+
+REPEAT = 200
+
+context = {
+  'httpHeaders': {f'X-Header-{i}': f'value-{i}' * 4 for i in range(20)},
+  'principal': {
+    'id': 'user-123',
+    'claims': {
+      'roles': ['admin', 'editor', 'viewer'],
+      'scopes': [f'scope:{i}' for i in range(30)],
+      'org': {'id': 'org-1', 'name': 'Example', 'features': ['a', 'b', 'c']}
+    }
+  }
+}
+
+def deepcopy_contexts(size):
+  batch_id = uuid()
+  for i in range(size):
+    item = copy.deepcopy({**context, 'batch_id': batch_id, 'request_id': str(i), 'route': 'route', 'headers': None})
+    item['user'] = i
+
+def layered_contexts(size):
+  shared = freeze_context(context)
+  shared['batch_id'] = uuid()
+  for i in range(size):
+    item = RequestContext(shared, {'request_id': str(i), 'route': 'route', 'headers': None})
+    item['user'] = i
+
+def measure(func, size):
+  start = time.perf_counter()
+  for _ in range(REPEAT):
+    func(size)
+  return (time.perf_counter() - start) / REPEAT * 1e6
+
+if __name__ == '__main__':
+  for size in (1, 25, 500):
+    before = measure(deepcopy_contexts, size)
+    after = measure(layered_contexts, size)
+    print(f'batch size {size:>3}: deepcopy {before:>10.1f} us  layered {after:>8.1f} us  ({before / after:.1f}x)')
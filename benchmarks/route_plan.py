@@ -0,0 +1,62 @@
+# Per-item overhead of running a route's handler chain.
+# Run from the repository root: python -m benchmarks.route_plan
+
+import asyncio
+import time
+from blest import compile_plan
+
+ITERATIONS = 200000
+
+async def middleware(body, context):
+  context['user'] = 1
+
+async def handler(body, context):
+  return {'ok': True}
+
+async def afterware(body, context):
+  pass
+
+chain = [middleware, middleware, handler, afterware]
+plan = compile_plan(chain)
+
+async def run_introspected(handler, body, context):
+  result = None
+  for i in range(len(handler)):
+    temp_result = None
+    if asyncio.iscoroutinefunction(handler[i]):
+      temp_result = await handler[i](body, context)
+    elif callable(handler[i]):
+      loop = asyncio.get_event_loop()
+      temp_result = await loop.run_in_executor(None, handler[i], body, context)
+    if temp_result:
+      result = temp_result
+  return result
+
+async def run_plan(plan, body, context):
+  result = None
+  for step in plan:
+    if step.is_async:
+      temp_result = await step.handler(body, context)
+    else:
+      temp_result = await asyncio.get_running_loop().run_in_executor(None, step.handler, body, context)
+    if temp_result:
+      result = temp_result
+  return result
+
+async def measure(runner, chain):
+  body = {}
+  context = {}
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    await runner(chain, body, context)
+  return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+async def main():
+  before = await measure(run_introspected, chain)
+  after = await measure(run_plan, plan)
+  print(f'introspected chain: {before:.2f} us/item')
+  print(f'compiled plan:      {after:.2f} us/item')
+  print(f'speedup:            {before / after:.2f}x')
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,82 @@
+# Composing a large router from many sub-routers, plus route-name validation.
+# Run from the repository root: python -m benchmarks.route_registry
+
+import re
+import time
+from blest import Router, validate_route, compile_route_plan
+
+SUB_ROUTERS = 40
+ROUTES_PER_ROUTER = 50
+
+def handler(body, context):
+  return {}
+
+def build_sub_routers():
+  routers = []
+  for i in range(SUB_ROUTERS):
+    router = Router()
+    for j in range(ROUTES_PER_ROUTER):
+      router.route(f'resource{j}/action{j}')(handler)
+    routers.append((f'service{i}', router))
+  return routers
+
+def legacy_namespace(target, prefix, router):
+  new_routes = list(router.routes.keys())
+  existing_routes = list(target.keys())
+  for route in new_routes:
+    ns_route = f"{prefix}/{route}"
+    if ns_route in existing_routes:
+      raise ValueError('Cannot merge duplicate routes: ' + ns_route)
+    target[ns_route] = {**router.routes[route], 'handler': router.routes[route]['handler']}
+    target[ns_route]['plan'] = compile_route_plan(target[ns_route])
+
+def legacy_validate_route(route):
+  if not re.match(r"^[a-zA-Z][a-zA-Z0-9_\-\/]*[a-zA-Z0-9]$", route):
+    return 'Invalid'
+  elif re.search(r"\/[^a-zA-Z]", route):
+    return 'Invalid'
+  elif re.search(r"[^a-zA-Z0-9]\/", route):
+    return 'Invalid'
+  elif re.search(r"\/[a-zA-Z0-9_\-]{0,1}\/", route):
+    return 'Invalid'
+  elif re.search(r"\/[a-zA-Z0-9_\-]$", route):
+    return 'Invalid'
+  elif re.search(r"^[a-zA-Z0-9_\-]\/", route):
+    return 'Invalid'
+  return None
+
+if __name__ == '__main__':
+  routers = build_sub_routers()
+
+  start = time.perf_counter()
+  target = {}
+  for prefix, router in routers:
+    legacy_namespace(target, prefix, router)
+  before = time.perf_counter() - start
+
+  start = time.perf_counter()
+  composed = Router()
+  for prefix, router in routers:
+    composed.namespace(prefix, router)
+  after = time.perf_counter() - start
+  assert list(composed.routes) == list(target)
+
+  print(f'{len(target)} routes')
+  print(f'list-scan namespace: {before * 1000:.1f} ms')
+  print(f'route table:         {after * 1000:.1f} ms ({before / after:.2f}x)')
+
+  start = time.perf_counter()
+  matches = composed.routes.with_prefix('service7')
+  print(f'prefix query:        {(time.perf_counter() - start) * 1000:.3f} ms for {len(matches)} routes')
+
+  names = list(composed.routes)
+  start = time.perf_counter()
+  for name in names:
+    legacy_validate_route(name)
+  before = time.perf_counter() - start
+  start = time.perf_counter()
+  for name in names:
+    validate_route(name)
+  after = time.perf_counter() - start
+  print(f'uncompiled validation: {before / len(names) * 1000000:.2f} us/route')
+  print(f'compiled validation:   {after / len(names) * 1000000:.2f} us/route ({before / after:.2f}x)')
@@ -0,0 +1,97 @@
+# Compiled route schema validation versus walking the schema on every call.
+# Run from the repository root: python -m benchmarks.schema_validation
+
+import re
+import time
+from blest import compile_schema
+
+ITERATIONS = 20000
+
+schema = {
+  'type': 'object',
+  'required': ['name', 'email', 'tags'],
+  'additionalProperties': False,
+  'properties': {
+    'name': {'type': 'string', 'minLength': 1, 'maxLength': 100},
+    'email': {'type': 'string', 'pattern': r'^[^@]+@[^@]+$'},
+    'age': {'type': 'integer', 'minimum': 0, 'maximum': 150},
+    'role': {'enum': ['admin', 'member', 'guest']},
+    'tags': {'type': 'array', 'maxItems': 10, 'items': {'type': 'string'}},
+    'address': {
+      'type': 'object',
+      'properties': {
+        'street': {'type': 'string'},
+        'city': {'type': 'string'},
+        'zip': {'type': 'string', 'pattern': r'^\d{5}$'}
+      }
+    }
+  }
+}
+
+body = {
+  'name': 'Ada',
+  'email': 'ada@example.com',
+  'age': 36,
+  'role': 'admin',
+  'tags': ['math', 'engines', 'poetry'],
+  'address': {'street': '1 Main St', 'city': 'London', 'zip': '12345'}
+}
+
+TYPES = {
+  'string': str,
+  'integer': int,
+  'number': (int, float),
+  'boolean': bool,
+  'object': dict,
+  'array': list
+}
+
+def naive_validate(schema, value, path='$'):
+  errors = []
+  if 'type' in schema and not isinstance(value, TYPES[schema['type']]):
+    return [(path, 'should be a ' + schema['type'])]
+  if 'enum' in schema and value not in schema['enum']:
+    errors.append((path, 'should be one of the allowed values'))
+  if isinstance(value, str):
+    if len(value) < schema.get('minLength', 0):
+      errors.append((path, 'is too short'))
+    if 'maxLength' in schema and len(value) > schema['maxLength']:
+      errors.append((path, 'is too long'))
+    if 'pattern' in schema and not re.search(schema['pattern'], value):
+      errors.append((path, 'should match the pattern'))
+  if isinstance(value, (int, float)):
+    if 'minimum' in schema and value < schema['minimum']:
+      errors.append((path, 'is too small'))
+    if 'maximum' in schema and value > schema['maximum']:
+      errors.append((path, 'is too large'))
+  if isinstance(value, dict):
+    for key in schema.get('required', []):
+      if key not in value:
+        errors.append((f'{path}.{key}', 'is required'))
+    properties = schema.get('properties', {})
+    for key, item in value.items():
+      if key in properties:
+        errors.extend(naive_validate(properties[key], item, f'{path}.{key}'))
+      elif schema.get('additionalProperties') is False:
+        errors.append((f'{path}.{key}', 'is not allowed'))
+  if isinstance(value, list):
+    if 'maxItems' in schema and len(value) > schema['maxItems']:
+      errors.append((path, 'has too many items'))
+    if 'items' in schema:
+      for i, item in enumerate(value):
+        errors.extend(naive_validate(schema['items'], item, f'{path}[{i}]'))
+  return errors
+
+def measure(func):
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    func(body)
+  return (time.perf_counter() - start) / ITERATIONS * 1000000
+
+if __name__ == '__main__':
+  validator = compile_schema(schema)
+  assert validator(body) == [] and naive_validate(schema, body) == []
+  before = measure(lambda value: naive_validate(schema, value))
+  after = measure(validator)
+  print(f'naive validation:    {before:.2f} us/body')
+  print(f'compiled validation: {after:.2f} us/body ({before / after:.2f}x)')
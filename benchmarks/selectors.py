@@ -0,0 +1,66 @@
+# Field selector projection on large nested results.
+# Run from the repository root: python -m benchmarks.selectors
+
+import time
+from blest import filter_object
+
+ITERATIONS = 200
+
+def legacy_filter_object(obj, arr):
+  if isinstance(arr, list):
+    filtered_obj = {}
+    for i in range(len(arr)):
+      key = arr[i]
+      if isinstance(key, str):
+        if key in obj:
+          filtered_obj[key] = obj[key]
+      elif isinstance(key, list):
+        nested_obj = obj[key[0]]
+        nested_arr = key[1]
+        if isinstance(nested_obj, list):
+          filtered_arr = []
+          for j in range(len(nested_obj)):
+            filtered_nested_obj = legacy_filter_object(nested_obj[j], nested_arr)
+            if len(filtered_nested_obj) > 0:
+              filtered_arr.append(filtered_nested_obj)
+          if len(filtered_arr) > 0:
+            filtered_obj[key[0]] = filtered_arr
+        elif isinstance(nested_obj, dict):
+          filtered_nested_obj = legacy_filter_object(nested_obj, nested_arr)
+          if len(filtered_nested_obj) > 0:
+            filtered_obj[key[0]] = filtered_nested_obj
+    return filtered_obj
+  return obj
+
+result = {
+  'users': [
+    {
+      'id': i,
+      'name': f'User {i}',
+      'email': f'user{i}@example.com',
+      'bio': 'x' * 200,
+      'address': {'street': f'{i} Main St', 'city': 'Springfield', 'zip': '12345', 'country': 'US'},
+      'orders': [
+        {'id': j, 'total': j * 1.5, 'status': 'shipped', 'items': [{'sku': f'SKU-{k}', 'quantity': k, 'price': 9.99} for k in range(5)]}
+        for j in range(10)
+      ]
+    }
+    for i in range(200)
+  ],
+  'total': 200
+}
+
+selector = ['total', ['users', ['id', 'name', ['address', ['city']], ['orders', ['id', ['items', ['sku']]]]]]]
+
+def measure(func):
+  start = time.perf_counter()
+  for _ in range(ITERATIONS):
+    func(result, selector)
+  return (time.perf_counter() - start) / ITERATIONS * 1000
+
+if __name__ == '__main__':
+  assert filter_object(result, selector) == legacy_filter_object(result, selector)
+  before = measure(legacy_filter_object)
+  after = measure(filter_object)
+  print(f'recursive filter_object: {before:.2f} ms/result')
+  print(f'compiled selection:      {after:.2f} ms/result ({before / after:.2f}x)')
@@ -37,12 +37,54 @@
 # ]
 # -------------------------------------------------------------------------------------------------
 
-import traceback
+import gzip
+import io
+import logging
+import threading
+import queue
+import random
 import aiohttp
 import asyncio
 from uuid import uuid1 as uuid
-import copy
+from collections import deque, OrderedDict
 import re
+import json
+import zlib
+import struct
+import functools
+import heapq
+import itertools
+import bisect
+import math
+import time
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from uuid import UUID
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import msgspec
+except ImportError:
+  msgspec = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 class Router:
 
@@ -51,10 +93,58 @@ class Router:
     self._afterware = []
     self._timeout = 5000
     self._introspection = False
-    self.routes = {}
+    self._max_batch_size = None
+    self.routes = RouteTable()
+    self._loaders = {}
     if options:
       self._timeout = options['timeout'] if options and 'timeout' in options else 5000
       self._introspection = options['introspection'] if options and 'introspection' in options else False
+      self._max_batch_size = options.get('max_batch_size')
+      if self._max_batch_size is not None and (not isinstance(self._max_batch_size, int) or self._max_batch_size <= 0):
+        raise ValueError('Max batch size should be a positive int')
+      if options.get('executor') is not None and not isinstance(options['executor'], Executor):
+        raise ValueError('Executor should be a concurrent.futures.Executor')
+      for key in ['max_workers', 'process_workers']:
+        if options.get(key) is not None and (not isinstance(options[key], int) or options[key] <= 0):
+          raise ValueError(key.replace('_', ' ').capitalize() + ' should be a positive int')
+    self._codec = get_codec(options.get('codec') if options else None)
+    self._compression_threshold = options.get('compression_threshold', 1024) if options else 1024
+    if self._compression_threshold is not None and (not isinstance(self._compression_threshold, int) or self._compression_threshold < 0):
+      raise ValueError('Compression threshold should be a non-negative int')
+    self._max_request_bytes = options.get('max_request_bytes', 10 * 1024 * 1024) if options else 10 * 1024 * 1024
+    if self._max_request_bytes is not None and (not isinstance(self._max_request_bytes, int) or self._max_request_bytes <= 0):
+      raise ValueError('Max request bytes should be a positive int')
+    self._msgpack_codec = self._codec if self._codec.name == 'msgpack' else MsgpackCodec()
+    self._deduplicator = None
+    if options and options.get('deduplicate'):
+      scope = 'batch' if options['deduplicate'] is True else options['deduplicate']
+      if scope not in ['batch', 'global']:
+        raise ValueError('Deduplicate should be True, "batch" or "global"')
+      elif scope == 'global' and not options.get('deduplicate_context_keys'):
+        raise ValueError('Global deduplication requires deduplicate_context_keys')
+      self._deduplicator = Deduplicator(scope, options.get('deduplicate_context_keys'))
+    if options and options.get('histograms') not in [None, True, False]:
+      raise ValueError('Histograms should be True or False')
+    if options and options.get('metrics') not in [None, True, False]:
+      raise ValueError('Metrics should be True or False')
+    self._instruments = Instrumentation(bool(options and options.get('histograms')), not options or options.get('metrics') is not False)
+    self._error_reporter = options.get('error_reporter') if options else None
+    if self._error_reporter is not None and not isinstance(self._error_reporter, ErrorReporter):
+      raise ValueError('Error reporter should be an ErrorReporter')
+    self._instruments.reporter = self._error_reporter
+    self._limiter = None
+    self._priority_waits = PriorityWaits()
+    if options and options.get('max_in_flight') is not None:
+      if not isinstance(options['max_in_flight'], int) or options['max_in_flight'] <= 0:
+        raise ValueError('Max in flight should be a positive int')
+      elif options.get('queue_limit') is not None and (not isinstance(options['queue_limit'], int) or options['queue_limit'] < 0):
+        raise ValueError('Queue limit should be a non-negative int')
+      self._limiter = ConcurrencyLimiter(options['max_in_flight'], options.get('queue_limit'))
+    self._executor = ExecutorPool(
+      options.get('executor') if options else None,
+      options.get('max_workers') if options else None,
+      options.get('process_workers') if options else None
+    )
 
   def route(self, route):
     def decorator(handler):
@@ -65,126 +155,1652 @@ class Router:
         raise ValueError('Route already exists')
       elif not handler or not callable(handler):
         raise ValueError('Handler should be a function')
+      handlers = [*self._middleware, handler, *self._afterware]
       self.routes[route] = {
-        'handler': [*self._middleware, handler, *self._afterware],
+        'handler': handlers,
+        'handler_index': len(self._middleware),
+        'plan': compile_plan(handlers),
         'description': None,
         'schema': None,
         'visible': self._introspection,
         'validate': False,
-        'timeout': self._timeout
+        'timeout': self._timeout,
+        'executor': 'thread'
       }
+      return handler
     return decorator
 
   def before_request(self):
     def decorator(middleware):
-      self._middleware.append(middleware)
+      self.add_middleware(middleware)
+      return middleware
     return decorator
   middleware = before_request
   before = before_request
 
   def add_middleware(self, middleware):
+    if not middleware or not callable(middleware):
+      raise ValueError('Middleware should be a function')
     self._middleware.append(middleware)
 
   def after_request(self):
     def decorator(afterware):
-      self._afterware.append(afterware)
+      self.add_afterware(afterware)
+      return afterware
     return decorator
   afterware = after_request
   after = after_request
 
-  def describe(self, route: str, config: dict):
-    if route not in self.routes:
-      raise ValueError('Route does not exist')
-    elif not isinstance(config, dict):
-      raise ValueError('Configuration should be an object')
+  def add_afterware(self, afterware):
+    if not afterware or not callable(afterware):
+      raise ValueError('Afterware should be a function')
+    self._afterware.append(afterware)
+
+  def loader(self, name, max_batch_size=None):
+    def decorator(batch_function):
+      self.add_loader(name, batch_function, max_batch_size)
+      return batch_function
+    return decorator
+
+  def add_loader(self, name, batch_function, max_batch_size=None):
+    if not name or not isinstance(name, str):
+      raise ValueError('Loader name should be a str')
+    elif name in self._loaders:
+      raise ValueError('Loader already exists')
+    elif not batch_function or not callable(batch_function):
+      raise ValueError('Loader should be a function')
+    elif max_batch_size is not None and (not isinstance(max_batch_size, int) or max_batch_size <= 0):
+      raise ValueError('Max batch size should be a positive int')
+    self._loaders[name] = LoaderSpec(name, batch_function, max_batch_size)
+
+  def describe(self, route: str, config: dict):
+    if route not in self.routes:
+      raise ValueError('Route does not exist')
+    elif not isinstance(config, dict):
+      raise ValueError('Configuration should be an object')
+
+    if 'description' in config:
+      if config['description'] is not None and not isinstance(config['description'], str):
+        raise ValueError('Description should be a str')
+      self.routes[route]['description'] = config['description']
+
+    if 'schema' in config:
+      if config['schema'] is not None and not isinstance(config['schema'], dict):
+        raise ValueError('Schema should be a dict')
+      self.routes[route]['validator'] = compile_schema(config['schema']) if config['schema'] else None
+      self.routes[route]['schema'] = config['schema']
+
+    if 'visible' in config:
+      if config['visible'] is not None and config['visible'] not in [True, False]:
+        raise ValueError('Visible should be True or False')
+      self.routes[route]['visible'] = config['visible']
+
+    if 'validate' in config:
+      if config['validate'] is not None and config['validate'] not in [True, False]:
+        raise ValueError('Validate should be True or False')
+      self.routes[route]['validate'] = config['validate']
+
+    if 'timeout' in config:
+      if config['timeout'] is not None and not isinstance(config['timeout'], int) or config['timeout'] <= 0:
+        raise ValueError('Timeout should be a positive int')
+      self.routes[route]['timeout'] = config['timeout']
+
+    if 'projected' in config:
+      if config['projected'] not in [True, False]:
+        raise ValueError('Projected should be True or False')
+      self.routes[route]['projected'] = config['projected']
+
+    if 'cache' in config:
+      if config['cache'] is not None and config['cache'] is not False and not isinstance(config['cache'], dict):
+        raise ValueError('Cache should be a dict')
+      if config['cache'] and not set(config['cache']).issubset(CACHE_OPTIONS):
+        raise ValueError('Cache options should be one of ' + ', '.join(CACHE_OPTIONS))
+      self.routes[route]['cache'] = ResultCache(**config['cache']) if config['cache'] else None
+
+    if 'executor' in config:
+      if config['executor'] not in ['thread', 'process']:
+        raise ValueError('Executor should be "thread" or "process"')
+      self.routes[route]['executor'] = config['executor']
+      self.routes[route]['plan'] = compile_route_plan(self.routes[route])
+
+    if 'priority' in config:
+      if config['priority'] is not None and (not isinstance(config['priority'], int) or isinstance(config['priority'], bool)):
+        raise ValueError('Priority should be an int')
+      self.routes[route]['priority'] = config['priority'] or 0
+
+    if 'max_concurrency' in config or 'queue_limit' in config:
+      limiter = self.routes[route].get('limiter')
+      max_concurrency = config.get('max_concurrency', limiter.max_concurrency if limiter else None)
+      queue_limit = config.get('queue_limit', limiter.queue_limit if limiter and max_concurrency is not None else None)
+      if max_concurrency is not None and (not isinstance(max_concurrency, int) or max_concurrency <= 0):
+        raise ValueError('Max concurrency should be a positive int')
+      elif queue_limit is not None and (not isinstance(queue_limit, int) or queue_limit < 0):
+        raise ValueError('Queue limit should be a non-negative int')
+      elif queue_limit is not None and max_concurrency is None:
+        raise ValueError('Queue limit requires max concurrency')
+      if max_concurrency is None:
+        self.routes[route]['limiter'] = None
+      elif self.routes[route].get('limiter'):
+        self.routes[route]['limiter'].configure(max_concurrency, queue_limit)
+      else:
+        self.routes[route]['limiter'] = ConcurrencyLimiter(max_concurrency, queue_limit, route)
+
+  def merge(self, router):
+    if not router or not isinstance(router, Router):
+      raise ValueError('Router is required')
+
+    if not router.routes:
+      raise ValueError('No routes to merge')
+
+    self._check_loaders(router)
+    self.routes.insert_all({route: self._adopt_route(config) for route, config in router.routes.items()})
+    self._loaders.update(router._loaders)
+
+  def namespace(self, prefix, router):
+    if not router or not isinstance(router, type(self)):
+      raise ValueError('Router is required')
+
+    prefix_error = validate_route(prefix)
+    if prefix_error:
+      raise ValueError(prefix_error)
+
+    if not router.routes:
+      raise ValueError('No routes to namespace')
+
+    self._check_loaders(router)
+    self.routes.insert_all({f"{prefix}/{route}": self._adopt_route(config) for route, config in router.routes.items()})
+    self._loaders.update(router._loaders)
+
+  def _check_loaders(self, router):
+    for name, spec in router._loaders.items():
+      if self._loaders.get(name, spec) is not spec:
+        raise ValueError('Cannot merge duplicate loaders: ' + name)
+
+  def _adopt_route(self, config):
+    entry = {
+      **config,
+      'handler': self._middleware + config['handler'] + self._afterware,
+      'handler_index': len(self._middleware) + config.get('handler_index', 0),
+      'timeout': config.get('timeout', self._timeout)
+    }
+    entry['plan'] = compile_route_plan(entry)
+    return entry
+
+  async def handle(self, request, context=None, deadline=None):
+    return await handle_request(self.routes, request, context, self._handle_options(), deadline)
+
+  async def handle_stream(self, request, context=None, deadline=None):
+    return await handle_stream(self.routes, request, context, self._handle_options(), deadline)
+
+  def _handle_options(self):
+    return HandleOptions(
+      max_batch_size=self._max_batch_size,
+      executor=self._executor,
+      deduplicator=self._deduplicator,
+      instruments=self._instruments if self._instruments.active else None,
+      reporter=self._error_reporter,
+      limiter=self._limiter,
+      loaders=self._loaders,
+      waits=self._priority_waits
+    )
+
+  def negotiate(self, content_type=None, accept=None):
+    if is_msgpack(content_type):
+      request_codec = self._msgpack_codec
+    elif content_type and 'json' in content_type:
+      request_codec = self._codec if self._codec.name != 'msgpack' else JsonCodec()
+    else:
+      request_codec = self._codec
+    if not accept or '*/*' in accept:
+      response_codec = request_codec
+    elif is_msgpack(accept):
+      response_codec = self._msgpack_codec
+    elif 'json' in accept:
+      response_codec = self._codec if self._codec.name != 'msgpack' else JsonCodec()
+    else:
+      response_codec = request_codec
+    return request_codec, response_codec
+
+  async def handle_bytes(self, raw, context=None, content_type=None, accept=None, deadline=None):
+    request_codec, response_codec = self.negotiate(content_type, accept)
+    if self._max_request_bytes is not None and len(raw) > self._max_request_bytes:
+      return handle_error(413, f'Request body exceeds {self._max_request_bytes} bytes')
+    try:
+      request = request_codec.decode(raw)
+    except Exception:
+      return handle_error(400, 'Request should be valid ' + request_codec.name.upper())
+    result, error = await self.handle(request, context, deadline)
+    if error:
+      return None, error
+    return response_codec.encode(result), None
+
+  async def handle_http(self, body, headers=None, context=None, deadline=None):
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    content_type = headers.get('content-type')
+    accept = headers.get('accept')
+    if self._max_request_bytes is not None and len(body) > self._max_request_bytes:
+      return self._http_error(413, f'Request body exceeds {self._max_request_bytes} bytes')
+    try:
+      body = decompress(body, headers.get('content-encoding'), self._max_request_bytes)
+    except BlestError as error:
+      return self._http_error(error.status, error.message)
+    except Exception:
+      return self._http_error(400, 'Request body could not be decompressed')
+    result, error = await self.handle_bytes(body, context, content_type, accept, deadline)
+    if error:
+      return self._http_error(error['status'], error['message'])
+    _, codec = self.negotiate(content_type, accept)
+    response_headers = {'Content-Type': codec.content_type, 'Vary': 'Accept-Encoding'}
+    if self._compression_threshold is not None:
+      result, encoding = compress_response(result, headers.get('accept-encoding'), self._compression_threshold)
+      if encoding:
+        response_headers['Content-Encoding'] = encoding
+    return 200, response_headers, result
+
+  def _http_error(self, status, message):
+    return status, {'Content-Type': 'application/json'}, JsonCodec().encode({'status': status, 'message': message})
+
+  def executor_stats(self):
+    return self._executor.snapshot()
+
+  def deduplication_stats(self):
+    return dict(self._deduplicator.stats) if self._deduplicator else None
+
+  def cache_stats(self):
+    return {route: config['cache'].stats() for route, config in self.routes.items() if config.get('cache')}
+
+  def loader_stats(self):
+    return {name: dict(spec.stats) for name, spec in self._loaders.items()}
+
+  def concurrency_stats(self):
+    return {
+      'global': self._limiter.stats() if self._limiter else None,
+      'routes': {route: config['limiter'].stats() for route, config in self.routes.items() if config.get('limiter')},
+      'priorities': self._priority_waits.snapshot()
+    }
+
+  def add_hook(self, event, callback):
+    self._instruments.add(event, callback)
+
+  def metrics(self):
+    snapshot = self._instruments.metrics.snapshot() if self._instruments.metrics is not None else {}
+    latency = self.latency_stats()
+    if latency is not None:
+      snapshot['latency_ms'] = latency
+    return snapshot
+
+  def latency_stats(self):
+    histograms = self._instruments.histograms
+    return {route: histogram.snapshot() for route, histogram in histograms.items()} if histograms is not None else None
+
+  def shutdown(self, wait=True):
+    self._executor.shutdown(wait)
+    if wait:
+      (self._error_reporter or default_error_reporter).flush()
+
+
+
+class SingleFlight:
+
+  def __init__(self, memoize=False):
+    self._calls = {}
+    self._memoize = memoize
+
+  def __len__(self):
+    return len(self._calls)
+
+  async def run(self, key, func, on_join=None):
+    while key in self._calls:
+      future = self._calls[key]
+      if on_join:
+        on_join()
+      try:
+        return await asyncio.shield(future)
+      except asyncio.CancelledError:
+        if not future.cancelled():
+          raise
+    future = asyncio.get_running_loop().create_future()
+    self._calls[key] = future
+    try:
+      result = await func()
+    except asyncio.CancelledError:
+      future.cancel()
+      del self._calls[key]
+      raise
+    except BaseException as error:
+      future.set_exception(error)
+      future.exception()
+      raise
+    else:
+      future.set_result(result)
+      return result
+    finally:
+      if not self._memoize and key in self._calls:
+        del self._calls[key]
+
+
+
+def canonical_json(value):
+  return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+
+def get_path(obj, path):
+  for key in path.split('.'):
+    if isinstance(obj, Mapping):
+      obj = obj.get(key)
+    else:
+      obj = getattr(obj, key, None)
+    if obj is None:
+      return None
+  return obj
+
+
+
+CACHE_OPTIONS = ('ttl', 'max_entries', 'max_bytes', 'context_keys')
+
+
+
+class ResultCache:
+
+  def __init__(self, ttl=None, max_entries=1000, max_bytes=None, context_keys=None):
+    if ttl is not None and (not isinstance(ttl, (int, float)) or ttl <= 0):
+      raise ValueError('Cache TTL should be a positive number')
+    elif max_entries is not None and (not isinstance(max_entries, int) or max_entries <= 0):
+      raise ValueError('Cache max entries should be a positive int')
+    elif max_bytes is not None and (not isinstance(max_bytes, int) or max_bytes <= 0):
+      raise ValueError('Cache max bytes should be a positive int')
+    elif context_keys is not None and (not isinstance(context_keys, list) or not all(isinstance(key, str) for key in context_keys)):
+      raise ValueError('Cache context keys should be a list of str')
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.context_keys = tuple(context_keys or ())
+    self._entries = OrderedDict()
+    self._flights = SingleFlight()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.evictions = 0
+
+  def key(self, body, context, selector=None):
+    if self.context_keys or selector is not None:
+      return canonical_json([body, [get_path(context, key) for key in self.context_keys], selector])
+    return canonical_json(body)
+
+  def get(self, key):
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    expires, result, _ = entry
+    if expires is not None and expires <= time.monotonic():
+      self._remove(key)
+      return None
+    self._entries.move_to_end(key)
+    return result
+
+  def set(self, key, result):
+    size = len(canonical_json(result)) if self.max_bytes else 0
+    if self.max_bytes and size > self.max_bytes:
+      return
+    if key in self._entries:
+      self._remove(key)
+    expires = time.monotonic() + self.ttl / 1000 if self.ttl else None
+    self._entries[key] = (expires, result, size)
+    self.size += size
+    while (self.max_entries and len(self._entries) > self.max_entries) or (self.max_bytes and self.size > self.max_bytes):
+      self._remove(next(iter(self._entries)))
+      self.evictions += 1
+
+  def _remove(self, key):
+    _, _, size = self._entries.pop(key)
+    self.size -= size
+
+  def clear(self):
+    self._entries.clear()
+    self.size = 0
+
+  async def fetch(self, key, func):
+    result = self.get(key)
+    if result is not None:
+      self.hits += 1
+      return result
+    self.misses += 1
+    async def load():
+      result = await func()
+      if isinstance(result, dict):
+        self.set(key, result)
+      return result
+    def joined():
+      self.coalesced += 1
+    return await self._flights.run(key, load, joined)
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'coalesced': self.coalesced,
+      'evictions': self.evictions,
+      'entries': len(self._entries),
+      'bytes': self.size
+    }
+
+
+
+class Deduplicator:
+
+  def __init__(self, scope='batch', context_keys=None, flights=None, stats=None):
+    if context_keys is not None and (not isinstance(context_keys, list) or not all(isinstance(key, str) for key in context_keys)):
+      raise ValueError('Deduplicate context keys should be a list of str')
+    self.scope = scope
+    self.context_keys = tuple(context_keys or ())
+    self._flights = flights if flights is not None else SingleFlight()
+    self.stats = stats if stats is not None else {'executions': 0, 'deduplicated': 0}
+
+  def for_batch(self):
+    if self.scope == 'global':
+      return self
+    return Deduplicator('batch', list(self.context_keys), SingleFlight(memoize=True), self.stats)
+
+  def key(self, route, body, headers, context, keep_selector=False):
+    if headers:
+      headers = {key: value for key, value in headers.items() if key != '_t' and key != '_p' and (keep_selector or key != '_s')}
+    if not headers:
+      headers = None
+    values = [get_path(context, key) for key in self.context_keys] if self.context_keys else None
+    return canonical_json([route, body, headers, values])
+
+  async def run(self, route, body, headers, context, func, keep_selector=False):
+    async def execute():
+      self.stats['executions'] += 1
+      return await func()
+    def joined():
+      self.stats['deduplicated'] += 1
+    return await self._flights.run(self.key(route, body, headers, context, keep_selector), execute, joined)
+
+
+
+class PriorityWaits:
+  __slots__ = ('waits',)
+
+  def __init__(self):
+    self.waits = {}
+
+  def record(self, priority, wait):
+    stats = self.waits.get(priority)
+    if stats is None:
+      stats = self.waits[priority] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += wait
+    if wait > stats[2]:
+      stats[2] = wait
+
+  def snapshot(self):
+    return {priority: {'calls': calls, 'wait_avg_ms': total / calls * 1000 if calls else 0.0, 'wait_max_ms': longest * 1000} for priority, (calls, total, longest) in sorted(self.waits.items(), reverse=True)}
+
+
+
+class ConcurrencyLimiter:
+
+  def __init__(self, max_concurrency, queue_limit=None, route=None):
+    self.max_concurrency = max_concurrency
+    self.queue_limit = queue_limit
+    self.route = route
+    self.active = 0
+    self.queued = 0
+    self.rejected = 0
+    self.waiters = []
+    self.waits = PriorityWaits()
+    self._sequence = itertools.count()
+
+  def configure(self, max_concurrency, queue_limit=None):
+    self.max_concurrency = max_concurrency
+    self.queue_limit = queue_limit
+    self._wake()
+
+  def _overloaded(self):
+    self.rejected += 1
+    return BlestError(f'The route "{self.route}" is overloaded' if self.route else 'The server is overloaded', status=503, code='OVERLOADED')
+
+  async def acquire(self, priority=0):
+    if self.active < self.max_concurrency and not self.queued:
+      self.active += 1
+      self.waits.record(priority, 0.0)
+      return
+    if self.queue_limit is not None and self.queued >= self.queue_limit:
+      victim = None
+      for entry in self.waiters:
+        if not entry[2].done() and (victim is None or entry[0] > victim[0] or (entry[0] == victim[0] and entry[1] > victim[1])):
+          victim = entry
+      if victim is None or -victim[0] >= priority:
+        raise self._overloaded()
+      victim[2].set_exception(self._overloaded())
+      self.queued -= 1
+    waiter = asyncio.get_running_loop().create_future()
+    heapq.heappush(self.waiters, (-priority, next(self._sequence), waiter, time.monotonic()))
+    self.queued += 1
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if not waiter.done() or waiter.cancelled():
+        self.queued -= 1
+      elif waiter.exception() is None:
+        self.release()
+      raise
+
+  def release(self):
+    self.active -= 1
+    self._wake()
+
+  def _wake(self):
+    while self.waiters and self.active < self.max_concurrency:
+      priority, _, waiter, enqueued = heapq.heappop(self.waiters)
+      if not waiter.done():
+        self.active += 1
+        self.queued -= 1
+        self.waits.record(-priority, time.monotonic() - enqueued)
+        waiter.set_result(None)
+
+  def stats(self):
+    return {
+      'max_concurrency': self.max_concurrency,
+      'queue_limit': self.queue_limit,
+      'active': self.active,
+      'queued': self.queued,
+      'rejected': self.rejected,
+      'priorities': self.waits.snapshot()
+    }
+
+
+
+def timed_call(handler, body, context):
+  started = time.monotonic()
+  result = handler(body, context)
+  return result, started, time.monotonic()
+
+
+
+class ExecutorStats:
+  __slots__ = ('calls', 'pending', 'wait_total', 'wait_max', 'run_total')
+
+  def __init__(self):
+    self.calls = 0
+    self.pending = 0
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    self.run_total = 0.0
+
+
+
+class ExecutorPool:
+
+  def __init__(self, executor=None, max_workers=None, process_workers=None):
+    self._thread_executor = executor
+    self._owns_thread_executor = executor is None
+    self._max_workers = max_workers
+    self._process_executor = None
+    self._process_workers = process_workers
+    self._started = time.monotonic()
+    self.stats = {}
+
+  @property
+  def thread_executor(self):
+    if self._thread_executor is None:
+      self._thread_executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix='blest')
+    return self._thread_executor
+
+  @property
+  def process_executor(self):
+    if self._process_executor is None:
+      self._process_executor = ProcessPoolExecutor(self._process_workers)
+    return self._process_executor
+
+  async def run(self, route, step, body, context, on_wait=None):
+    if step.process:
+      pool = 'process'
+      executor = self.process_executor
+      context = dict(context)
+    else:
+      pool = 'thread'
+      executor = self.thread_executor
+    stats = self.stats.get((route, pool))
+    if stats is None:
+      stats = self.stats[(route, pool)] = ExecutorStats()
+    stats.pending += 1
+    submitted = time.monotonic()
+    try:
+      result, started, finished = await asyncio.get_running_loop().run_in_executor(executor, timed_call, step.handler, body, context)
+    finally:
+      stats.pending -= 1
+    wait = max(0.0, started - submitted)
+    stats.calls += 1
+    stats.wait_total += wait
+    stats.run_total += finished - started
+    if wait > stats.wait_max:
+      stats.wait_max = wait
+    if on_wait is not None:
+      on_wait(pool, wait)
+    return result
+
+  def snapshot(self):
+    elapsed = max(time.monotonic() - self._started, 1e-9)
+    workers = {
+      'thread': getattr(self._thread_executor, '_max_workers', None),
+      'process': getattr(self._process_executor, '_max_workers', None)
+    }
+    def utilization(busy, pool):
+      return busy / (elapsed * workers[pool]) if workers[pool] else None
+    pools = {pool: {'workers': workers[pool], 'pending': 0, 'busy_ms': 0.0} for pool in workers}
+    routes = {}
+    for (route, pool), stats in self.stats.items():
+      pools[pool]['pending'] += stats.pending
+      pools[pool]['busy_ms'] += stats.run_total * 1000
+      routes.setdefault(route, {})[pool] = {
+        'calls': stats.calls,
+        'pending': stats.pending,
+        'wait_avg_ms': stats.wait_total / stats.calls * 1000 if stats.calls else 0.0,
+        'wait_max_ms': stats.wait_max * 1000,
+        'run_avg_ms': stats.run_total / stats.calls * 1000 if stats.calls else 0.0,
+        'utilization': utilization(stats.run_total, pool)
+      }
+    for pool in pools:
+      pools[pool]['utilization'] = utilization(pools[pool]['busy_ms'] / 1000, pool)
+    return {'pools': pools, 'routes': routes}
+
+  def shutdown(self, wait=True):
+    if self._owns_thread_executor and self._thread_executor is not None:
+      self._thread_executor.shutdown(wait)
+      self._thread_executor = None
+    if self._process_executor is not None:
+      self._process_executor.shutdown(wait)
+      self._process_executor = None
+
+
+
+class ErrorReporter:
+
+  def __init__(self, logger=None, rate_limit=10, sample_rate=1.0, background=True, max_queue_size=10000):
+    if logger is not None and not isinstance(logger, (str, logging.Logger)):
+      raise ValueError('Logger should be a name or a logging.Logger')
+    elif rate_limit is not None and (not isinstance(rate_limit, (int, float)) or rate_limit <= 0):
+      raise ValueError('Rate limit should be a positive number')
+    elif not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1:
+      raise ValueError('Sample rate should be a number between 0 and 1')
+    self.logger = logging.getLogger(logger or 'blest') if not isinstance(logger, logging.Logger) else logger
+    self.rate_limit = rate_limit
+    self.sample_rate = sample_rate
+    self.background = background
+    self.reported = 0
+    self.suppressed = 0
+    self._buckets = {}
+    self._queue = queue.Queue(max_queue_size) if background else None
+    self._thread = None
+    self._lock = threading.Lock()
+
+  def report(self, route, message, *args, error=None, level=logging.ERROR):
+    if not self.logger.isEnabledFor(level):
+      return False
+    if self.sample_rate < 1 and random.random() >= self.sample_rate:
+      self.suppressed += 1
+      return False
+    skipped = 0
+    if self.rate_limit is not None:
+      now = time.monotonic()
+      bucket = self._buckets.get(route)
+      if bucket is None:
+        if len(self._buckets) >= 1000:
+          self._buckets.clear()
+        bucket = self._buckets[route] = [self.rate_limit, now, 0]
+      else:
+        bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+      if bucket[0] < 1:
+        bucket[2] += 1
+        self.suppressed += 1
+        return False
+      bucket[0] -= 1
+      skipped, bucket[2] = bucket[2], 0
+    if skipped:
+      message += ' (%d similar messages suppressed)'
+      args += (skipped,)
+    exc_info = (type(error), error, error.__traceback__) if error is not None else None
+    record = (level, message, args, exc_info, route)
+    if self._queue is None:
+      self._log(record)
+    else:
+      self._start()
+      try:
+        self._queue.put_nowait(record)
+      except queue.Full:
+        self.suppressed += 1
+        return False
+    self.reported += 1
+    return True
+
+  def _log(self, record):
+    level, message, args, exc_info, route = record
+    self.logger.log(level, message, *args, exc_info=exc_info, extra={'route': route})
+
+  def _start(self):
+    if self._thread is None:
+      with self._lock:
+        if self._thread is None:
+          self._thread = threading.Thread(target=self._drain, name='blest-error-reporter', daemon=True)
+          self._thread.start()
+
+  def _drain(self):
+    while True:
+      record = self._queue.get()
+      try:
+        if record is None:
+          return
+        self._log(record)
+      except Exception:
+        pass
+      finally:
+        self._queue.task_done()
+
+  def flush(self):
+    if self._queue is not None and self._thread is not None:
+      self._queue.join()
+
+  def close(self):
+    if self._queue is not None and self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def stats(self):
+    return {'reported': self.reported, 'suppressed': self.suppressed}
+
+
+
+HOOK_EVENTS = ('batch_received', 'item_scheduled', 'step_start', 'step_end', 'executor_wait', 'selection', 'timeout', 'item_completed', 'batch_completed')
+
+class Instrumentation:
+
+  def __init__(self, histograms=False, metrics=True):
+    self.hooks = {}
+    self.histograms = {} if histograms else None
+    self.metrics = RouterMetrics() if metrics else None
+    self.active = bool(histograms or metrics)
+    self.reporter = None
+
+  def add(self, event, callback):
+    if event not in HOOK_EVENTS:
+      raise ValueError('Hook event should be one of: ' + ', '.join(HOOK_EVENTS))
+    if not callable(callback):
+      raise ValueError('Hook should be a function')
+    self.hooks.setdefault(event, []).append(callback)
+    self.active = True
+
+  def emit(self, event, **fields):
+    callbacks = self.hooks.get(event)
+    if not callbacks:
+      return
+    fields['event'] = event
+    for callback in callbacks:
+      try:
+        callback(fields)
+      except Exception as error:
+        (self.reporter or default_error_reporter).report(fields.get('route'), 'A hook for "%s" events raised an error', event, error=error)
+
+  def received(self, batch_id, size):
+    if self.metrics is not None:
+      self.metrics.batches += 1
+      self.metrics.batch_sizes.record(size)
+      self.metrics.in_flight += size
+    if self.hooks:
+      self.emit('batch_received', batch_id=batch_id, size=size)
+
+  def completed(self, result, known):
+    metrics = self.metrics
+    if metrics is not None:
+      metrics.in_flight -= 1
+      if result[1] in known:
+        counters = metrics.route(result[1])
+        counters[0] += 1
+        if result[3]:
+          counters[1] += 1
+      else:
+        metrics.unknown_routes += 1
+
+  def finished(self, promises, pending, started):
+    if self.metrics is not None:
+      self.metrics.in_flight -= pending
+    if self.hooks:
+      self.emit('batch_completed', batch_id=promises.batch_id, size=len(promises), duration_ms=(time.perf_counter() - started) * 1000)
+
+  def timed_out(self, id, route, batch_id, timeout):
+    if self.metrics is not None:
+      self.metrics.route(route)[2] += 1
+    if self.hooks:
+      self.emit('timeout', batch_id=batch_id, request_id=id, route=route, timeout_ms=timeout)
+
+  async def track(self, promise, batch_id, id, route, known):
+    if self.hooks:
+      self.emit('item_scheduled', batch_id=batch_id, request_id=id, route=route)
+    started = time.perf_counter()
+    result = await promise()
+    elapsed = time.perf_counter() - started
+    if known and self.histograms is not None:
+      histogram = self.histograms.get(route)
+      if histogram is None:
+        histogram = self.histograms[route] = LatencyHistogram()
+      histogram.record(elapsed)
+    if self.hooks:
+      self.emit('item_completed', batch_id=batch_id, request_id=id, route=route, status=result[3]['status'] if result[3] else 200, duration_ms=elapsed * 1000)
+    return result
+
+
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+FLUSH_INTERVAL_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+class BucketHistogram:
+  __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0
+
+  def record(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def snapshot(self):
+    buckets = {}
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      buckets[bound] = seen
+    buckets['+Inf'] = self.count
+    return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+
+class RouterMetrics:
+
+  def __init__(self):
+    self.batches = 0
+    self.batch_sizes = BucketHistogram(BATCH_SIZE_BUCKETS)
+    self.in_flight = 0
+    self.unknown_routes = 0
+    self.routes = {}
+
+  def route(self, route):
+    counters = self.routes.get(route)
+    if counters is None:
+      counters = self.routes[route] = [0, 0, 0]
+    return counters
+
+  def snapshot(self):
+    return {
+      'batches_total': self.batches,
+      'batch_items': self.batch_sizes.snapshot(),
+      'in_flight': self.in_flight,
+      'unknown_routes_total': self.unknown_routes,
+      'routes': {route: {'calls_total': calls, 'errors_total': errors, 'timeouts_total': timeouts} for route, (calls, errors, timeouts) in self.routes.items()}
+    }
+
+
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_sample(value):
+  if isinstance(value, float):
+    if math.isinf(value):
+      return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+  return str(value)
+
+def render_prometheus(snapshot, prefix='blest'):
+  lines = []
+  for name, value in snapshot.items():
+    metric = f'{prefix}_{name}'
+    if value is None or isinstance(value, bool):
+      continue
+    elif isinstance(value, (int, float)):
+      lines.append(f'# TYPE {metric} ' + ('counter' if name.endswith('_total') else 'gauge'))
+      lines.append(f'{metric} {format_sample(value)}')
+    elif isinstance(value, dict) and 'buckets' in value:
+      lines.append(f'# TYPE {metric} histogram')
+      for bound, count in value['buckets'].items():
+        lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+      lines.append(f'{metric}_sum {format_sample(value["sum"])}')
+      lines.append(f'{metric}_count {value["count"]}')
+    elif name == 'latency_ms':
+      metric = f'{prefix}_route_latency_ms'
+      lines.append(f'# TYPE {metric} summary')
+      for route, stats in value.items():
+        label = escape_label(route)
+        for key, quantile in [('p50_ms', '0.5'), ('p90_ms', '0.9'), ('p99_ms', '0.99'), ('p999_ms', '0.999')]:
+          lines.append(f'{metric}{{route="{label}",quantile="{quantile}"}} {format_sample(stats[key])}')
+        lines.append(f'{metric}_sum{{route="{label}"}} {format_sample(stats["mean_ms"] * stats["count"])}')
+        lines.append(f'{metric}_count{{route="{label}"}} {stats["count"]}')
+    elif name == 'routes':
+      families = {}
+      for route, counters in value.items():
+        for key, count in counters.items():
+          families.setdefault(key, []).append((route, count))
+      for key, samples in families.items():
+        metric = f'{prefix}_route_{key}'
+        lines.append(f'# TYPE {metric} ' + ('counter' if key.endswith('_total') else 'gauge'))
+        for route, count in samples:
+          lines.append(f'{metric}{{route="{escape_label(route)}"}} {format_sample(count)}')
+  return '\n'.join(lines) + '\n'
+
+
+
+class LatencyHistogram:
+  SUB_BUCKET_BITS = 7
+
+  def __init__(self):
+    self.counts = {}
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+
+  @classmethod
+  def index(cls, value):
+    shift = value.bit_length() - cls.SUB_BUCKET_BITS
+    if shift <= 0:
+      return value
+    return (shift << (cls.SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+  @classmethod
+  def lowest(cls, index):
+    half = 1 << (cls.SUB_BUCKET_BITS - 1)
+    if index < 2 * half:
+      return index
+    shift = (index >> (cls.SUB_BUCKET_BITS - 1)) - 1
+    return (index - (shift << (cls.SUB_BUCKET_BITS - 1))) << shift
+
+  def record(self, seconds):
+    value = max(0, round(seconds * 1000000))
+    index = self.index(value)
+    self.counts[index] = self.counts.get(index, 0) + 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, percent):
+    if not self.count:
+      return 0.0
+    target = max(1, math.ceil(self.count * percent / 100))
+    seen = 0
+    for index in sorted(self.counts):
+      seen += self.counts[index]
+      if seen >= target:
+        return min(self.lowest(index + 1) - 1, self.max) / 1000
+    return self.max / 1000
+
+  def snapshot(self):
+    return {
+      'count': self.count,
+      'min_ms': (self.min or 0) / 1000,
+      'max_ms': self.max / 1000,
+      'mean_ms': self.total / self.count / 1000 if self.count else 0.0,
+      'p50_ms': self.percentile(50),
+      'p90_ms': self.percentile(90),
+      'p99_ms': self.percentile(99),
+      'p999_ms': self.percentile(99.9)
+    }
+
+
+
+def encode_default(obj):
+  if isinstance(obj, Mapping):
+    return dict(obj)
+  elif isinstance(obj, (tuple, set, frozenset)):
+    return list(obj)
+  elif isinstance(obj, UUID):
+    return str(obj)
+  elif isinstance(obj, Selection):
+    return obj.to_selector()
+  elif isinstance(obj, CancellationToken):
+    return obj.remaining
+  elif isinstance(obj, DataLoader):
+    return obj.name
+  raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+
+class JsonCodec:
+  name = 'json'
+  content_type = 'application/json'
+
+  def encode(self, value):
+    return json.dumps(value, separators=(',', ':'), default=encode_default).encode('utf-8')
+
+  def decode(self, data):
+    return json.loads(data)
+
+
+
+class OrjsonCodec:
+  name = 'json'
+  content_type = 'application/json'
+
+  def encode(self, value):
+    return orjson.dumps(value, default=encode_default)
+
+  def decode(self, data):
+    return orjson.loads(data)
+
+
+
+class MsgspecCodec:
+  name = 'json'
+  content_type = 'application/json'
+
+  def __init__(self):
+    self._encoder = msgspec.json.Encoder(enc_hook=encode_default)
+    self._decoder = msgspec.json.Decoder()
+
+  def encode(self, value):
+    return self._encoder.encode(value)
+
+  def decode(self, data):
+    return self._decoder.decode(data)
+
+
+
+def pack(value):
+  chunks = []
+  append = chunks.append
+  stack = [value]
+  while stack:
+    obj = stack.pop()
+    if obj is None:
+      append(b'\xc0')
+    elif obj is True:
+      append(b'\xc3')
+    elif obj is False:
+      append(b'\xc2')
+    elif isinstance(obj, int):
+      if 0 <= obj < 0x80:
+        append(struct.pack('B', obj))
+      elif -0x20 <= obj < 0:
+        append(struct.pack('b', obj))
+      elif 0 <= obj <= 0xff:
+        append(struct.pack('>BB', 0xcc, obj))
+      elif 0 <= obj <= 0xffff:
+        append(struct.pack('>BH', 0xcd, obj))
+      elif 0 <= obj <= 0xffffffff:
+        append(struct.pack('>BI', 0xce, obj))
+      elif 0 <= obj <= 0xffffffffffffffff:
+        append(struct.pack('>BQ', 0xcf, obj))
+      elif -0x80 <= obj < 0:
+        append(struct.pack('>Bb', 0xd0, obj))
+      elif -0x8000 <= obj < 0:
+        append(struct.pack('>Bh', 0xd1, obj))
+      elif -0x80000000 <= obj < 0:
+        append(struct.pack('>Bi', 0xd2, obj))
+      elif -0x8000000000000000 <= obj < 0:
+        append(struct.pack('>Bq', 0xd3, obj))
+      else:
+        raise OverflowError('Integer is too large to pack')
+    elif isinstance(obj, float):
+      append(struct.pack('>Bd', 0xcb, obj))
+    elif isinstance(obj, str):
+      data = obj.encode('utf-8')
+      length = len(data)
+      if length < 32:
+        append(struct.pack('B', 0xa0 | length))
+      elif length <= 0xff:
+        append(struct.pack('>BB', 0xd9, length))
+      elif length <= 0xffff:
+        append(struct.pack('>BH', 0xda, length))
+      else:
+        append(struct.pack('>BI', 0xdb, length))
+      append(data)
+    elif isinstance(obj, (bytes, bytearray)):
+      length = len(obj)
+      if length <= 0xff:
+        append(struct.pack('>BB', 0xc4, length))
+      elif length <= 0xffff:
+        append(struct.pack('>BH', 0xc5, length))
+      else:
+        append(struct.pack('>BI', 0xc6, length))
+      append(bytes(obj))
+    elif isinstance(obj, list):
+      length = len(obj)
+      if length < 16:
+        append(struct.pack('B', 0x90 | length))
+      elif length <= 0xffff:
+        append(struct.pack('>BH', 0xdc, length))
+      else:
+        append(struct.pack('>BI', 0xdd, length))
+      stack.extend(reversed(obj))
+    elif isinstance(obj, dict):
+      length = len(obj)
+      if length < 16:
+        append(struct.pack('B', 0x80 | length))
+      elif length <= 0xffff:
+        append(struct.pack('>BH', 0xde, length))
+      else:
+        append(struct.pack('>BI', 0xdf, length))
+      for key, item in reversed(list(obj.items())):
+        stack.append(item)
+        stack.append(key)
+    else:
+      stack.append(encode_default(obj))
+  return b''.join(chunks)
+
+
+
+MSGPACK_STRUCTS = {fmt: struct.Struct(fmt) for fmt in ['B', 'b', '>H', '>h', '>I', '>i', '>Q', '>q', '>f', '>d']}
+
+def unpack(data):
+  data = memoryview(data).cast('B')
+  offset = 0
+  def read(fmt):
+    nonlocal offset
+    unpacker = MSGPACK_STRUCTS[fmt]
+    value = unpacker.unpack_from(data, offset)[0]
+    offset += unpacker.size
+    return value
+  def take(length):
+    nonlocal offset
+    if offset + length > len(data):
+      raise ValueError('Unexpected end of MessagePack data')
+    chunk = data[offset:offset + length]
+    offset += length
+    return chunk
+  def value():
+    byte = read('B')
+    if byte <= 0x7f:
+      return byte
+    elif byte >= 0xe0:
+      return byte - 0x100
+    elif 0x80 <= byte <= 0x8f:
+      return mapping(byte & 0x0f)
+    elif 0x90 <= byte <= 0x9f:
+      return array(byte & 0x0f)
+    elif 0xa0 <= byte <= 0xbf:
+      return str(take(byte & 0x1f), 'utf-8')
+    elif byte == 0xc0:
+      return None
+    elif byte == 0xc2:
+      return False
+    elif byte == 0xc3:
+      return True
+    elif byte in (0xc4, 0xc5, 0xc6):
+      return bytes(take(read({0xc4: 'B', 0xc5: '>H', 0xc6: '>I'}[byte])))
+    elif byte == 0xca:
+      return read('>f')
+    elif byte == 0xcb:
+      return read('>d')
+    elif 0xcc <= byte <= 0xd3:
+      return read({0xcc: 'B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q', 0xd0: 'b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}[byte])
+    elif byte in (0xd9, 0xda, 0xdb):
+      return str(take(read({0xd9: 'B', 0xda: '>H', 0xdb: '>I'}[byte])), 'utf-8')
+    elif byte in (0xdc, 0xdd):
+      return array(read('>H' if byte == 0xdc else '>I'))
+    elif byte in (0xde, 0xdf):
+      return mapping(read('>H' if byte == 0xde else '>I'))
+    raise ValueError(f'Unsupported MessagePack type 0x{byte:02x}')
+  def array(length):
+    return [value() for _ in range(length)]
+  def mapping(length):
+    result = {}
+    for _ in range(length):
+      key = value()
+      result[key] = value()
+    return result
+  try:
+    result = value()
+  except struct.error:
+    raise ValueError('Unexpected end of MessagePack data')
+  if offset != len(data):
+    raise ValueError('Extra data after MessagePack value')
+  return result
+
+
+
+class MsgpackCodec:
+  name = 'msgpack'
+  content_type = 'application/msgpack'
+
+  def __init__(self, pure=False):
+    self.pure = pure or msgpack is None
+
+  def encode(self, value):
+    if self.pure:
+      return pack(value)
+    return msgpack.packb(value, default=encode_default, use_bin_type=True)
+
+  def decode(self, data):
+    if self.pure:
+      return unpack(data)
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+
+def is_msgpack(media_type):
+  return bool(media_type) and 'msgpack' in media_type
+
+
+
+def get_codec(codec=None):
+  if codec is None or codec == 'json':
+    return JsonCodec()
+  elif codec == 'orjson':
+    if orjson is None:
+      raise ValueError('The orjson codec requires the orjson package')
+    return OrjsonCodec()
+  elif codec == 'msgspec':
+    if msgspec is None:
+      raise ValueError('The msgspec codec requires the msgspec package')
+    return MsgspecCodec()
+  elif codec == 'msgpack':
+    return MsgpackCodec()
+  elif codec == 'auto':
+    if orjson is not None:
+      return OrjsonCodec()
+    elif msgspec is not None:
+      return MsgspecCodec()
+    return JsonCodec()
+  elif callable(getattr(codec, 'encode', None)) and callable(getattr(codec, 'decode', None)):
+    return codec
+  raise ValueError('Codec should be "json", "orjson", "msgspec", "msgpack", "auto" or an object with encode and decode methods')
+
+
+
+def available_encodings():
+  encodings = []
+  if zstandard is not None:
+    encodings.append('zstd')
+  if brotli is not None:
+    encodings.append('br')
+  encodings.extend(['gzip', 'deflate'])
+  return encodings
+
+
+
+def choose_encoding(accept_encoding, encodings=None):
+  if not accept_encoding:
+    return None
+  accepted = {}
+  for part in accept_encoding.split(','):
+    name, _, params = part.strip().partition(';')
+    quality = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        quality = float(params[2:])
+      except ValueError:
+        quality = 0.0
+    accepted[name.strip().lower()] = quality
+  for encoding in encodings or available_encodings():
+    if accepted.get(encoding, accepted.get('*', 0)) > 0:
+      return encoding
+  return None
+
+
+
+def compress(data, encoding):
+  if encoding == 'gzip':
+    return gzip.compress(data, 6)
+  elif encoding == 'deflate':
+    return zlib.compress(data, 6)
+  elif encoding == 'br' and brotli is not None:
+    return brotli.compress(data, quality=4)
+  elif encoding == 'zstd' and zstandard is not None:
+    return zstandard.ZstdCompressor(level=3).compress(data)
+  raise ValueError(f'Unsupported content encoding: {encoding}')
+
+
+
+def bounded_encodings(incremental=False):
+  encodings = []
+  if zstandard is not None and not incremental:
+    encodings.append('zstd')
+  if brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data'):
+    encodings.append('br')
+  encodings.extend(['gzip', 'deflate'])
+  return encodings
+
+
+
+class Decompressor:
+
+  def __init__(self, encoding, max_length=None):
+    self.encoding = encoding
+    self.max_length = max_length
+    self.total = 0
+    if encoding == 'gzip':
+      self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+      self._decompressor = zlib.decompressobj()
+    elif encoding == 'br' and brotli is not None:
+      self._decompressor = brotli.Decompressor()
+    elif encoding == 'zstd' and zstandard is not None:
+      self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+      raise ValueError(f'Unsupported content encoding: {encoding}')
+    if max_length is not None and encoding not in bounded_encodings(incremental=True):
+      raise BlestError(f'The {encoding} content encoding cannot be decompressed within a size limit', status=415, code='UNSUPPORTED_ENCODING')
+
+  def decompress(self, data):
+    if self.max_length is None:
+      if self.encoding == 'br':
+        return self._decompressor.process(data) if hasattr(self._decompressor, 'process') else self._decompressor.decompress(data)
+      return self._decompressor.decompress(data)
+    if self.encoding == 'br':
+      chunks = [self._check(self._decompressor.process(data, output_buffer_limit=self.max_length - self.total + 1))]
+      while not self._decompressor.can_accept_more_data():
+        chunk = self._check(self._decompressor.process(b'', output_buffer_limit=self.max_length - self.total + 1))
+        if not chunk:
+          break
+        chunks.append(chunk)
+      return b''.join(chunks)
+    return self._check(self._decompressor.decompress(data, self.max_length - self.total + 1))
+
+  def _check(self, chunk):
+    self.total += len(chunk)
+    if self.total > self.max_length:
+      raise BlestError(f'Decompressed content exceeds {self.max_length} bytes', status=413, code='PAYLOAD_TOO_LARGE')
+    return chunk
+
+
+
+def decompress(data, encoding, max_length=None):
+  if not encoding or encoding == 'identity':
+    return data
+  elif encoding == 'zstd' and zstandard is not None and max_length is not None:
+    chunks = []
+    total = 0
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+      while True:
+        chunk = reader.read(min(65536, max_length - total + 1))
+        if not chunk:
+          break
+        total += len(chunk)
+        if total > max_length:
+          raise BlestError(f'Decompressed content exceeds {max_length} bytes', status=413, code='PAYLOAD_TOO_LARGE')
+        chunks.append(chunk)
+    return b''.join(chunks)
+  return Decompressor(encoding, max_length).decompress(data)
+
+
+
+def compress_response(payload, accept_encoding, threshold=1024, encodings=None):
+  if payload is None or len(payload) < threshold:
+    return payload, None
+  encoding = choose_encoding(accept_encoding, encodings)
+  if encoding is None:
+    return payload, None
+  return compress(payload, encoding), encoding
+
+
+
+class EventEmitter:
+  def __init__(self):
+    self.listeners = {}
+  def once(self, name, listener):
+    if name not in self.listeners:
+      self.listeners[name] = []
+    self.listeners[name].append(listener)
+  def emit(self, name, *args):
+    if name in self.listeners:
+      for listener in self.listeners[name]:
+        listener(*args)
+      del self.listeners[name]
+
+
+
+class FrozenDict(dict):
+  def _immutable(self, *args, **kwargs):
+    raise TypeError('Shared context data is read-only')
+  __setitem__ = __delitem__ = __ior__ = _immutable
+  clear = pop = popitem = setdefault = update = _immutable
+  def __reduce__(self):
+    return (FrozenDict, (dict(self),))
+
+
+
+class FrozenList(list):
+  def _immutable(self, *args, **kwargs):
+    raise TypeError('Shared context data is read-only')
+  __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+  append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+  def __reduce__(self):
+    return (FrozenList, (list(self),))
+
+
+
+def freeze(value):
+  if isinstance(value, FrozenDict) or isinstance(value, FrozenList):
+    return value
+  elif isinstance(value, dict):
+    return FrozenDict((key, freeze(item)) for key, item in value.items())
+  elif isinstance(value, list):
+    return FrozenList(freeze(item) for item in value)
+  return value
+
+
+
+def freeze_context(context):
+  if not context:
+    return {}
+  return {key: freeze(value) for key, value in context.items()}
+
+
+
+_MISSING = object()
+_DELETED = object()
+
+class LoaderSpec:
+  __slots__ = ('name', 'batch_function', 'max_batch_size', 'step', 'stats')
+
+  def __init__(self, name, batch_function, max_batch_size=None):
+    self.name = name
+    self.batch_function = batch_function
+    self.max_batch_size = max_batch_size
+    self.step = RouteStep(batch_function)
+    self.stats = {'loads': 0, 'cache_hits': 0, 'batches': 0, 'keys': 0}
+
+
+
+class BatchLoaders(Mapping):
+
+  def __init__(self, specs, context, executor=None):
+    self._specs = specs
+    self._context = context
+    self._executor = executor
+    self._loaders = {}
+
+  def __getitem__(self, name):
+    loader = self._loaders.get(name)
+    if loader is None:
+      loader = self._loaders[name] = DataLoader(self._specs[name], self._context, self._executor)
+    return loader
+
+  def __iter__(self):
+    return iter(self._specs)
+
+  def __len__(self):
+    return len(self._specs)
+
+  def __reduce__(self):
+    return (dict, ())
+
+
+
+class DataLoader:
+
+  def __init__(self, spec, context, executor=None):
+    self.name = spec.name
+    self._spec = spec
+    self._context = context
+    self._executor = executor
+    self._cache = {}
+    self._queue = []
+
+  async def load(self, key):
+    future = self._cache.get(key)
+    self._spec.stats['loads'] += 1
+    if future is None:
+      loop = asyncio.get_running_loop()
+      future = self._cache[key] = loop.create_future()
+      if not self._queue:
+        loop.call_soon(self._dispatch)
+      self._queue.append((key, future))
+    else:
+      self._spec.stats['cache_hits'] += 1
+    return await asyncio.shield(future)
+
+  async def load_many(self, keys):
+    return await asyncio.gather(*[self.load(key) for key in keys])
+
+  def prime(self, key, value):
+    if key not in self._cache:
+      future = self._cache[key] = asyncio.get_running_loop().create_future()
+      future.set_result(value)
+
+  def clear(self, key):
+    self._cache.pop(key, None)
+
+  def _dispatch(self):
+    queue, self._queue = self._queue, []
+    size = self._spec.max_batch_size or len(queue)
+    for i in range(0, len(queue), size):
+      asyncio.ensure_future(self._run(queue[i:i + size]))
+
+  async def _run(self, batch):
+    keys = [key for key, _ in batch]
+    self._spec.stats['batches'] += 1
+    self._spec.stats['keys'] += len(keys)
+    try:
+      if self._spec.step.is_async:
+        values = await self._spec.batch_function(keys, self._context)
+      elif self._executor is not None:
+        values = await self._executor.run('loader:' + self.name, self._spec.step, keys, self._context)
+      else:
+        values = await asyncio.get_running_loop().run_in_executor(None, self._spec.batch_function, keys, self._context)
+      if isinstance(values, Mapping):
+        values = [values.get(key) for key in keys]
+      elif values is None or len(values) != len(keys):
+        raise BlestError(f'Loader "{self.name}" should return one value per key')
+    except Exception as error:
+      values = [error] * len(keys)
+    for (key, future), value in zip(batch, values):
+      if future.done():
+        continue
+      elif isinstance(value, Exception):
+        self._cache.pop(key, None)
+        future.set_exception(value)
+        future.exception()
+      else:
+        future.set_result(value)
+
+
+
+class CancellationToken:
+  __slots__ = ('deadline', '_cancelled')
+
+  def __init__(self, deadline=None):
+    self.deadline = deadline
+    self._cancelled = False
+
+  def __reduce__(self):
+    return (CancellationToken, (self.deadline,))
+
+  def cancel(self):
+    self._cancelled = True
+
+  @property
+  def expired(self):
+    return self.deadline is not None and time.monotonic() >= self.deadline
+
+  @property
+  def cancelled(self):
+    return self._cancelled or self.expired
 
-    if 'description' in config:
-      if config['description'] is not None and not isinstance(config['description'], str):
-        raise ValueError('Description should be a str')
-      self.routes[route]['description'] = config['description']
+  @property
+  def remaining(self):
+    if self.deadline is None:
+      return None
+    return max(0.0, (self.deadline - time.monotonic()) * 1000)
 
-    if 'schema' in config:
-      if config['schema'] is not None and not isinstance(config['schema'], dict):
-        raise ValueError('Schema should be a dict')
-      self.routes[route]['schema'] = config['schema']
+  def raise_if_cancelled(self):
+    if self.cancelled:
+      raise BlestError('Deadline exceeded', status=504, code='DEADLINE_EXCEEDED')
 
-    if 'visible' in config:
-      if config['visible'] is not None and config['visible'] not in [True, False]:
-        raise ValueError('Visible should be True or False')
-      self.routes[route]['visible'] = config['visible']
 
-    if 'validate' in config:
-      if config['validate'] is not None and config['validate'] not in [True, False]:
-        raise ValueError('Validate should be True or False')
-      self.routes[route]['validate'] = config['validate']
 
-    if 'timeout' in config:
-      if config['timeout'] is not None and not isinstance(config['timeout'], int) or config['timeout'] <= 0:
-        raise ValueError('Timeout should be a positive int')
-      self.routes[route]['timeout'] = config['timeout']
+class RequestContext(MutableMapping):
+  __slots__ = ('_shared', '_local')
 
-  def merge(self, router):
-    if not router or not isinstance(router, Router):
-      raise ValueError('Router is required')
+  def __init__(self, shared=None, local=None):
+    self._shared = shared if shared is not None else {}
+    self._local = local if local is not None else {}
 
-    new_routes = list(router.routes.keys())
-    existing_routes = list(self.routes.keys())
+  def __getitem__(self, key):
+    value = self._local.get(key, _MISSING)
+    if value is _MISSING:
+      return self._shared[key]
+    elif value is _DELETED:
+      raise KeyError(key)
+    return value
 
-    if not new_routes:
-      raise ValueError('No routes to merge')
+  def __setitem__(self, key, value):
+    self._local[key] = value
 
-    for route in new_routes:
-      if route in existing_routes:
-        raise ValueError('Cannot merge duplicate routes: ' + route)
-      else:
-        self.routes[route] = {
-          **router.routes[route],
-          'handler': self._middleware + router.routes[route]['handler'] + self._afterware,
-          'timeout': router.routes[route].get('timeout', self._timeout)
-        }
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    if key in self._shared:
+      self._local[key] = _DELETED
+    else:
+      del self._local[key]
 
-  def namespace(self, prefix, router):
-    if not router or not isinstance(router, type(self)):
-      raise ValueError('Router is required')
+  def __contains__(self, key):
+    value = self._local.get(key, _MISSING)
+    if value is _MISSING:
+      return key in self._shared
+    return value is not _DELETED
 
-    prefix_error = validate_route(prefix)
-    if prefix_error:
-      raise ValueError(prefix_error)
+  def __iter__(self):
+    local = self._local
+    for key, value in local.items():
+      if value is not _DELETED:
+        yield key
+    for key in self._shared:
+      if key not in local:
+        yield key
 
-    new_routes = list(router.routes.keys())
-    existing_routes = list(self.routes.keys())
+  def __len__(self):
+    return sum(1 for _ in self)
 
-    if not new_routes:
-      raise ValueError('No routes to namespace')
+  def __repr__(self):
+    return f'RequestContext({dict(self)!r})'
 
-    for route in new_routes:
-      ns_route = f"{prefix}/{route}"
-      if ns_route in existing_routes:
-        raise ValueError('Cannot merge duplicate routes: ' + ns_route)
-      else:
-        self.routes[ns_route] = {
-          **router.routes[route],
-          'handler': self._middleware + router.routes[route]['handler'] + self._afterware,
-          'timeout': router.routes[route].get('timeout', self._timeout)
-        }
+  def get(self, key, default=None):
+    value = self._local.get(key, _MISSING)
+    if value is _MISSING:
+      return self._shared.get(key, default)
+    elif value is _DELETED:
+      return default
+    return value
 
-  async def handle(self, request, context=None):
-    return await handle_request(self.routes, request, context)
+  def to_dict(self):
+    return dict(self)
 
 
 
-class EventEmitter:
-  def __init__(self):
-    self.listeners = {}
-  def once(self, name, listener):
-    if name not in self.listeners:
-      self.listeners[name] = []
-    self.listeners[name].append(listener)
-  def emit(self, name, *args):
-    if name in self.listeners:
-      for listener in self.listeners[name]:
-        listener(*args)
-      del self.listeners[name]
+default_error_reporter = ErrorReporter()
 
 
 
@@ -198,39 +1814,484 @@ class BlestError(Exception):
 
 
 
+class RouteTimeout(Exception):
+  pass
+
+
+
+QUEUE_POLICIES = ('block', 'reject', 'drop_oldest')
+ENDPOINT_POLICIES = ('round_robin', 'least_outstanding', 'latency_ewma')
+
+class Endpoint:
+
+  def __init__(self, url, failure_threshold=5, recovery_timeout=10000, alpha=0.3):
+    self.url = url
+    self.failure_threshold = failure_threshold
+    self.recovery_timeout = recovery_timeout / 1000
+    self.alpha = alpha
+    self.state = 'closed'
+    self.failures = 0
+    self.opened_at = None
+    self.probing = False
+    self.outstanding = 0
+    self.latency = None
+
+  def available(self, now):
+    if self.state == 'open' and now - self.opened_at >= self.recovery_timeout:
+      self.state = 'half_open'
+      self.probing = False
+    return self.state == 'closed' or (self.state == 'half_open' and not self.probing)
+
+  def acquire(self):
+    if self.state == 'half_open':
+      self.probing = True
+    self.outstanding += 1
+
+  def succeeded(self):
+    self.state = 'closed'
+    self.failures = 0
+    self.probing = False
+
+  def failed(self):
+    self.failures += 1
+    if self.state == 'half_open' or self.failures >= self.failure_threshold:
+      self.state = 'open'
+      self.opened_at = time.monotonic()
+    self.probing = False
+
+  def abandoned(self):
+    self.probing = False
+
+  def observe(self, latency):
+    self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+
+  def stats(self):
+    return {
+      'url': self.url,
+      'state': self.state,
+      'failures': self.failures,
+      'outstanding': self.outstanding,
+      'latency_ewma_ms': self.latency * 1000 if self.latency is not None else None
+    }
+
+
+class AdaptiveBatching:
+  def __init__(self, batch_size, batch_delay, min_batch_delay=0, batch_size_ceiling=None, smoothing=0.2):
+    self.min_batch_size = batch_size
+    self.max_batch_size = batch_size_ceiling or batch_size * 4
+    self.min_delay = min_batch_delay
+    self.max_delay = batch_delay
+    self.smoothing = smoothing
+    self.batch_size = batch_size
+    self.interval = None
+    self.rtt = None
+    self.baseline_rtt = None
+    self._last_arrival = None
+
+  def _average(self, average, value):
+    return value if average is None else average + self.smoothing * (value - average)
+
+  def arrival(self, timestamp):
+    if self._last_arrival is not None:
+      gap = min((timestamp - self._last_arrival) * 1000, self.max_delay * 2)
+      self.interval = self._average(self.interval, gap)
+    self._last_arrival = timestamp
+
+  def completed(self, rtt):
+    rtt *= 1000
+    self.rtt = self._average(self.rtt, rtt)
+    if self.baseline_rtt is None or rtt < self.baseline_rtt:
+      self.baseline_rtt = rtt
+    else:
+      self.baseline_rtt += self.smoothing * 0.05 * (rtt - self.baseline_rtt)
+    if self.rtt > self.baseline_rtt * 2:
+      self.batch_size = min(self.max_batch_size, math.ceil(self.batch_size * 1.5))
+    elif self.rtt < self.baseline_rtt * 1.25:
+      self.batch_size = max(self.min_batch_size, math.floor(self.batch_size / 1.5))
+
+  @property
+  def delay(self):
+    if self.interval is None or self.interval >= self.max_delay:
+      return self.min_delay
+    return max(self.min_delay, min(self.max_delay, self.interval * (self.batch_size - 1)))
+
+
 class HttpClient:
-  def __init__(self, url, max_batch_size=25, batch_delay=10, http_headers={}):
-    self._url = url
+  def __init__(self, url, max_batch_size=25, batch_delay=10, http_headers={}, pool_size=100, pool_size_per_host=0, keepalive_timeout=15, dns_cache_ttl=10, max_in_flight=None, max_queue_size=None, queue_policy='block', adaptive=False, min_batch_delay=0, batch_size_ceiling=None, stream=False, codec=None, compression=True, compress_requests=None, policy='round_robin', failure_threshold=5, recovery_timeout=10000, idempotent_routes=None, hedge_percentile=None, hedge_delay=None, max_response_bytes=10 * 1024 * 1024, timeout=30000):
+    urls = [url] if isinstance(url, str) else list(url or [])
+    if not urls or not all(isinstance(item, str) and item for item in urls):
+      raise ValueError('URL should be a str or a list of str')
+    elif policy not in ENDPOINT_POLICIES:
+      raise ValueError('Policy should be one of: ' + ', '.join(ENDPOINT_POLICIES))
+    elif not isinstance(failure_threshold, int) or failure_threshold <= 0:
+      raise ValueError('Failure threshold should be a positive int')
+    elif not isinstance(recovery_timeout, (int, float)) or recovery_timeout <= 0:
+      raise ValueError('Recovery timeout should be a positive number')
+    elif hedge_percentile is not None and (not isinstance(hedge_percentile, (int, float)) or not 0 < hedge_percentile < 100):
+      raise ValueError('Hedge percentile should be a number between 0 and 100')
+    elif hedge_delay is not None and (not isinstance(hedge_delay, (int, float)) or hedge_delay < 0):
+      raise ValueError('Hedge delay should be a non-negative number')
+    elif pool_size is not None and (not isinstance(pool_size, int) or pool_size < 0):
+      raise ValueError('Pool size should be a non-negative int')
+    elif pool_size_per_host is not None and (not isinstance(pool_size_per_host, int) or pool_size_per_host < 0):
+      raise ValueError('Pool size per host should be a non-negative int')
+    elif keepalive_timeout is not None and (not isinstance(keepalive_timeout, (int, float)) or keepalive_timeout < 0):
+      raise ValueError('Keep-alive timeout should be a non-negative number')
+    elif max_in_flight is not None and (not isinstance(max_in_flight, int) or max_in_flight <= 0):
+      raise ValueError('Max in flight should be a positive int')
+    elif max_queue_size is not None and (not isinstance(max_queue_size, int) or max_queue_size <= 0):
+      raise ValueError('Max queue size should be a positive int')
+    elif queue_policy not in QUEUE_POLICIES:
+      raise ValueError('Queue policy should be one of: ' + ', '.join(QUEUE_POLICIES))
+    elif compress_requests is not None and (not isinstance(compress_requests, int) or compress_requests < 0):
+      raise ValueError('Compress requests should be a non-negative int byte threshold')
+    elif max_response_bytes is not None and (not isinstance(max_response_bytes, int) or max_response_bytes <= 0):
+      raise ValueError('Max response bytes should be a positive int')
+    elif timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+      raise ValueError('Timeout should be a positive number')
+    elif batch_size_ceiling is not None and (not isinstance(batch_size_ceiling, int) or batch_size_ceiling < max_batch_size):
+      raise ValueError('Batch size ceiling should be an int no smaller than the max batch size')
+    self._endpoints = [Endpoint(item, failure_threshold, recovery_timeout) for item in urls]
+    self._policy = policy
+    self._next_endpoint = 0
+    self._idempotent_routes = frozenset(idempotent_routes or ())
+    self._hedge_percentile = hedge_percentile
+    self._hedge_delay = hedge_delay
+    self._latencies = deque(maxlen=200)
+    self._hedges = 0
+    self._failovers = 0
     self._max_batch_size = max_batch_size
     self._batch_delay = batch_delay
-    self._http_headers = http_headers
-    self._timer = False
+    self._stream = stream
+    self._codec = get_codec(codec)
+    self._json_codec = self._codec if self._codec.name == 'json' else JsonCodec()
+    if stream:
+      accept = 'application/x-ndjson, application/json'
+    elif self._codec.name == 'msgpack':
+      accept = self._codec.content_type + ', application/json'
+    else:
+      accept = 'application/json'
+    self._http_headers = {
+      **(http_headers or {}),
+      'Accept': accept,
+      'Content-Type': self._codec.content_type
+    }
+    self._compress_requests = compress_requests
+    self._max_response_bytes = max_response_bytes
+    self._timeout = timeout
+    encodings = available_encodings() if max_response_bytes is None else bounded_encodings(incremental=stream)
+    self._http_headers['Accept-Encoding'] = ', '.join(encodings) if compression else 'identity'
+    self._pool_size = pool_size or 0
+    self._pool_size_per_host = pool_size_per_host or 0
+    self._keepalive_timeout = keepalive_timeout
+    self._dns_cache_ttl = dns_cache_ttl
+    self._max_in_flight = max_in_flight
+    self._max_queue_size = max_queue_size
+    self._queue_policy = queue_policy
+    self._session = None
+    self._semaphore = None
+    self._adaptive = AdaptiveBatching(max_batch_size, batch_delay, min_batch_delay, batch_size_ceiling) if adaptive else None
+    self._in_flight = 0
+    self._timer = None
+    self._flush_pending = False
     self._queue = []
+    self._queue_waiters = deque()
     self._emitter = EventEmitter()
+    self._requests = 0
+    self._batch_errors = 0
+    self._bytes_sent = 0
+    self._bytes_received = 0
+    self._flush_sizes = BucketHistogram(BATCH_SIZE_BUCKETS)
+    self._flush_intervals = BucketHistogram(FLUSH_INTERVAL_BUCKETS)
+    self._last_flush = None
 
-  async def _delay(self, func, time):
-    await asyncio.sleep(time / 1000)
-    await func()
+  async def __aenter__(self):
+    return self
 
-  async def _process(self):
-    new_queue = self._queue[:self._max_batch_size]
-    del self._queue[:self._max_batch_size]
-    if len(self._queue) == 0:
-      self._timer = False
+  async def __aexit__(self, *args):
+    await self.close()
+
+  @property
+  def session(self):
+    if self._session is None or self._session.closed:
+      connector_options = {
+        'limit': self._pool_size,
+        'limit_per_host': self._pool_size_per_host,
+        'use_dns_cache': self._dns_cache_ttl is not None,
+        'ttl_dns_cache': self._dns_cache_ttl
+      }
+      if self._keepalive_timeout:
+        connector_options['keepalive_timeout'] = self._keepalive_timeout
+      else:
+        connector_options['force_close'] = True
+      session_options = {'timeout': aiohttp.ClientTimeout(total=self._timeout / 1000)} if self._timeout is not None else {}
+      self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(**connector_options), headers=self._http_headers, auto_decompress=False, **session_options)
+    return self._session
+
+  @property
+  def queue_depth(self):
+    return len(self._queue)
+
+  @property
+  def in_flight(self):
+    return self._in_flight
+
+  async def close(self):
+    if self._session is not None and not self._session.closed:
+      await self._session.close()
+    self._session = None
+
+  @property
+  def batch_size(self):
+    return self._adaptive.batch_size if self._adaptive else self._max_batch_size
+
+  @property
+  def batch_delay(self):
+    return self._adaptive.delay if self._adaptive else self._batch_delay
+
+  def metrics(self):
+    return {
+      'requests_total': self._requests,
+      'queue_length': len(self._queue),
+      'in_flight': self._in_flight,
+      'batch_size': self.batch_size,
+      'batch_delay_ms': self.batch_delay,
+      'flush_items': self._flush_sizes.snapshot(),
+      'flush_interval_ms': self._flush_intervals.snapshot(),
+      'bytes_sent_total': self._bytes_sent,
+      'bytes_received_total': self._bytes_received,
+      'batch_errors_total': self._batch_errors,
+      'failovers_total': self._failovers,
+      'hedges_total': self._hedges,
+      'open_circuits': sum(1 for endpoint in self._endpoints if endpoint.state == 'open')
+    }
+
+  def endpoint_stats(self):
+    return [endpoint.stats() for endpoint in self._endpoints]
+
+  def _select_endpoint(self, exclude=()):
+    now = time.monotonic()
+    candidates = [endpoint for endpoint in self._endpoints if endpoint not in exclude and endpoint.available(now)]
+    if not candidates:
+      return None
+    elif self._policy == 'least_outstanding':
+      offset = self._next_endpoint % len(candidates)
+      endpoint = min(candidates[offset:] + candidates[:offset], key=lambda endpoint: endpoint.outstanding)
+      self._next_endpoint += 1
+    elif self._policy == 'latency_ewma':
+      endpoint = min(candidates, key=lambda endpoint: (endpoint.latency or 0.0) * (endpoint.outstanding + 1))
+    else:
+      endpoint = candidates[self._next_endpoint % len(candidates)]
+      self._next_endpoint += 1
+    endpoint.acquire()
+    return endpoint
+
+  def _current_hedge_delay(self):
+    if len(self._latencies) >= 10:
+      ordered = sorted(self._latencies)
+      delay = ordered[min(len(ordered) - 1, int(len(ordered) * self._hedge_percentile / 100))]
+      return max(delay, self._hedge_delay / 1000) if self._hedge_delay is not None else delay
+    return self._hedge_delay / 1000 if self._hedge_delay is not None else None
+
+  def _schedule_flush(self, delay):
+    if self._flush_pending:
+      return
+    elif self._timer is not None:
+      if delay > 0:
+        return
+      self._timer.cancel()
+    if delay > 0:
+      self._timer = asyncio.get_running_loop().call_later(delay / 1000, self._start_flush)
     else:
-      self._timer = True
-      asyncio.create_task(self._delay(self._process, self._batch_delay))
-    async with aiohttp.ClientSession() as session:
+      self._start_flush()
+
+  def _start_flush(self):
+    self._timer = None
+    self._flush_pending = True
+    asyncio.create_task(self._process())
+
+  async def _process(self):
+    if self._max_in_flight:
+      if self._semaphore is None:
+        self._semaphore = asyncio.Semaphore(self._max_in_flight)
+      await self._semaphore.acquire()
+    try:
+      self._flush_pending = False
+      batch_size = self.batch_size
+      new_queue = self._queue[:batch_size]
+      del self._queue[:batch_size]
+      if self._queue:
+        self._schedule_flush(0 if self._adaptive and len(self._queue) >= self.batch_size else self.batch_delay)
+      self._release_queue_waiters()
+      if new_queue:
+        now = time.monotonic()
+        if self._last_flush is not None:
+          self._flush_intervals.record((now - self._last_flush) * 1000)
+        self._last_flush = now
+        self._flush_sizes.record(len(new_queue))
+        self._in_flight += 1
+        try:
+          await self._send(new_queue)
+        finally:
+          self._in_flight -= 1
+    finally:
+      if self._semaphore is not None:
+        self._semaphore.release()
+
+  async def _send(self, new_queue):
+    try:
+      start = time.monotonic()
+      data = self._codec.encode(new_queue)
+      headers = None
+      if self._compress_requests is not None and len(data) >= self._compress_requests:
+        data = compress(data, 'gzip')
+        headers = {'Content-Encoding': 'gzip'}
+      await self._dispatch(new_queue, data, headers)
+      if self._adaptive:
+        self._adaptive.completed(time.monotonic() - start)
+      error = {'message': 'Missing response'}
+    except Exception as e:
+      self._batch_errors += 1
+      error = {'message': str(e) or 'Network Error'}
+    for q in new_queue:
+      self._emitter.emit(q[0], None, error)
+
+  async def _dispatch(self, new_queue, data, headers):
+    idempotent = all(q[1] in self._idempotent_routes for q in new_queue)
+    tried = set()
+    error = None
+    while True:
+      endpoint = self._select_endpoint(tried)
+      if endpoint is None:
+        if error is not None:
+          raise error
+        raise BlestError('No endpoints are available', status=503, code='UNAVAILABLE')
+      tried.add(endpoint)
       try:
-        response = await session.post(self._url, json=new_queue, headers=self._http_headers.update({'Accept': 'application/json', 'Content-Type': 'application/json'}))
+        if idempotent and self._hedge_percentile is not None:
+          await self._hedge(endpoint, tried, data, headers)
+        else:
+          await self._attempt(endpoint, data, headers)
+        return
+      except Exception as e:
+        error = e
+        if not self._retryable(e, idempotent):
+          raise
+        self._failovers += 1
+
+  def _retryable(self, error, idempotent):
+    if isinstance(error, aiohttp.ClientConnectorError):
+      return True
+    elif not idempotent:
+      return False
+    elif isinstance(error, aiohttp.ClientResponseError):
+      return error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+  async def _hedge(self, endpoint, tried, data, headers):
+    primary = asyncio.ensure_future(self._attempt(endpoint, data, headers))
+    tasks = [primary]
+    try:
+      delay = self._current_hedge_delay()
+      if delay is not None:
+        await asyncio.wait({primary}, timeout=delay)
+        if not primary.done():
+          secondary_endpoint = self._select_endpoint(tried)
+          if secondary_endpoint is not None:
+            tried.add(secondary_endpoint)
+            self._hedges += 1
+            tasks.append(asyncio.ensure_future(self._attempt(secondary_endpoint, data, headers)))
+            pending = set(tasks)
+            error = None
+            while pending:
+              done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+              for task in done:
+                error = task.exception()
+                if error is None:
+                  return
+                elif not self._retryable(error, True):
+                  raise error
+            raise error
+      await primary
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  async def _attempt(self, endpoint, data, headers):
+    start = time.monotonic()
+    responded = False
+    try:
+      self._bytes_sent += len(data)
+      async with self.session.post(endpoint.url, data=data, headers=headers) as response:
+        if response.status < 500:
+          responded = True
+          endpoint.succeeded()
         response.raise_for_status()
-        response_json = await response.json()
-        for r in response_json:
-          self._emitter.emit(r[0], r[2], r[3])
-      except aiohttp.ClientError as e:
-        for q in new_queue:
-          self._emitter.emit(q[0], None, response_json)
-  
+        encoding = response.headers.get('Content-Encoding')
+        if response.content_type == 'application/x-ndjson':
+          decompressor = Decompressor(encoding, self._max_response_bytes) if encoding and encoding != 'identity' else None
+          buffer = b''
+          async for chunk in response.content.iter_any():
+            self._bytes_received += len(chunk)
+            buffer += decompressor.decompress(chunk) if decompressor else chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+              if line.strip():
+                r = self._json_codec.decode(line)
+                self._emitter.emit(r[0], r[2], r[3])
+          if buffer.strip():
+            r = self._json_codec.decode(buffer)
+            self._emitter.emit(r[0], r[2], r[3])
+        else:
+          if is_msgpack(response.content_type):
+            codec = self._codec if self._codec.name == 'msgpack' else MsgpackCodec()
+          else:
+            codec = self._json_codec
+          raw = await response.read()
+          self._bytes_received += len(raw)
+          response_json = codec.decode(decompress(raw, encoding, self._max_response_bytes))
+          for r in response_json:
+            self._emitter.emit(r[0], r[2], r[3])
+      latency = time.monotonic() - start
+      endpoint.observe(latency)
+      self._latencies.append(latency)
+    except asyncio.CancelledError:
+      endpoint.abandoned()
+      raise
+    except Exception as error:
+      if not responded or isinstance(error, asyncio.TimeoutError):
+        endpoint.failed()
+      raise
+    finally:
+      endpoint.outstanding -= 1
+
+  def _release_queue_waiters(self):
+    available = self._max_queue_size - len(self._queue) if self._max_queue_size else len(self._queue_waiters)
+    while available > 0 and self._queue_waiters:
+      waiter = self._queue_waiters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        available -= 1
+
+  async def _enqueue(self, item):
+    while self._max_queue_size and len(self._queue) >= self._max_queue_size:
+      if self._queue_policy == 'reject':
+        raise BlestError('Request queue is full', status=503, code='QUEUE_FULL')
+      elif self._queue_policy == 'drop_oldest':
+        oldest = self._queue.pop(0)
+        self._emitter.emit(oldest[0], None, {'message': 'Request was dropped from a full queue', 'status': 503, 'code': 'QUEUE_FULL'})
+      else:
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue_waiters.append(waiter)
+        try:
+          await waiter
+        except asyncio.CancelledError:
+          if waiter in self._queue_waiters:
+            self._queue_waiters.remove(waiter)
+          raise
+    self._queue.append(item)
+
   async def request(self, route, body=None, headers=None):
     if not route:
       raise ValueError('Route is required')
@@ -239,110 +2300,354 @@ class HttpClient:
     elif headers and not isinstance(headers, dict):
       raise ValueError('Headers should be a dict')
     id = str(uuid())
+    self._requests += 1
     future = asyncio.Future()
     def callback(result, error):
-      if error:
+      if future.done():
+        return
+      elif error:
         future.set_exception(Exception(error['message']))
       else:
         future.set_result(result)
     self._emitter.once(id, callback)
-    self._queue.append([id, route, body, headers])
-    if self._timer == False:
-      self._timer = True
-      asyncio.create_task(self._delay(self._process, self._batch_delay))
+    try:
+      await self._enqueue([id, route, body, headers])
+    except BaseException:
+      self._emitter.listeners.pop(id, None)
+      raise
+    if self._adaptive:
+      self._adaptive.arrival(time.monotonic())
+      self._schedule_flush(0 if len(self._queue) >= self._adaptive.batch_size else self._adaptive.delay)
+    else:
+      self._schedule_flush(self._batch_delay)
     result = await future
     return result
 
 
 
-route_regex = r"^[a-zA-Z][a-zA-Z0-9_\-\/]*[a-zA-Z0-9]$"
-system_route_regex = r"^_[a-zA-Z][a-zA-Z0-9_\-\/]*[a-zA-Z0-9]$"
+route_regex = re.compile(r"^[a-zA-Z][a-zA-Z0-9_\-\/]*[a-zA-Z0-9]$")
+system_route_regex = re.compile(r"^_[a-zA-Z][a-zA-Z0-9_\-\/]*[a-zA-Z0-9]$")
+route_segment = r"[a-zA-Z][a-zA-Z0-9_\-]*[a-zA-Z0-9]"
+valid_route_regex = re.compile(route_segment + r"(?:/" + route_segment + r")*")
+valid_system_route_regex = re.compile(r"_" + route_segment + r"(?:/" + route_segment + r")*")
+letter_regex = re.compile(r"[a-zA-Z]")
+alphanumeric_regex = re.compile(r"[a-zA-Z0-9]")
+sub_route_start_regex = re.compile(r"\/[^a-zA-Z]")
+sub_route_end_regex = re.compile(r"[^a-zA-Z0-9]\/")
+sub_route_length_regex = re.compile(r"\/[a-zA-Z0-9_\-]{0,1}\/|\/[a-zA-Z0-9_\-]$|^[a-zA-Z0-9_\-]\/")
 
 def validate_route(route, system=False):
-    if not route:
+    if route and (valid_system_route_regex if system else valid_route_regex).fullmatch(route):
+        return None
+    elif not route:
         return 'Route is required'
-    elif system and not re.match(system_route_regex, route):
+    elif system and not system_route_regex.match(route):
         routeLength = len(route)
         if routeLength < 3:
             return 'System route should be at least three characters long'
         elif route[0] != '_':
             return 'System route should start with an underscore'
-        elif not re.match(r"[a-zA-Z0-9]", route[-1]):
+        elif not alphanumeric_regex.match(route[-1]):
             return 'System route should end with a letter or a number'
         else:
             return 'System route should contain only letters, numbers, dashes, underscores, and forward slashes'
-    elif not system and not re.match(route_regex, route):
+    elif not system and not route_regex.match(route):
         routeLength = len(route)
         if routeLength < 2:
             return 'Route should be at least two characters long'
-        elif not re.match(r"[a-zA-Z]", route[0]):
+        elif not letter_regex.match(route[0]):
             return 'Route should start with a letter'
-        elif not re.match(r"[a-zA-Z0-9]", route[-1]):
+        elif not alphanumeric_regex.match(route[-1]):
             return 'Route should end with a letter or a number'
         else:
             return 'Route should contain only letters, numbers, dashes, underscores, and forward slashes'
-    elif re.search(r"\/[^a-zA-Z]", route):
+    elif sub_route_start_regex.search(route):
         return 'Sub-routes should start with a letter'
-    elif re.search(r"[^a-zA-Z0-9]\/", route):
+    elif sub_route_end_regex.search(route):
         return 'Sub-routes should end with a letter or a number'
-    elif re.search(r"\/[a-zA-Z0-9_\-]{0,1}\/", route):
-        return 'Sub-routes should be at least two characters long'
-    elif re.search(r"\/[a-zA-Z0-9_\-]$", route):
-        return 'Sub-routes should be at least two characters long'
-    elif re.search(r"^[a-zA-Z0-9_\-]\/", route):
+    elif sub_route_length_regex.search(route):
         return 'Sub-routes should be at least two characters long'
     return None
 
 
 
-async def handle_request(routes, requests, context):
+class RouteNode:
+  __slots__ = ('children', 'terminal')
+
+  def __init__(self):
+    self.children = {}
+    self.terminal = False
+
+
+
+class RouteTable(MutableMapping):
+
+  def __init__(self):
+    self._routes = {}
+    self._trie = RouteNode()
+
+  def __getitem__(self, route):
+    return self._routes[route]
+
+  def __setitem__(self, route, config):
+    if route not in self._routes:
+      node = self._trie
+      for segment in route.split('/'):
+        child = node.children.get(segment)
+        if child is None:
+          child = node.children[segment] = RouteNode()
+        node = child
+      node.terminal = True
+    self._routes[route] = config
+
+  def __delitem__(self, route):
+    del self._routes[route]
+    path = []
+    node = self._trie
+    for segment in route.split('/'):
+      path.append((node, segment))
+      node = node.children[segment]
+    node.terminal = False
+    for parent, segment in reversed(path):
+      child = parent.children[segment]
+      if child.children or child.terminal:
+        break
+      del parent.children[segment]
+
+  def __iter__(self):
+    return iter(self._routes)
+
+  def __len__(self):
+    return len(self._routes)
+
+  def __contains__(self, route):
+    return route in self._routes
+
+  def get(self, route, default=None):
+    return self._routes.get(route, default)
+
+  def with_prefix(self, prefix):
+    node = self._trie
+    prefix = prefix.strip('/')
+    if prefix:
+      for segment in prefix.split('/'):
+        node = node.children.get(segment)
+        if node is None:
+          return {}
+    routes = {}
+    stack = [(node, prefix)]
+    while stack:
+      node, route = stack.pop()
+      if node.terminal:
+        routes[route] = self._routes[route]
+      for segment, child in reversed(node.children.items()):
+        stack.append((child, f'{route}/{segment}' if route else segment))
+    return routes
+
+  def insert_all(self, entries):
+    for route in entries:
+      if route in self._routes:
+        raise ValueError('Cannot merge duplicate routes: ' + route)
+    for route, config in entries.items():
+      self[route] = config
+
+
+
+def validate_batch(requests, max_batch_size=None):
   if not requests or not isinstance(requests, list):
     return handle_error(400, 'Request should be an array')
-  batch_id = uuid()
-  unique_ids = []
-  promises = []
-  for i in range(len(requests)):
-    request = requests[i]
-    # request_length = len(request)
+  if max_batch_size and len(requests) > max_batch_size:
+    return handle_error(413, f'Request should contain at most {max_batch_size} items')
+  unique_ids = set()
+  items = []
+  for request in requests:
     if not isinstance(request, list):
       return handle_error(400, 'Request item should be an array')
-    id = request[0] if len(request) > 0 else None
-    route = request[1] if len(request) > 1 else None
-    body = request[2] if len(request) > 2 else None
-    headers = request[3] if len(request) > 3 else None
+    request_length = len(request)
+    id = request[0] if request_length > 0 else None
+    route = request[1] if request_length > 1 else None
+    body = request[2] if request_length > 2 else None
+    headers = request[3] if request_length > 3 else None
     if not id or not isinstance(id, str):
       return handle_error(400, 'Request item should have an ID')
     if not route or not isinstance(route, str):
       return handle_error(400, 'Request items should have a route')
     if body and not isinstance(body, dict):
       return handle_error(400, 'Request item body should be an object')
-    if headers and not isinstance(headers, list):
+    if headers and not isinstance(headers, dict):
       return handle_error(400, 'Request item headers should be an object')
+    if headers and headers.get('_t') is not None and (not isinstance(headers['_t'], (int, float)) or isinstance(headers['_t'], bool) or headers['_t'] <= 0):
+      return handle_error(400, 'Request item deadline should be a positive number of milliseconds')
+    if headers and headers.get('_p') is not None and (not isinstance(headers['_p'], int) or isinstance(headers['_p'], bool)):
+      return handle_error(400, 'Request item priority should be an int')
     if id in unique_ids:
       return handle_error(400, 'Request items should have unique IDs')
-    unique_ids.append(id)
+    unique_ids.add(id)
+    items.append((id, route, body, headers))
+  return handle_result(items)
+
+
+
+class HandleOptions:
+  __slots__ = ('max_batch_size', 'executor', 'deduplicator', 'instruments', 'reporter', 'limiter', 'loaders', 'waits')
+
+  def __init__(self, max_batch_size=None, executor=None, deduplicator=None, instruments=None, reporter=None, limiter=None, loaders=None, waits=None):
+    self.max_batch_size = max_batch_size
+    self.executor = executor
+    self.deduplicator = deduplicator
+    self.instruments = instruments
+    self.reporter = reporter
+    self.limiter = limiter
+    self.loaders = loaders
+    self.waits = waits
+
+  def for_batch(self):
+    if self.deduplicator is None:
+      return self
+    return HandleOptions(self.max_batch_size, self.executor, self.deduplicator.for_batch(), self.instruments, self.reporter, self.limiter, self.loaders, self.waits)
+
+
+
+DEFAULT_HANDLE_OPTIONS = HandleOptions()
+
+
+
+async def handle_request(routes, requests, context, options=None, deadline=None):
+  promises, error = prepare_request(routes, requests, context, options, deadline)
+  if error:
+    return None, error
+  instruments = promises.options.instruments
+  if instruments is None:
+    results = await asyncio.gather(*promises.schedule())
+  else:
+    instruments.received(promises.batch_id, len(promises))
+    started = time.perf_counter()
+    pending = len(promises)
+    try:
+      results = await asyncio.gather(*promises.schedule())
+      for result in results:
+        instruments.completed(result, promises.known)
+      pending = 0
+    finally:
+      instruments.finished(promises, pending, started)
+  return handle_result(results)
+
+
+
+async def handle_stream(routes, requests, context, options=None, deadline=None):
+  promises, error = prepare_request(routes, requests, context, options, deadline)
+  if error:
+    return None, error
+  return handle_result(stream_results(promises))
+
+
+
+async def stream_results(promises):
+  instruments = promises.options.instruments
+  if instruments is not None:
+    instruments.received(promises.batch_id, len(promises))
+  started = time.perf_counter()
+  tasks = promises.schedule()
+  pending = len(tasks)
+  try:
+    for task in asyncio.as_completed(tasks):
+      result = await task
+      if instruments is not None:
+        instruments.completed(result, promises.known)
+        pending -= 1
+      yield result
+  finally:
+    cancelled = [task for task in tasks if not task.done()]
+    for task in cancelled:
+      task.cancel()
+    if cancelled:
+      await asyncio.gather(*cancelled, return_exceptions=True)
+    if instruments is not None:
+      instruments.finished(promises, pending, started)
+
+
+
+def prepare_request(routes, requests, context, options=None, deadline=None):
+  if deadline is not None and (not isinstance(deadline, (int, float)) or isinstance(deadline, bool) or deadline <= 0):
+    raise ValueError('Deadline should be a positive number of milliseconds')
+  options = options or DEFAULT_HANDLE_OPTIONS
+  items, error = validate_batch(requests, options.max_batch_size)
+  if error:
+    return None, error
+  now = time.monotonic()
+  batch_deadline = now + deadline / 1000 if deadline is not None else None
+  options = options.for_batch()
+  instruments = options.instruments
+  batch_id = uuid()
+  shared_context = freeze_context(context)
+  shared_context['batch_id'] = batch_id
+  if options.loaders:
+    shared_context['loaders'] = BatchLoaders(options.loaders, shared_context, options.executor)
+  promises = BatchPromises(batch_id, options)
+  for id, route, body, headers in items:
     this_route = routes.get(route)
-    route_handler = None
     if isinstance(this_route, dict):
-      route_handler = this_route.get('handler') or route_not_found
+      route_plan = this_route.get('plan') or compile_plan(this_route.get('handler') or route_not_found)
+    elif this_route:
+      route_plan = compile_plan(this_route)
     else:
-      route_handler = this_route or route_not_found
+      route_plan = NOT_FOUND_PLAN
+    selection = (headers and compile_selector(headers.get('_s') or None)) or FULL_SELECTION
+    item_deadline = batch_deadline
+    if headers and headers.get('_t') is not None:
+      header_deadline = now + headers['_t'] / 1000
+      if item_deadline is None or header_deadline < item_deadline:
+        item_deadline = header_deadline
+    cancellation = CancellationToken(item_deadline)
+    if headers and headers.get('_p') is not None:
+      priority = headers['_p']
+    else:
+      priority = this_route.get('priority', 0) if isinstance(this_route, dict) else 0
+    promises.priorities.append(priority)
     request_object = {
       'id': id,
       'route': route,
       'body': body or {},
-      'headers': headers
+      'headers': headers,
+      'selection': selection,
+      'cancellation': cancellation,
+      'priority': priority
     }
-    my_context = {
-      **(context or {}),
-      'batch_id': batch_id,
+    my_context = RequestContext(shared_context, {
       'request_id': id,
       'route': route,
-      'headers': headers
-    }
-    promises.append(route_reducer(route_handler, request_object, my_context, this_route.get('timeout') if this_route else None))
-  results = await asyncio.gather(*promises)
-  return handle_result(results)
+      'headers': headers,
+      'selection': selection,
+      'cancellation': cancellation
+    })
+    promise = functools.partial(route_reducer, route_plan, request_object, my_context, this_route.get('timeout') if isinstance(this_route, dict) else None, this_route if isinstance(this_route, dict) else None, options)
+    if instruments is not None:
+      if isinstance(this_route, dict):
+        promises.known.add(route)
+      if instruments.hooks or instruments.histograms is not None:
+        promise = functools.partial(instruments.track, promise, batch_id, id, route, isinstance(this_route, dict))
+    promises.append(promise)
+  return handle_result(promises)
+
+
+
+class BatchPromises(list):
+  __slots__ = ('batch_id', 'options', 'known', 'priorities')
+
+  def __init__(self, batch_id, options=None):
+    super().__init__()
+    self.batch_id = batch_id
+    self.options = options or DEFAULT_HANDLE_OPTIONS
+    self.known = set()
+    self.priorities = []
+
+  def schedule(self):
+    if not any(self.priorities):
+      return [asyncio.ensure_future(promise()) for promise in self]
+    tasks = [None] * len(self)
+    for index in sorted(range(len(self)), key=lambda index: -self.priorities[index]):
+      tasks[index] = asyncio.ensure_future(self[index]())
+    return tasks
 
 
 
@@ -364,66 +2669,208 @@ def route_not_found(*args):
 
 
 
-async def route_reducer(handler, request, context, timeout=None):
+class RouteStep:
+  __slots__ = ('handler', 'is_async', 'process')
+
+  def __init__(self, handler, process=False):
+    if not callable(handler):
+      raise ValueError('Handler should be a function')
+    self.handler = handler
+    self.is_async = asyncio.iscoroutinefunction(handler)
+    self.process = process
+    if process and self.is_async:
+      raise ValueError('Only sync handlers can run in a process pool')
+
+
+
+def compile_plan(handler, process_index=None):
+  if isinstance(handler, (list, tuple)):
+    return tuple(RouteStep(h, i == process_index) for i, h in enumerate(handler))
+  return (RouteStep(handler, process_index == 0),)
+
+
+
+def compile_route_plan(route):
+  process_index = route.get('handler_index', 0) if route.get('executor') == 'process' else None
+  return compile_plan(route['handler'], process_index)
+
+
+
+NOT_FOUND_PLAN = compile_plan(route_not_found)
+
+
+
+async def route_reducer(plan, request, context, timeout=None, config=None, options=None):
+  options = options or DEFAULT_HANDLE_OPTIONS
+  executor = options.executor
+  deduplicator = options.deduplicator
+  instruments = options.instruments
+  reporter = options.reporter
+  limiter = options.limiter
+  waits = options.waits
   
-  safe_context = copy.deepcopy(context)
+  safe_context = context
   safe_body = request['body'] or {}
   route = request['route']
-  result = None
+  cache = config.get('cache') if config else None
+  projected = config.get('projected', False) if config else False
+  selection = request.get('selection') or FULL_SELECTION
+  selector = selection.to_selector() if projected else None
+  cancellation = request.get('cancellation')
+  route_limiter = config.get('limiter') if config else None
+  priority = request.get('priority', 0)
+
+  tracer = instruments if instruments is not None and instruments.hooks else None
+  if tracer is not None:
+    handler_index = config.get('handler_index', 0) if config else 0
+    event = {'batch_id': context.get('batch_id'), 'request_id': request['id'], 'route': route}
+    def on_wait(pool, wait):
+      tracer.emit('executor_wait', **event, pool=pool, duration_ms=wait * 1000)
 
   async def target():
-    nonlocal result
-    if isinstance(handler, list):
-      for i in range(len(handler)):
-        temp_result = None
-        if asyncio.iscoroutinefunction(handler[i]):
-          temp_result = await handler[i](safe_body, safe_context)
-        elif callable(handler[i]):
-          loop = asyncio.get_event_loop()
-          temp_result = await loop.run_in_executor(None, handler[i], safe_body, safe_context)
-        else:
-          print(f'Tried to resolve route "{route}" with handler of type "{type(handler[i])}"')
-          return [request['id'], request['route'], None, { 'message': 'Internal Server Error', 'status': 500 }]
-        if temp_result and temp_result is not None:
-          if result and result is not None:
-            print(f'Multiple handlers on the route "{route}" returned results')
-            return [request['id'], request['route'], None, { 'message': 'Internal Server Error', 'status': 500 }]
-          else:
-            result = temp_result
-    else:
-      if asyncio.iscoroutinefunction(handler):
-        result = await handler(safe_body, safe_context)
-      elif callable(handler):
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, handler, safe_body, safe_context)
+    result = None
+    loop = None
+    for index, step in enumerate(plan):
+      if tracer is not None:
+        stage = 'middleware' if index < handler_index else 'handler' if index == handler_index else 'afterware'
+        tracer.emit('step_start', **event, stage=stage, index=index)
+        started = time.perf_counter()
+      if step.is_async:
+        temp_result = await step.handler(safe_body, safe_context)
+      elif executor is not None:
+        temp_result = await executor.run(route, step, safe_body, safe_context, on_wait if tracer is not None else None)
       else:
-        print(f'Tried to resolve route "{route}" with handler of type "{type(handler)}"')
-        return [request['id'], request['route'], None, { 'message': 'Internal Server Error', 'status': 500 }]
+        if loop is None:
+          loop = asyncio.get_running_loop()
+        temp_result = await loop.run_in_executor(None, step.handler, safe_body, safe_context)
+      if tracer is not None:
+        tracer.emit('step_end', **event, stage=stage, index=index, duration_ms=(time.perf_counter() - started) * 1000)
+      if temp_result:
+        if result:
+          (reporter or default_error_reporter).report(route, 'Multiple handlers on the route "%s" returned results', route)
+          raise BlestError()
+        result = temp_result
     return result
 
-  try:
-    if timeout is not None and timeout > 0:
+  async def limited():
+    started = time.monotonic()
+    if route_limiter is not None:
+      await route_limiter.acquire(priority)
+    try:
+      if limiter is not None:
+        await limiter.acquire(priority)
       try:
-        timeout_ms = timeout / 1000
-        await asyncio.wait_for(target(), timeout=timeout_ms)
-      except asyncio.exceptions.TimeoutError:
-        print(f'The route "{route}" timed out after {timeout} milliseconds')
-        return [request['id'], request['route'], None, {'message': 'Internal Server Error', 'status': 500}]
+        if waits is not None:
+          waits.record(priority, time.monotonic() - started)
+        return await target()
+      finally:
+        if limiter is not None:
+          limiter.release()
+    finally:
+      if route_limiter is not None:
+        route_limiter.release()
+
+  deadline = cancellation.deadline if cancellation is not None else None
+  shared = deduplicator is not None or cache is not None
+
+  async def run():
+    work = target() if route_limiter is None and limiter is None else limited()
+    limit = timeout / 1000 if timeout is not None and timeout > 0 else None
+    if deadline is not None and not shared:
+      remaining = deadline - time.monotonic()
+      if limit is None or remaining < limit:
+        limit = max(remaining, 0)
+    if limit is None:
+      return await work
+    started = time.monotonic()
+    try:
+      return await asyncio.wait_for(work, timeout=limit)
+    except asyncio.TimeoutError:
+      if time.monotonic() - started < limit:
+        raise
+      raise RouteTimeout()
+
+  validator = config.get('validator') if config and config.get('validate') else None
+
+  try:
+    if validator is not None:
+      errors = validator(safe_body)
+      if errors:
+        return [request['id'], request['route'], None, {
+          'message': 'Invalid body: ' + '; '.join(f'{path} {message}' for path, message in errors),
+          'status': 400,
+          'code': 'INVALID_BODY',
+          'data': {'errors': [{'path': path, 'message': message} for path, message in errors]}
+        }]
+
+    if cancellation is not None and cancellation.expired:
+      cancellation.cancel()
+      return [request['id'], request['route'], None, {'message': 'Deadline exceeded', 'status': 504, 'code': 'DEADLINE_EXCEEDED'}]
+
+    async def fetch():
+      if cache is not None:
+        return await cache.fetch(cache.key(safe_body, safe_context, selector), run)
+      return await run()
+
+    async def share():
+      if deduplicator is not None:
+        return await deduplicator.run(route, safe_body, request.get('headers'), safe_context, fetch, projected)
+      return await fetch()
+
+    if not shared:
+      result = await run()
     else:
-      await target()
+      safe_context = RequestContext(context, {'cancellation': CancellationToken()})
+      if deadline is None:
+        result = await share()
+      else:
+        task = asyncio.ensure_future(share())
+        try:
+          result = await asyncio.wait_for(asyncio.shield(task), timeout=max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+          if task.done():
+            raise
+          task.add_done_callback(lambda task: task.cancelled() or task.exception())
+          raise RouteTimeout()
 
-    if result is None or not isinstance(result, dict):
-      print(f'The route "{route}" did not return a result object')
+    if (result is None or not isinstance(result, dict)) and cancellation is not None and cancellation.expired:
+      return [request['id'], request['route'], None, {'message': 'Deadline exceeded', 'status': 504, 'code': 'DEADLINE_EXCEEDED'}]
+    elif result is None or not isinstance(result, dict):
+      (reporter or default_error_reporter).report(route, 'The route "%s" did not return a result object', route)
       return [request['id'], request['route'], None, { 'message': 'Internal Server Error', 'status': 500 }]
-    if request.get('headers') and request['headers'].get('_s'):
-      result = filter_object(result, request['headers']['_s'])
+    if not projected:
+      if tracer is not None and selection is not FULL_SELECTION:
+        started = time.perf_counter()
+        result = selection.project(result)
+        tracer.emit('selection', **event, duration_ms=(time.perf_counter() - started) * 1000)
+      else:
+        result = selection.project(result)
     return [request['id'], request['route'], result, None]
+  except RouteTimeout:
+    if cancellation is not None:
+      cancellation.cancel()
+    if instruments is not None:
+      instruments.timed_out(request['id'], route, context.get('batch_id'), timeout)
+    if cancellation is not None and cancellation.expired:
+      (reporter or default_error_reporter).report(route, 'The route "%s" missed its deadline', route, level=logging.WARNING)
+      return [request['id'], request['route'], None, {'message': 'Deadline exceeded', 'status': 504, 'code': 'DEADLINE_EXCEEDED'}]
+    (reporter or default_error_reporter).report(route, 'The route "%s" timed out after %s milliseconds', route, timeout, level=logging.WARNING)
+    return [request['id'], request['route'], None, {'message': 'Internal Server Error', 'status': 500}]
+  except asyncio.CancelledError:
+    if cancellation is not None:
+      cancellation.cancel()
+    raise
   except Exception as error:
-    traceback.print_exc()
     responseError = {
       'message': str(error) or 'Internal Server Error',
       'status': error.status or 500 if hasattr(error, 'status') else 500
     }
+    if not isinstance(error, BlestError):
+      (reporter or default_error_reporter).report(route, 'The route "%s" raised an error', route, error=error)
+    elif responseError['status'] >= 500:
+      (reporter or default_error_reporter).report(route, 'The route "%s" returned status %s: %s', route, responseError['status'], responseError['message'], level=logging.WARNING)
+    else:
+      (reporter or default_error_reporter).report(route, 'The route "%s" returned status %s: %s', route, responseError['status'], responseError['message'], level=logging.INFO)
     if hasattr(error, 'code') and isinstance(error.code, str):
       responseError['code'] = error.code
     if hasattr(error, 'data') and isinstance(error.data, dict):
@@ -441,28 +2888,333 @@ async def execute_async_functions(functions):
 
 
 
+SCHEMA_TYPES = {
+  'string': lambda value: isinstance(value, str),
+  'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+  'integer': lambda value: (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, float) and value.is_integer()),
+  'boolean': lambda value: isinstance(value, bool),
+  'object': lambda value: isinstance(value, dict),
+  'array': lambda value: isinstance(value, list),
+  'null': lambda value: value is None
+}
+
+SCHEMA_KEYWORDS = frozenset([
+  'type', 'enum', 'const', 'properties', 'required', 'additionalProperties', 'items', 'minItems', 'maxItems',
+  'minLength', 'maxLength', 'pattern', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum'
+])
+
+SCHEMA_ANNOTATIONS = frozenset(['title', 'description', 'default', 'examples', '$schema', '$id', '$comment'])
+
+def compile_schema(schema):
+  if not isinstance(schema, dict):
+    raise ValueError('Schema should be a dict')
+  for key in schema:
+    if key not in SCHEMA_KEYWORDS and key not in SCHEMA_ANNOTATIONS:
+      raise ValueError(f'Unsupported schema keyword: {key}')
+  if 'items' in schema and not isinstance(schema['items'], dict):
+    raise ValueError('Schema items should be a dict')
+  if 'properties' in schema and not isinstance(schema['properties'], dict):
+    raise ValueError('Schema properties should be a dict')
+  if 'additionalProperties' in schema and not isinstance(schema['additionalProperties'], (bool, dict)):
+    raise ValueError('Schema additionalProperties should be a bool or a dict')
+  if 'type' in schema and not (isinstance(schema['type'], str) or (isinstance(schema['type'], list) and schema['type'] and all(isinstance(name, str) for name in schema['type']))):
+    raise ValueError('Schema type should be a str or a list of str')
+  if 'enum' in schema and not isinstance(schema['enum'], list):
+    raise ValueError('Schema enum should be a list')
+  if 'required' in schema and not (isinstance(schema['required'], list) and all(isinstance(key, str) for key in schema['required'])):
+    raise ValueError('Schema required should be a list of str')
+  for key in ['minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum']:
+    if key in schema and not SCHEMA_TYPES['number'](schema[key]):
+      raise ValueError(f'Schema {key} should be a number')
+  for key in ['minLength', 'maxLength', 'minItems', 'maxItems']:
+    if key in schema and (not isinstance(schema[key], int) or isinstance(schema[key], bool) or schema[key] < 0):
+      raise ValueError(f'Schema {key} should be a non-negative int')
+  if 'pattern' in schema and not isinstance(schema['pattern'], str):
+    raise ValueError('Schema pattern should be a str')
+  checks = []
+
+  if 'type' in schema:
+    types = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+    for name in types:
+      if name not in SCHEMA_TYPES:
+        raise ValueError(f'Unsupported schema type: {name}')
+    testers = tuple(SCHEMA_TYPES[name] for name in types)
+    message = 'should be ' + ' or '.join('null' if name == 'null' else f'an {name}' if name[0] in 'aeiou' else f'a {name}' for name in types)
+    def check_type(value, path, errors):
+      for tester in testers:
+        if tester(value):
+          return True
+      errors.append((path, message))
+      return False
+    checks.append(check_type)
+
+  if 'enum' in schema:
+    options = list(schema['enum'])
+    message = 'should be one of ' + ', '.join(json.dumps(option) for option in options)
+    def check_enum(value, path, errors):
+      if value not in options:
+        errors.append((path, message))
+      return True
+    checks.append(check_enum)
+
+  if 'const' in schema:
+    constant = schema['const']
+    message = 'should be ' + json.dumps(constant)
+    def check_const(value, path, errors):
+      if value != constant:
+        errors.append((path, message))
+      return True
+    checks.append(check_const)
+
+  bounds = [(key, schema[key]) for key in ['minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum'] if key in schema]
+  if bounds:
+    comparisons = {
+      'minimum': (lambda value, bound: value >= bound, 'should be at least {}'),
+      'maximum': (lambda value, bound: value <= bound, 'should be at most {}'),
+      'exclusiveMinimum': (lambda value, bound: value > bound, 'should be greater than {}'),
+      'exclusiveMaximum': (lambda value, bound: value < bound, 'should be less than {}')
+    }
+    rules = tuple((comparisons[key][0], bound, comparisons[key][1].format(bound)) for key, bound in bounds)
+    def check_bounds(value, path, errors):
+      if SCHEMA_TYPES['number'](value):
+        for compare, bound, message in rules:
+          if not compare(value, bound):
+            errors.append((path, message))
+      return True
+    checks.append(check_bounds)
+
+  if 'minLength' in schema or 'maxLength' in schema or 'pattern' in schema:
+    min_length = schema.get('minLength')
+    max_length = schema.get('maxLength')
+    try:
+      pattern = re.compile(schema['pattern']) if 'pattern' in schema else None
+    except re.error as error:
+      raise ValueError(f'Schema pattern is not a valid regular expression: {error}')
+    def check_string(value, path, errors):
+      if isinstance(value, str):
+        if min_length is not None and len(value) < min_length:
+          errors.append((path, f'should be at least {min_length} characters long'))
+        if max_length is not None and len(value) > max_length:
+          errors.append((path, f'should be at most {max_length} characters long'))
+        if pattern is not None and not pattern.search(value):
+          errors.append((path, f'should match the pattern {pattern.pattern}'))
+      return True
+    checks.append(check_string)
+
+  if 'properties' in schema or 'required' in schema or 'additionalProperties' in schema:
+    properties = tuple((key, compile_schema(subschema)) for key, subschema in schema.get('properties', {}).items())
+    known = frozenset(schema.get('properties', {}))
+    required = tuple(schema.get('required', ()))
+    additional = schema.get('additionalProperties', True)
+    additional_validator = compile_schema(additional) if isinstance(additional, dict) else None
+    def check_object(value, path, errors):
+      if isinstance(value, dict):
+        for key in required:
+          if key not in value:
+            errors.append((f'{path}.{key}', 'is required'))
+        for key, validate in properties:
+          if key in value:
+            validate.check(value[key], f'{path}.{key}', errors)
+        if additional is not True:
+          for key in value:
+            if key not in known:
+              if additional_validator is not None:
+                additional_validator.check(value[key], f'{path}.{key}', errors)
+              else:
+                errors.append((f'{path}.{key}', 'is not allowed'))
+      return True
+    checks.append(check_object)
+
+  if 'items' in schema or 'minItems' in schema or 'maxItems' in schema:
+    items = compile_schema(schema['items']) if 'items' in schema else None
+    min_items = schema.get('minItems')
+    max_items = schema.get('maxItems')
+    def check_array(value, path, errors):
+      if isinstance(value, list):
+        if min_items is not None and len(value) < min_items:
+          errors.append((path, f'should have at least {min_items} items'))
+        if max_items is not None and len(value) > max_items:
+          errors.append((path, f'should have at most {max_items} items'))
+        if items is not None:
+          for i, item in enumerate(value):
+            items.check(item, f'{path}[{i}]', errors)
+      return True
+    checks.append(check_array)
+
+  return SchemaValidator(tuple(checks))
+
+
+
+class SchemaValidator:
+  __slots__ = ('checks',)
+
+  def __init__(self, checks):
+    self.checks = checks
+
+  def check(self, value, path, errors):
+    for check in self.checks:
+      if not check(value, path, errors):
+        return
+
+  def __call__(self, value):
+    errors = []
+    self.check(value, '$', errors)
+    return errors
+
+
+
+class Selection:
+  __slots__ = ('leaves', 'branches', '_leaf_set', '_children')
+
+  def __init__(self, leaves, branches):
+    self.leaves = leaves
+    self.branches = branches
+    self._leaf_set = frozenset(leaves)
+    self._children = dict(branches)
+
+  def __contains__(self, key):
+    return key in self._leaf_set or key in self._children
+
+  def __repr__(self):
+    return f'Selection({self.to_selector()!r})'
+
+  def keys(self):
+    return list(self.leaves) + [key for key, _ in self.branches]
+
+  def child(self, key):
+    if key in self._leaf_set:
+      return FULL_SELECTION
+    return self._children.get(key)
+
+  def includes(self, path):
+    selection = self
+    for key in path.split('.'):
+      selection = selection.child(key)
+      if selection is None:
+        return False
+    return True
+
+  def to_selector(self):
+    return list(self.leaves) + [[key, child.to_selector()] for key, child in self.branches]
+
+  def project(self, obj):
+    root = {}
+    if not isinstance(obj, dict):
+      return root
+    stack = [(obj, self, root)]
+    containers = []
+    while stack:
+      source, selection, target = stack.pop()
+      for key in selection.leaves:
+        if key in source:
+          target[key] = source[key]
+      for key, child in selection.branches:
+        value = source.get(key)
+        leaves = child.leaves
+        if isinstance(value, dict):
+          if child.branches:
+            nested = target[key] = {}
+            containers.append((target, key, nested))
+            stack.append((value, child, nested))
+          else:
+            nested = {}
+            for leaf in leaves:
+              if leaf in value:
+                nested[leaf] = value[leaf]
+            if nested:
+              target[key] = nested
+        elif isinstance(value, list):
+          if child.branches:
+            items = target[key] = []
+            containers.append((target, key, items))
+            for item in value:
+              if isinstance(item, dict):
+                nested = {}
+                items.append(nested)
+                stack.append((item, child, nested))
+          else:
+            items = []
+            for item in value:
+              if isinstance(item, dict):
+                nested = {}
+                for leaf in leaves:
+                  if leaf in item:
+                    nested[leaf] = item[leaf]
+                if nested:
+                  items.append(nested)
+            if items:
+              target[key] = items
+    for parent, key, container in reversed(containers):
+      if isinstance(container, list):
+        container[:] = [item for item in container if item]
+      if not container:
+        del parent[key]
+    return root
+
+
+
+class FullSelection(Selection):
+  __slots__ = ()
+
+  def __init__(self):
+    super().__init__((), ())
+
+  def __contains__(self, key):
+    return True
+
+  def __repr__(self):
+    return 'FullSelection()'
+
+  def keys(self):
+    return None
+
+  def child(self, key):
+    return self
+
+  def includes(self, path):
+    return True
+
+  def project(self, obj):
+    return obj
+
+  def to_selector(self):
+    return None
+
+
+
+FULL_SELECTION = FullSelection()
+
+
+
+def build_selection(selector):
+  fields = {}
+  for key in selector:
+    if isinstance(key, str):
+      fields[key] = None
+    elif isinstance(key, list) and key and isinstance(key[0], str):
+      fields[key[0]] = build_selection(key[1]) if len(key) > 1 and isinstance(key[1], list) else None
+  return Selection(
+    tuple(key for key, child in fields.items() if child is None),
+    tuple((key, child) for key, child in fields.items() if child is not None)
+  )
+
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_canonical_selector(canonical):
+  return build_selection(json.loads(canonical))
+
+
+
+def compile_selector(selector):
+  if not isinstance(selector, list):
+    return None
+  return compile_canonical_selector(canonical_json(selector))
+
+
+
 def filter_object(obj, arr):
-  if isinstance(arr, list):
-    filtered_obj = {}
-    for i in range(len(arr)):
-      key = arr[i]
-      if isinstance(key, str):
-        if key in obj:
-          filtered_obj[key] = obj[key]
-      elif isinstance(key, list):
-        nested_obj = obj[key[0]]
-        nested_arr = key[1]
-        if isinstance(nested_obj, list):
-          filtered_arr = []
-          for j in range(len(nested_obj)):
-            filtered_nested_obj = filter_object(nested_obj[j], nested_arr)
-            if len(filtered_nested_obj) > 0:
-              filtered_arr.append(filtered_nested_obj)
-          if len(filtered_arr) > 0:
-            filtered_obj[key[0]] = filtered_arr
-        elif isinstance(nested_obj, dict):
-          filtered_nested_obj = filter_object(nested_obj, nested_arr)
-          if len(filtered_nested_obj) > 0:
-            filtered_obj[key[0]] = filtered_nested_obj
-    return filtered_obj
-  return obj
+  selection = compile_selector(arr)
+  if selection is None:
+    return obj
+  return selection.project(obj)
@@ -1,6 +1,7 @@
+import json
 import random
-from django.http.response import JsonResponse
-from blest import Router
+from django.http.response import HttpResponse, JsonResponse, StreamingHttpResponse
+from blest import Router, render_prometheus
 
 router = Router()
 
@@ -26,18 +27,25 @@ async def fail(body, context):
 async def index(request):
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
             headers = {}
             for key, value in request.META.items():
               if key.startswith('HTTP_'):
                 header_key = key[5:].replace('_', '-').title()
                 headers[header_key] = value
-            result, error = await router.handle(data, { 'httpHeaders': headers })
-            if error:
-                return JsonResponse(error, status=500)
-            else:
-                return JsonResponse(result, status=200, safe=False)
+            if 'application/x-ndjson' in request.headers.get('Accept', ''):
+                results, error = await router.handle_stream(json.loads(request.body), { 'httpHeaders': headers })
+                if error:
+                    return JsonResponse(error, status=error['status'])
+                async def ndjson():
+                    async for result in results:
+                        yield json.dumps(result) + '\n'
+                return StreamingHttpResponse(ndjson(), content_type='application/x-ndjson')
+            status, response_headers, body = await router.handle_http(request.body, request.headers, { 'httpHeaders': headers })
+            return HttpResponse(body, status=status, headers=response_headers)
         except json.JSONDecodeError:
             return JsonResponse({'message': 'Request body should be valid JSON'}, status=400)
     else:
-        return JsonResponse({'message': 'Request should use the POST method'}, status=405)
\ No newline at end of file
+        return JsonResponse({'message': 'Request should use the POST method'}, status=405)
+
+async def metrics(request):
+    return HttpResponse(render_prometheus(router.metrics()), content_type='text/plain; version=0.0.4')
@@ -1,10 +1,12 @@
+import json
 import random
 from fastapi import FastAPI, HTTPException, Request
-from blest import Router
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from blest import Router, render_prometheus
 
 app = FastAPI()
 
-router = Router()
+router = Router({ 'codec': 'auto' })
 
 @router.route('hello')
 async def hello(body, context):
@@ -27,10 +29,18 @@ async def fail(body, context):
 
 @app.post('/')
 async def index(request: Request):
-  data = await request.json()
   headers = dict(request.headers)
-  result, error = await router.handle(data, { 'httpHeaders': headers })
-  if error:
-    raise HTTPException(status_code=500, detail=error['message'])
-  else:
-    return result
\ No newline at end of file
+  if 'application/x-ndjson' in headers.get('accept', ''):
+    results, error = await router.handle_stream(await request.json(), { 'httpHeaders': headers })
+    if error:
+      raise HTTPException(status_code=error['status'], detail=error['message'])
+    async def ndjson():
+      async for result in results:
+        yield json.dumps(result) + '\n'
+    return StreamingResponse(ndjson(), media_type='application/x-ndjson')
+  status, response_headers, body = await router.handle_http(await request.body(), headers, { 'httpHeaders': headers })
+  return Response(body, status_code=status, headers=response_headers)
+
+@app.get('/metrics')
+async def metrics():
+  return PlainTextResponse(render_prometheus(router.metrics()), media_type='text/plain; version=0.0.4')
@@ -1,5 +1,6 @@
-from flask import Flask, make_response, request
-from blest import Router
+import json
+from flask import Flask, Response, make_response, request
+from blest import Router, render_prometheus
 
 app = Flask(__name__)
 
@@ -27,11 +28,17 @@ async def fail(body, context):
 @app.post('/')
 async def index():
   headers = dict(request.headers)
-  result, error = await router.handle(request.json, { 'httpHeaders': headers })
-  if error:
-    resp = make_response(error, 500)
-    resp.headers['Content-Type'] = 'application/json'
-  else:
-    resp = make_response(result, 200)
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
\ No newline at end of file
+  if 'application/x-ndjson' in request.headers.get('Accept', ''):
+    results, error = await router.handle_stream(request.json, { 'httpHeaders': headers })
+    if error:
+      return make_response(error, error['status'])
+    # Flask's event loop ends with the view, so the lines are sent once every
+    # item has finished; use an ASGI framework to send each one as it completes
+    lines = [json.dumps(result) + '\n' async for result in results]
+    return Response(lines, mimetype='application/x-ndjson')
+  status, response_headers, body = await router.handle_http(request.get_data(), request.headers, { 'httpHeaders': headers })
+  return Response(body, status=status, headers=response_headers)
+
+@app.get('/metrics')
+def metrics():
+  return Response(render_prometheus(router.metrics()), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,61 @@
+import unittest
+import test_router
+from blest import MsgpackCodec, JsonCodec, pack, unpack
+
+RUN_ROUTES_TESTS = [
+    'test_valid_requests',
+    'test_matching_ids',
+    'test_matching_routes',
+    'test_accept_parameters',
+    'test_respect_context',
+    'test_support_middleware',
+    'test_handle_errors',
+    'test_timeout_setting',
+    'test_reject_malformed_requests',
+    'test_trailing_middleware'
+]
+
+class EncodedRouterTests(test_router.TestRouter):
+    codec = JsonCodec()
+    accept = None
+
+    async def handle(self, request, context=None):
+        result, error = await self.router.handle_bytes(self.codec.encode(request), context, self.codec.content_type, self.accept)
+        if result is not None:
+            _, response_codec = self.router.negotiate(self.codec.content_type, self.accept)
+            result = response_codec.decode(result)
+        return result, error
+
+for name in dir(test_router.TestRouter):
+    if name.startswith('test_') and name not in RUN_ROUTES_TESTS:
+        setattr(EncodedRouterTests, name, None)
+
+class TestJsonBytes(EncodedRouterTests):
+    codec = JsonCodec()
+
+class TestMsgpack(EncodedRouterTests):
+    codec = MsgpackCodec()
+
+class TestPureMsgpack(EncodedRouterTests):
+    codec = MsgpackCodec(pure=True)
+
+class TestMsgpackToJson(EncodedRouterTests):
+    codec = MsgpackCodec(pure=True)
+    accept = 'application/json'
+
+class TestPureMsgpackFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [None, True, False, 0, 127, 128, 65536, 2 ** 40, -1, -33, -129, -2 ** 40, 1.5, '', 'é' * 40, b'\x00' * 300, list(range(20)), {str(i): [i] for i in range(20)}]
+        for value in values:
+            self.assertEqual(unpack(pack(value)), value)
+
+    def test_invalid_data(self):
+        for data in [b'', b'\x92\x01', b'\x01\x02', b'\xc1']:
+            with self.assertRaises(ValueError):
+                unpack(data)
+
+del EncodedRouterTests
+
+if __name__ == '__main__':
+    unittest.main()
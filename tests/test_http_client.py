@@ -0,0 +1,447 @@
+import unittest
+import asyncio
+import json
+import time
+from aiohttp import web
+from blest import Router, HttpClient, BlestError, AdaptiveBatching, compress, compress_response, choose_encoding, Decompressor, render_prometheus, bounded_encodings, decompress
+
+class TestHttpClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.router = Router({'compression_threshold': 200})
+        self.connections = set()
+        self.request_encodings = []
+        self.response_encodings = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+        @self.router.route('greet')
+        async def greet(body, context):
+            return {'greeting': 'Hi, ' + body['name'] + '!'}
+
+        @self.router.route('slow')
+        async def slow(body, context):
+            await asyncio.sleep(0.05)
+            return {'slow': True}
+
+        @self.router.route('fail')
+        async def fail(body, context):
+            raise Exception('Intentional failure')
+
+        async def index(request):
+            self.connections.add(request.transport)
+            if 'application/x-ndjson' in request.headers.get('Accept', ''):
+                return await stream(request)
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+            self.request_encodings.append(request.headers.get('Content-Encoding'))
+            try:
+                status, headers, body = await self.router.handle_http(await request.read(), request.headers, {'httpHeaders': dict(request.headers)})
+            finally:
+                self.concurrent -= 1
+            self.response_encodings.append(headers.get('Content-Encoding'))
+            return web.Response(status=status, headers=headers, body=body)
+
+        async def stream(request):
+            results, error = await self.router.handle_stream(await request.json())
+            if error:
+                return web.json_response(error, status=error['status'])
+            response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await response.prepare(request)
+            async for result in results:
+                await response.write((json.dumps(result) + '\n').encode())
+            await response.write_eof()
+            return response
+
+        app = web.Application(handler_args={'auto_decompress': False})
+        app.router.add_post('/', index)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/'
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_request(self):
+        async with HttpClient(self.url) as client:
+            result = await client.request('greet', {'name': 'Steve'})
+            self.assertEqual(result, {'greeting': 'Hi, Steve!'})
+            with self.assertRaises(Exception):
+                await client.request('fail')
+
+    async def test_codec(self):
+        async with HttpClient(self.url, codec='auto') as client:
+            result = await client.request('greet', {'name': 'Steve'})
+            self.assertEqual(result, {'greeting': 'Hi, Steve!'})
+
+    async def test_msgpack(self):
+        async with HttpClient(self.url, codec='msgpack') as client:
+            result = await client.request('greet', {'name': 'Steve'})
+            self.assertEqual(result, {'greeting': 'Hi, Steve!'})
+            with self.assertRaises(Exception):
+                await client.request('fail')
+
+    async def test_compression(self):
+        async with HttpClient(self.url, compress_requests=500) as client:
+            await client.request('greet', {'name': 'Steve'})
+            results = await asyncio.gather(*[client.request('greet', {'name': 'Steve' * 10}) for _ in range(10)])
+            self.assertEqual(results[0], {'greeting': 'Hi, ' + 'Steve' * 10 + '!'})
+            self.assertEqual(self.request_encodings, [None, 'gzip'])
+            self.assertEqual(self.response_encodings, [None, bounded_encodings()[0]])
+
+        async with HttpClient(self.url, stream=True) as client:
+            results = await asyncio.gather(*[client.request('greet', {'name': str(i)}) for i in range(10)])
+            self.assertEqual(len(results), 10)
+
+        async with HttpClient(self.url, compression=False) as client:
+            await asyncio.gather(*[client.request('greet', {'name': 'Steve' * 10}) for _ in range(10)])
+            self.assertIsNone(self.response_encodings[-1])
+
+    def test_compression_helpers(self):
+        payload = b'{"greeting":"hello"}' * 100
+        self.assertEqual(compress_response(payload[:100], 'gzip', threshold=1024), (payload[:100], None))
+        self.assertEqual(compress_response(payload, 'identity', threshold=1024), (payload, None))
+        compressed, encoding = compress_response(payload, 'br;q=0, gzip;q=0.5, deflate', threshold=1024, encodings=['br', 'gzip', 'deflate'])
+        self.assertEqual(encoding, 'gzip')
+        self.assertIsNone(choose_encoding('gzip;q=0', ['gzip']))
+        decompressor = Decompressor('gzip')
+        decompressed = b''.join(decompressor.decompress(compressed[i:i + 10]) for i in range(0, len(compressed), 10))
+        self.assertEqual(decompressed, payload)
+        self.assertEqual(Decompressor('deflate').decompress(compress(payload, 'deflate')), payload)
+
+    async def test_decompression_limits(self):
+        bomb = compress(b'[' + b' ' * 10000000 + b']', 'gzip')
+        router = Router({'max_request_bytes': 1000000})
+        status, headers, body = await router.handle_http(bomb, {'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 413)
+        status, headers, body = await router.handle_http(b'[' + b' ' * 1000000 + b']', {})
+        self.assertEqual(status, 413)
+        status, headers, body = await router.handle_http(compress(b'[["a1", "missing", {}]]', 'gzip'), {'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        with self.assertRaises(ValueError):
+            Router({'max_request_bytes': 0})
+
+        decompressor = Decompressor('gzip', 1000)
+        with self.assertRaises(BlestError) as context:
+            for i in range(0, len(bomb), 100):
+                decompressor.decompress(bomb[i:i + 100])
+        self.assertEqual(context.exception.status, 413)
+        self.assertLessEqual(decompressor.total, 1001)
+
+        payload = b' ' * 10000000
+        for encoding in bounded_encodings():
+            compressed = compress(payload, encoding)
+            self.assertEqual(decompress(compress(b'[]', encoding), encoding, 1000), b'[]')
+            with self.assertRaises(BlestError):
+                decompress(compressed, encoding, 1000)
+            status, headers, body = await router.handle_http(compressed, {'Content-Encoding': encoding})
+            self.assertEqual(status, 413)
+        for encoding in bounded_encodings(incremental=True):
+            decompressor = Decompressor(encoding, 100000)
+            with self.assertRaises(BlestError):
+                decompressor.decompress(compress(payload, encoding))
+            self.assertLess(decompressor.total, 1000000)
+        self.assertNotIn('zstd', bounded_encodings(incremental=True))
+
+        async with HttpClient(self.url, max_response_bytes=100) as client:
+            with self.assertRaisesRegex(Exception, 'exceeds 100 bytes'):
+                await client.request('greet', {'name': 'Steve' * 100})
+            self.assertEqual(await client.request('greet', {'name': 'Steve'}), {'greeting': 'Hi, Steve!'})
+
+    async def test_batching(self):
+        async with HttpClient(self.url) as client:
+            results = await asyncio.gather(*[client.request('greet', {'name': str(i)}) for i in range(30)])
+            self.assertEqual([r['greeting'] for r in results], ['Hi, ' + str(i) + '!' for i in range(30)])
+
+    async def test_persistent_session(self):
+        client = HttpClient(self.url, pool_size=10, keepalive_timeout=30)
+        await client.request('greet', {'name': 'A'})
+        session = client.session
+        await client.request('greet', {'name': 'B'})
+        self.assertIs(client.session, session)
+        self.assertEqual(len(self.connections), 1)
+        await client.close()
+        self.assertTrue(session.closed)
+
+    async def test_max_in_flight(self):
+        async with HttpClient(self.url, max_batch_size=2, batch_delay=1, max_in_flight=2) as client:
+            results = await asyncio.gather(*[client.request('slow') for _ in range(12)])
+            self.assertEqual(len(results), 12)
+            self.assertLessEqual(self.max_concurrent, 2)
+            self.assertEqual(client.in_flight, 0)
+            self.assertEqual(client.queue_depth, 0)
+
+    async def test_queue_policies(self):
+        async with HttpClient(self.url, max_queue_size=2, queue_policy='reject') as client:
+            tasks = [asyncio.ensure_future(client.request('greet', {'name': str(i)})) for i in range(2)]
+            await asyncio.sleep(0)
+            self.assertEqual(client.queue_depth, 2)
+            with self.assertRaises(BlestError):
+                await client.request('greet', {'name': 'Overflow'})
+            await asyncio.gather(*tasks)
+
+        async with HttpClient(self.url, max_queue_size=2, queue_policy='drop_oldest') as client:
+            tasks = [asyncio.ensure_future(client.request('greet', {'name': str(i)})) for i in range(3)]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertIsInstance(results[0], Exception)
+            self.assertEqual(results[2], {'greeting': 'Hi, 2!'})
+
+        async with HttpClient(self.url, max_batch_size=1, batch_delay=1, max_queue_size=1) as client:
+            results = await asyncio.gather(*[client.request('greet', {'name': str(i)}) for i in range(5)])
+            self.assertEqual(len(results), 5)
+
+        with self.assertRaises(ValueError):
+            HttpClient(self.url, queue_policy='unknown')
+
+    async def test_adaptive_batching(self):
+        async with HttpClient(self.url, max_batch_size=5, batch_delay=1000, adaptive=True) as client:
+            self.assertEqual(client.batch_delay, 0)
+            start = asyncio.get_running_loop().time()
+            results = await asyncio.gather(*[client.request('greet', {'name': str(i)}) for i in range(10)])
+            self.assertEqual(len(results), 10)
+            self.assertLess(asyncio.get_running_loop().time() - start, 0.5)
+
+    def test_adaptive_window(self):
+        batching = AdaptiveBatching(10, 20, min_batch_delay=1, batch_size_ceiling=40)
+        self.assertEqual(batching.delay, 1)
+        for i in range(20):
+            batching.arrival(i * 0.001)
+        self.assertAlmostEqual(batching.delay, 9, delta=1)
+        for _ in range(5):
+            batching.completed(0.01)
+        self.assertEqual(batching.batch_size, 10)
+        for _ in range(5):
+            batching.completed(0.05)
+        self.assertEqual(batching.batch_size, 40)
+        for i in range(20):
+            batching.arrival(1 + i)
+        self.assertEqual(batching.delay, 1)
+
+    async def test_stream(self):
+        async with HttpClient(self.url, stream=True) as client:
+            slow = asyncio.ensure_future(client.request('slow'))
+            result = await client.request('greet', {'name': 'Steve'})
+            self.assertEqual(result, {'greeting': 'Hi, Steve!'})
+            self.assertFalse(slow.done())
+            self.assertEqual(await slow, {'slow': True})
+            with self.assertRaises(Exception):
+                await client.request('fail')
+
+    async def test_metrics(self):
+        async with HttpClient(self.url, batch_delay=5) as client:
+            await asyncio.gather(*[client.request('greet', {'name': str(i)}) for i in range(30)])
+            await client.request('greet', {'name': 'Steve'})
+            metrics = client.metrics()
+            self.assertEqual(metrics['requests_total'], 31)
+            self.assertEqual(metrics['queue_length'], 0)
+            self.assertEqual(metrics['flush_items']['count'], 3)
+            self.assertEqual(metrics['flush_items']['sum'], 31)
+            self.assertEqual(metrics['flush_interval_ms']['count'], 2)
+            self.assertGreater(metrics['bytes_sent_total'], 0)
+            self.assertGreater(metrics['bytes_received_total'], 0)
+            self.assertEqual(metrics['batch_errors_total'], 0)
+            text = render_prometheus(metrics, 'blest_client')
+            self.assertIn('blest_client_requests_total 31', text)
+            self.assertIn('blest_client_flush_items_bucket{le="5"} 2', text)
+
+        router_metrics = self.router.metrics()
+        self.assertEqual(router_metrics['routes']['greet']['calls_total'], 31)
+
+    async def test_network_error(self):
+        await self.runner.cleanup()
+        async with HttpClient(self.url) as client:
+            with self.assertRaises(Exception):
+                await client.request('greet', {'name': 'Steve'})
+
+class TestHttpClientEndpoints(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.servers = []
+        for name in ['a', 'b', 'c']:
+            await self.start_server(name)
+
+    async def start_server(self, name):
+        router = Router()
+        server = {'name': name, 'batches': 0, 'status': 200, 'delay': 0}
+
+        @router.route('whoami')
+        async def whoami(body, context):
+            return {'server': name}
+
+        @router.route('write')
+        async def write(body, context):
+            return {'server': name}
+
+        async def index(request):
+            server['batches'] += 1
+            if server['delay']:
+                await asyncio.sleep(server['delay'])
+            if server['status'] != 200:
+                return web.json_response({'message': 'Unavailable'}, status=server['status'])
+            status, headers, body = await router.handle_http(await request.read(), request.headers)
+            return web.Response(status=status, headers=headers, body=body)
+
+        app = web.Application(handler_args={'auto_decompress': False})
+        app.router.add_post('/', index)
+        server['runner'] = web.AppRunner(app)
+        await server['runner'].setup()
+        site = web.TCPSite(server['runner'], '127.0.0.1', 0)
+        await site.start()
+        server['url'] = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+        self.servers.append(server)
+
+    async def asyncTearDown(self):
+        for server in self.servers:
+            await server['runner'].cleanup()
+
+    @property
+    def urls(self):
+        return [server['url'] for server in self.servers]
+
+    async def test_round_robin(self):
+        async with HttpClient(self.urls, batch_delay=1) as client:
+            results = [await client.request('whoami') for _ in range(6)]
+            self.assertEqual([result['server'] for result in results], ['a', 'b', 'c', 'a', 'b', 'c'])
+
+    async def test_least_outstanding(self):
+        self.servers[0]['delay'] = 0.2
+        async with HttpClient(self.urls[:2], batch_delay=1, policy='least_outstanding') as client:
+            slow = asyncio.ensure_future(client.request('whoami'))
+            await asyncio.sleep(0.05)
+            results = [await client.request('whoami') for _ in range(3)]
+            self.assertEqual([result['server'] for result in results], ['b', 'b', 'b'])
+            self.assertEqual((await slow)['server'], 'a')
+
+    async def test_latency_ewma(self):
+        self.servers[0]['delay'] = 0.05
+        async with HttpClient(self.urls[:2], batch_delay=1, policy='latency_ewma') as client:
+            await client.request('whoami')
+            await client.request('whoami')
+            results = [await client.request('whoami') for _ in range(5)]
+            self.assertEqual([result['server'] for result in results], ['b'] * 5)
+            stats = client.endpoint_stats()
+            self.assertGreater(stats[0]['latency_ewma_ms'], stats[1]['latency_ewma_ms'])
+
+    async def test_circuit_breaker(self):
+        self.servers[0]['status'] = 500
+        async with HttpClient(self.urls[:2], batch_delay=1, failure_threshold=2, recovery_timeout=100) as client:
+            for _ in range(4):
+                try:
+                    await client.request('write')
+                except Exception:
+                    pass
+            self.assertEqual(client.endpoint_stats()[0]['state'], 'open')
+            self.assertEqual(self.servers[0]['batches'], 2)
+            results = [await client.request('write') for _ in range(3)]
+            self.assertEqual([result['server'] for result in results], ['b'] * 3)
+            self.assertEqual(self.servers[0]['batches'], 2)
+            self.assertEqual(client.metrics()['open_circuits'], 1)
+
+            self.servers[0]['status'] = 200
+            await asyncio.sleep(0.15)
+            results = [await client.request('write') for _ in range(4)]
+            self.assertIn('a', [result['server'] for result in results])
+            self.assertEqual(client.endpoint_stats()[0]['state'], 'closed')
+
+    async def test_timeout_opens_circuit(self):
+        self.servers[0]['delay'] = 1
+        async with HttpClient(self.urls[:2], batch_delay=1, failure_threshold=2, timeout=100) as client:
+            started = time.monotonic()
+            results = []
+            for _ in range(4):
+                try:
+                    results.append((await client.request('write'))['server'])
+                except Exception:
+                    results.append(None)
+            self.assertEqual(results, [None, 'b', None, 'b'])
+            self.assertLess(time.monotonic() - started, 0.8)
+            self.assertEqual(client.endpoint_stats()[0]['state'], 'open')
+            self.assertEqual((await client.request('write'))['server'], 'b')
+
+    async def test_failover(self):
+        await self.servers[0]['runner'].cleanup()
+        async with HttpClient(self.urls, batch_delay=1) as client:
+            results = [await client.request('write') for _ in range(3)]
+            self.assertNotIn('a', [result['server'] for result in results])
+            self.assertGreaterEqual(client.metrics()['failovers_total'], 1)
+
+        self.servers[1]['status'] = 503
+        async with HttpClient(self.urls[1:], batch_delay=1, idempotent_routes=['whoami']) as client:
+            results = [await client.request('whoami') for _ in range(2)]
+            self.assertEqual([result['server'] for result in results], ['c', 'c'])
+            with self.assertRaises(Exception):
+                for _ in range(2):
+                    await client.request('write')
+
+        async with HttpClient(self.urls[1], batch_delay=1, failure_threshold=1) as client:
+            with self.assertRaises(Exception):
+                await client.request('write')
+            with self.assertRaisesRegex(Exception, 'No endpoints are available'):
+                await client.request('write')
+
+    async def test_hedging(self):
+        self.servers[0]['delay'] = 0.5
+        async with HttpClient(self.urls[:2], batch_delay=1, idempotent_routes=['whoami'], hedge_percentile=95, hedge_delay=20) as client:
+            started = time.monotonic()
+            result = await client.request('whoami')
+            self.assertEqual(result['server'], 'b')
+            self.assertLess(time.monotonic() - started, 0.4)
+            self.assertEqual(client.metrics()['hedges_total'], 1)
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.endpoint_stats()[0]['outstanding'], 0)
+
+            started = time.monotonic()
+            results = [await client.request('write') for _ in range(2)]
+            self.assertEqual(sorted(result['server'] for result in results), ['a', 'b'])
+            self.assertGreaterEqual(time.monotonic() - started, 0.5)
+            self.assertEqual(client.metrics()['hedges_total'], 1)
+
+    async def test_hedge_cancelled(self):
+        self.servers[0]['delay'] = 0.5
+        async with HttpClient(self.urls[:2], batch_delay=1, idempotent_routes=['whoami'], hedge_percentile=95, hedge_delay=200) as client:
+            request = asyncio.ensure_future(client.request('whoami'))
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.endpoint_stats()[0]['outstanding'], 1)
+            for task in asyncio.all_tasks():
+                if task.get_coro().__qualname__ == 'HttpClient._process':
+                    task.cancel()
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.endpoint_stats()[0]['outstanding'], 0)
+            self.assertFalse([task for task in asyncio.all_tasks() if task.get_coro().__qualname__ == 'HttpClient._attempt'])
+            request.cancel()
+
+    async def test_no_retry_on_client_error(self):
+        self.servers[0]['status'] = 400
+        async with HttpClient(self.urls[:2], batch_delay=1, idempotent_routes=['whoami']) as client:
+            with self.assertRaises(Exception):
+                await client.request('whoami')
+            self.assertEqual(self.servers[1]['batches'], 0)
+            self.assertEqual(client.metrics()['failovers_total'], 0)
+
+        self.servers[0]['delay'] = 0.5
+        self.servers[1]['status'] = 400
+        async with HttpClient(self.urls[:2], batch_delay=1, idempotent_routes=['whoami'], hedge_percentile=95, hedge_delay=20) as client:
+            started = time.monotonic()
+            with self.assertRaises(Exception):
+                await client.request('whoami')
+            self.assertLess(time.monotonic() - started, 0.4)
+            self.assertEqual(client.metrics()['hedges_total'], 1)
+            self.assertEqual(client.metrics()['failovers_total'], 0)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            HttpClient([])
+        with self.assertRaises(ValueError):
+            HttpClient(self.urls, policy='random')
+        with self.assertRaises(ValueError):
+            HttpClient(self.urls, hedge_percentile=100)
+        with self.assertRaises(ValueError):
+            HttpClient(self.urls, failure_threshold=0)
+        with self.assertRaises(ValueError):
+            HttpClient(self.urls, timeout=0)
+
+if __name__ == '__main__':
+    unittest.main()
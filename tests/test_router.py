@@ -1,9 +1,16 @@
 import unittest
+import gc
+import warnings
+import json
 import time
 import uuid
 import random
 import asyncio
-from blest import Router, BlestError
+import logging
+from blest import ErrorReporter, Router, BlestError, RouteStep, RequestContext, filter_object, compile_selector, render_prometheus, ConcurrencyLimiter
+
+def render_report(body, context):
+    return {'total': sum(body['values']), 'user': context['user']}
 
 class TestRouter(unittest.IsolatedAsyncioTestCase):
 
@@ -51,34 +58,37 @@ class TestRouter(unittest.IsolatedAsyncioTestCase):
 
         cls.router.namespace('subRoutes', router3)
 
+    async def handle(self, request, context=None):
+        return await self.router.handle(request, context)
+
     async def run_routes(self):
         # Basic route
         self.testId1 = str(uuid.uuid4())
         self.testValue1 = random.random()
-        self.result1, self.error1 = await self.router.handle([[self.testId1, 'basicRoute', {'testValue': self.testValue1}]], {'testValue': self.testValue1})
+        self.result1, self.error1 = await self.handle([[self.testId1, 'basicRoute', {'testValue': self.testValue1}]], {'testValue': self.testValue1})
 
         # Merged route
         self.testId2 = str(uuid.uuid4())
         self.testValue2 = random.random()
-        self.result2, self.error2 = await self.router.handle([[self.testId2, 'mergedRoute', {'testValue': self.testValue2}]], {'testValue': self.testValue2})
+        self.result2, self.error2 = await self.handle([[self.testId2, 'mergedRoute', {'testValue': self.testValue2}]], {'testValue': self.testValue2})
 
         # Error route
         self.testId3 = str(uuid.uuid4())
         self.testValue3 = random.random()
-        self.result3, self.error3 = await self.router.handle([[self.testId3, 'subRoutes/errorRoute', {'testValue': self.testValue3}]], {'testValue': self.testValue3})
+        self.result3, self.error3 = await self.handle([[self.testId3, 'subRoutes/errorRoute', {'testValue': self.testValue3}]], {'testValue': self.testValue3})
 
         # Missing route
         self.testId4 = str(uuid.uuid4())
         self.testValue4 = random.random()
-        self.result4, self.error4 = await self.router.handle([[self.testId4, 'missingRoute', {'testValue': self.testValue4}]], {'testValue': self.testValue4})
+        self.result4, self.error4 = await self.handle([[self.testId4, 'missingRoute', {'testValue': self.testValue4}]], {'testValue': self.testValue4})
 
         # Timeout route
         self.testId5 = str(uuid.uuid4())
         self.testValue5 = random.random()
-        self.result5, self.error5 = await self.router.handle([[self.testId5, 'timeoutRoute', {'testValue': self.testValue5}]], {'testValue': self.testValue5})
+        self.result5, self.error5 = await self.handle([[self.testId5, 'timeoutRoute', {'testValue': self.testValue5}]], {'testValue': self.testValue5})
 
         # Malformed request
-        self.result6, self.error6 = await self.router.handle([[self.testId4], {}, [True, 1.25]])
+        self.result6, self.error6 = await self.handle([[self.testId4], {}, [True, 1.25]])
 
     async def test_class_properties(self):
         self.assertIsInstance(self.router, Router)
@@ -140,6 +150,16 @@ class TestRouter(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(self.result5[0][3].get('message'), 'Internal Server Error')
         self.assertEqual(self.result5[0][3].get('status'), 500)
 
+        router = Router({'timeout': 1000})
+
+        @router.route('upstream')
+        async def upstream(body, context):
+            raise asyncio.TimeoutError('Upstream timed out')
+
+        result, error = await router.handle([['t1', 'upstream']])
+        self.assertEqual(result[0][3], {'message': 'Upstream timed out', 'status': 500})
+        self.assertEqual(router.metrics()['routes']['upstream'], {'calls_total': 1, 'errors_total': 1, 'timeouts_total': 0})
+
     async def test_reject_malformed_requests(self):
         await self.run_routes()
         self.assertIsNotNone(self.error6)
@@ -148,6 +168,766 @@ class TestRouter(unittest.IsolatedAsyncioTestCase):
         await self.run_routes()
         self.assertEqual(len(self.benchmarks), 2)
 
+    async def test_compiled_plans(self):
+        plan = self.router.routes['basicRoute']['plan']
+        self.assertIsInstance(plan, tuple)
+        self.assertEqual(len(plan), 3)
+        self.assertTrue(all(isinstance(step, RouteStep) for step in plan))
+        self.assertFalse(plan[1].is_async)
+        self.assertTrue(self.router.routes['timeoutRoute']['plan'][1].is_async)
+        self.assertEqual(len(self.router.routes['subRoutes/errorRoute']['plan']), 3)
+
+    async def test_context_isolation(self):
+        shared = {'testValue': 1, 'principal': {'claims': ['read']}}
+        result, error = await self.router.handle([
+            [str(uuid.uuid4()), 'basicRoute', {'testValue': 1}],
+            [str(uuid.uuid4()), 'basicRoute', {'testValue': 2}]
+        ], shared)
+        self.assertIsNone(error)
+        self.assertIsInstance(result[0][2]['context'], RequestContext)
+        self.assertEqual(result[0][2]['context']['test']['value'], 1)
+        self.assertEqual(result[1][2]['context']['test']['value'], 2)
+        self.assertEqual(result[0][2]['context']['batch_id'], result[1][2]['context']['batch_id'])
+        self.assertNotIn('test', shared)
+        with self.assertRaises(TypeError):
+            result[0][2]['context']['principal']['claims'].append('write')
+
+    async def test_batch_validation(self):
+        result, error = await self.router.handle([['a1', 'basicRoute', {'testValue': 1}], ['a1', 'basicRoute', {'testValue': 2}]])
+        self.assertIsNone(result)
+        self.assertEqual(error['status'], 400)
+        result, error = await self.router.handle([['a1', 'basicRoute', {'testValue': 1}, {'_s': ['route']}]])
+        self.assertIsNone(error)
+        self.assertEqual(result[0][2], {'route': 'basicRoute'})
+
+    async def test_max_batch_size(self):
+        router = Router({'max_batch_size': 2})
+
+        @router.route('basicRoute')
+        def basic_route(body, context):
+            return {'ok': True}
+
+        result, error = await router.handle([[str(i), 'basicRoute'] for i in range(3)])
+        self.assertIsNone(result)
+        self.assertEqual(error['status'], 413)
+        result, error = await router.handle([[str(i), 'basicRoute'] for i in range(2)])
+        self.assertIsNone(error)
+        self.assertEqual(len(result), 2)
+
+        with self.assertRaises(ValueError):
+            Router({'max_batch_size': 0})
+
+    async def test_stream(self):
+        results, error = await self.router.handle_stream([
+            ['slow', 'timeoutRoute', {'testValue': 1}],
+            ['fast', 'basicRoute', {'testValue': 2}]
+        ])
+        self.assertIsNone(error)
+        ids = [result[0] async for result in results]
+        self.assertEqual(ids, ['fast', 'slow'])
+        results, error = await self.router.handle_stream([['a1'], ['a1']])
+        self.assertIsNone(results)
+        self.assertEqual(error['status'], 400)
+
+    async def test_executors(self):
+        router = Router({'max_workers': 2, 'process_workers': 1})
+
+        @router.before_request()
+        def middleware(body, context):
+            context['user'] = 'steve'
+
+        router.route('report')(render_report)
+        router.describe('report', {'executor': 'process'})
+        self.assertTrue(router.routes['report']['plan'][1].process)
+        self.assertFalse(router.routes['report']['plan'][0].process)
+        try:
+            result, error = await router.handle([['a1', 'report', {'values': [1, 2, 3]}]], {'principal': {'claims': ['read']}})
+            self.assertIsNone(error)
+            self.assertEqual(result[0][2], {'total': 6, 'user': 'steve'})
+            stats = router.executor_stats()
+            self.assertEqual(stats['pools']['thread']['workers'], 2)
+            self.assertEqual(stats['routes']['report']['process']['calls'], 1)
+            self.assertEqual(stats['routes']['report']['thread']['calls'], 1)
+            self.assertGreaterEqual(stats['routes']['report']['process']['wait_avg_ms'], 0)
+        finally:
+            router.shutdown()
+
+        with self.assertRaises(ValueError):
+            router.describe('report', {'executor': 'fiber'})
+
+        with self.assertRaises(ValueError):
+            Router({'max_workers': 0})
+
+    async def test_result_cache(self):
+        router = Router()
+        calls = []
+
+        @router.before_request()
+        async def middleware(body, context):
+            calls.append('middleware')
+
+        @router.route('catalog')
+        async def catalog(body, context):
+            calls.append('handler')
+            await asyncio.sleep(0.01)
+            return {'item': body['item'], 'user': context['user']['id']}
+
+        router.describe('catalog', {'cache': {'ttl': 50, 'max_entries': 2, 'context_keys': ['user.id']}})
+
+        result, error = await router.handle([['a1', 'catalog', {'item': 1}], ['a2', 'catalog', {'item': 1}]], {'user': {'id': 'u1'}})
+        self.assertIsNone(error)
+        self.assertEqual(result[0][2], result[1][2])
+        self.assertEqual(calls, ['middleware', 'handler'])
+
+        result, error = await router.handle([['a1', 'catalog', {'item': 1}, {'_s': ['item']}]], {'user': {'id': 'u1'}})
+        self.assertEqual(result[0][2], {'item': 1})
+        self.assertEqual(len(calls), 2)
+
+        result, error = await router.handle([['a1', 'catalog', {'item': 1}]], {'user': {'id': 'u2'}})
+        self.assertEqual(result[0][2]['user'], 'u2')
+        self.assertEqual(len(calls), 4)
+
+        stats = router.cache_stats()['catalog']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['entries'], 2)
+
+        await router.handle([['a1', 'catalog', {'item': 2}]], {'user': {'id': 'u1'}})
+        self.assertEqual(router.cache_stats()['catalog']['evictions'], 1)
+
+        await asyncio.sleep(0.06)
+        await router.handle([['a1', 'catalog', {'item': 2}]], {'user': {'id': 'u1'}})
+        self.assertEqual(len(calls), 8)
+
+        with self.assertRaises(ValueError):
+            router.describe('catalog', {'cache': {'ttl': -1}})
+        with self.assertRaises(ValueError):
+            router.describe('catalog', {'cache': {'tll': 5}})
+
+    async def test_deduplication(self):
+        router = Router({'deduplicate': True})
+        calls = []
+
+        @router.route('user')
+        def user(body, context):
+            calls.append(body['id'])
+            return {'id': body['id'], 'name': 'Steve'}
+
+        result, error = await router.handle([
+            ['a1', 'user', {'id': 1}],
+            ['a2', 'user', {'id': 1}, {'_s': ['name']}],
+            ['a3', 'user', {'id': 2}]
+        ])
+        self.assertIsNone(error)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(result[0][2], {'id': 1, 'name': 'Steve'})
+        self.assertEqual(result[1][2], {'name': 'Steve'})
+        self.assertEqual(router.deduplication_stats(), {'executions': 2, 'deduplicated': 1})
+
+        await router.handle([['a1', 'user', {'id': 1}]])
+        self.assertEqual(calls, [1, 2, 1])
+
+        with self.assertRaises(ValueError):
+            Router({'deduplicate': 'everywhere'})
+        with self.assertRaises(ValueError):
+            Router({'deduplicate': 'global'})
+
+    async def test_global_deduplication(self):
+        router = Router({'deduplicate': 'global', 'deduplicate_context_keys': ['user.id']})
+        calls = []
+
+        @router.route('profile')
+        async def profile(body, context):
+            calls.append(context['user']['id'])
+            await asyncio.sleep(0.05)
+            return {'user': context['user']['id']}
+
+        results = await asyncio.gather(
+            router.handle([['a1', 'profile', {}]], {'user': {'id': 1}}),
+            router.handle([['a1', 'profile', {}]], {'user': {'id': 1}}),
+            router.handle([['a1', 'profile', {}]], {'user': {'id': 2}})
+        )
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual([result[0][2] for result, error in results], [{'user': 1}, {'user': 1}, {'user': 2}])
+
+    async def test_filter_object(self):
+        obj = {
+            'id': 1,
+            'name': 'Steve',
+            'address': {'city': 'Paris', 'zip': '75001'},
+            'orders': [{'id': 1, 'total': 5}, {'total': 7}, 'invalid'],
+            'tags': None
+        }
+        self.assertEqual(filter_object(obj, ['name', ['address', ['city']], ['orders', ['id']], ['missing', ['id']], ['tags', ['id']]]), {
+            'name': 'Steve',
+            'address': {'city': 'Paris'},
+            'orders': [{'id': 1}]
+        })
+        self.assertEqual(filter_object(obj, [['address', ['country']], ['orders', ['missing']]]), {})
+        self.assertIs(filter_object(obj, None), obj)
+        self.assertIs(compile_selector(['name', ['address', ['city']]]), compile_selector(['name', ['address', ['city']]]))
+
+    async def test_selection_push_down(self):
+        router = Router()
+        seen = []
+
+        @router.route('profile')
+        def profile(body, context):
+            selection = context['selection']
+            seen.append((selection.includes('user.name'), selection.includes('user.address.city'), selection.includes('orders')))
+            result = {'user': {'name': 'Steve', 'address': {'city': 'Paris'}}}
+            if selection.includes('orders'):
+                result['orders'] = [{'id': 1}]
+            return result
+
+        @router.route('projected')
+        def projected(body, context):
+            return context['selection'].project({'a': 1, 'b': 2})
+
+        router.describe('projected', {'projected': True})
+
+        result, error = await router.handle([
+            ['a1', 'profile', {}, {'_s': [['user', ['address']]]}],
+            ['a2', 'profile', {}],
+            ['a3', 'projected', {}, {'_s': ['a']}]
+        ])
+        self.assertIsNone(error)
+        self.assertEqual(seen, [(False, True, False), (True, True, True)])
+        self.assertEqual(result[0][2], {'user': {'address': {'city': 'Paris'}}})
+        self.assertIn('orders', result[1][2])
+        self.assertEqual(result[2][2], {'a': 1})
+
+        with self.assertRaises(ValueError):
+            router.describe('projected', {'projected': 'yes'})
+
+    async def test_handle_bytes(self):
+        for codec in ['json', 'orjson', 'msgspec']:
+            try:
+                router = Router({'codec': codec})
+            except ValueError:
+                continue
+            router.merge(self.router)
+            raw = json.dumps([['a1', 'basicRoute', {'testValue': 1}], ['a2', 'missingRoute']]).encode()
+            result, error = await router.handle_bytes(raw, {'testValue': 1})
+            self.assertIsNone(error)
+            self.assertIsInstance(result, bytes)
+            decoded = json.loads(result)
+            self.assertEqual(decoded[0][2]['context']['test']['value'], 1)
+            self.assertEqual(decoded[1][3]['status'], 404)
+            result, error = await router.handle_bytes(b'[not json', {})
+            self.assertIsNone(result)
+            self.assertEqual(error['status'], 400)
+
+        with self.assertRaises(ValueError):
+            Router({'codec': 'yaml'})
+
+    async def test_schema_validation(self):
+        router = Router()
+        calls = []
+
+        @router.before_request()
+        def middleware(body, context):
+            calls.append(body)
+
+        @router.route('createUser')
+        def create_user(body, context):
+            return {'name': body['name']}
+
+        router.describe('createUser', {
+            'validate': True,
+            'schema': {
+                'type': 'object',
+                'required': ['name'],
+                'additionalProperties': False,
+                'properties': {
+                    'name': {'type': 'string', 'minLength': 1},
+                    'age': {'type': 'integer', 'minimum': 0},
+                    'tags': {'type': 'array', 'items': {'type': 'string'}}
+                }
+            }
+        })
+        self.assertIsNotNone(router.routes['createUser']['validator'])
+
+        result, error = await router.handle([
+            ['v1', 'createUser', {'name': 'Ada', 'age': 36, 'tags': ['x']}],
+            ['v2', 'createUser', {'age': -1, 'tags': ['x', 2], 'extra': True}],
+            ['v3', 'createUser', {'name': 'Ada', 'age': True}]
+        ])
+        self.assertIsNone(error)
+        self.assertEqual(result[0][2], {'name': 'Ada'})
+        self.assertEqual(result[1][3]['status'], 400)
+        self.assertEqual(result[1][3]['code'], 'INVALID_BODY')
+        paths = [item['path'] for item in result[1][3]['data']['errors']]
+        self.assertEqual(paths, ['$.name', '$.age', '$.tags[1]', '$.extra'])
+        self.assertIn('$.name is required', result[1][3]['message'])
+        self.assertEqual(result[2][3]['data']['errors'], [{'path': '$.age', 'message': 'should be an integer'}])
+        self.assertEqual(len(calls), 1)
+
+        router.describe('createUser', {'validate': False})
+        result, error = await router.handle([['v4', 'createUser', {'name': 'Ada', 'age': True}]])
+        self.assertEqual(result[0][2], {'name': 'Ada'})
+
+        with self.assertRaises(ValueError):
+            router.describe('createUser', {'validate': True, 'schema': {'type': 'date'}})
+        for schema in [
+            {'kind': {'oneOf': [{'const': 'a'}]}},
+            {'properties': {'kind': {'oneOf': [{'const': 'a'}]}}},
+            {'$ref': '#/definitions/user'},
+            {'properties': {'email': {'type': 'string', 'format': 'email'}}},
+            {'dependentRequired': {'a': ['b']}},
+            {'items': [{'type': 'string'}]},
+            {'required': 'name'},
+            {'minimum': '5'},
+            {'pattern': '('},
+            {'maxLength': -1},
+            {'type': [{'type': 'string'}]}
+        ]:
+            with self.assertRaises(ValueError):
+                router.describe('createUser', {'validate': True, 'schema': schema})
+        router.describe('createUser', {'validate': True, 'schema': {'$schema': 'https://json-schema.org/draft/2020-12/schema', 'title': 'User', 'type': 'object', 'properties': {'name': {'type': 'string', 'description': 'Name', 'default': ''}}}})
+
+        def broken(body):
+            raise TypeError('Broken validator')
+
+        router.routes['createUser']['validator'] = broken
+        result, error = await router.handle([['v5', 'createUser', {'name': 'Ada'}], ['v6', 'missing']])
+        self.assertIsNone(error)
+        self.assertEqual(result[0][3]['status'], 500)
+        self.assertEqual(result[1][3]['status'], 404)
+
+    async def test_route_table(self):
+        billing = Router()
+        for name in ['invoices', 'refunds', 'plans/list', 'plans/get']:
+            billing.route(name)(lambda body, context: {})
+        router = Router()
+        router.route('billingReport')(lambda body, context: {})
+        router.namespace('billing', billing)
+
+        self.assertEqual(list(router.routes.with_prefix('billing/')), ['billing/invoices', 'billing/refunds', 'billing/plans/list', 'billing/plans/get'])
+        self.assertEqual(list(router.routes.with_prefix('billing/plans')), ['billing/plans/list', 'billing/plans/get'])
+        self.assertEqual(router.routes.with_prefix('bill'), {})
+        self.assertEqual(len(router.routes.with_prefix('')), 5)
+
+        del router.routes['billing/plans/list']
+        self.assertEqual(list(router.routes.with_prefix('billing/plans')), ['billing/plans/get'])
+        self.assertNotIn('billing/plans/list', router.routes)
+
+        other = Router()
+        other.route('fresh')(lambda body, context: {})
+        other.route('billingReport')(lambda body, context: {})
+        with self.assertRaises(ValueError):
+            router.merge(other)
+        self.assertNotIn('fresh', router.routes)
+
+    async def test_instrumentation(self):
+        router = Router({'histograms': True})
+        events = []
+
+        @router.before_request()
+        def middleware(body, context):
+            pass
+
+        @router.route('work')
+        def work(body, context):
+            time.sleep(0.01)
+            return {'a': 1, 'b': 2}
+
+        @router.route('sleepy')
+        async def sleepy(body, context):
+            await asyncio.sleep(1)
+
+        router.describe('sleepy', {'timeout': 20})
+
+        for event in ['batch_received', 'item_scheduled', 'step_start', 'step_end', 'executor_wait', 'selection', 'timeout', 'item_completed', 'batch_completed']:
+            router.add_hook(event, events.append)
+
+        result, error = await router.handle([['w1', 'work', None, {'_s': ['a']}], ['s1', 'sleepy'], ['m1', 'missingRoute']])
+        self.assertIsNone(error)
+        self.assertEqual(result[0][2], {'a': 1})
+        names = [event['event'] for event in events]
+        self.assertEqual(names[0], 'batch_received')
+        self.assertEqual(names[-1], 'batch_completed')
+        self.assertEqual(events[0]['size'], 3)
+        self.assertEqual(names.count('item_scheduled'), 3)
+        self.assertEqual(names.count('item_completed'), 3)
+        self.assertIn('executor_wait', names)
+        self.assertIn('selection', names)
+        self.assertIn('timeout', names)
+        stages = [(event['stage'], event['route']) for event in events if event['event'] == 'step_end']
+        self.assertIn(('middleware', 'work'), stages)
+        self.assertIn(('handler', 'work'), stages)
+        handler_end = next(event for event in events if event['event'] == 'step_end' and event['stage'] == 'handler' and event['route'] == 'work')
+        self.assertGreaterEqual(handler_end['duration_ms'], 10)
+        statuses = {event['request_id']: event['status'] for event in events if event['event'] == 'item_completed'}
+        self.assertEqual(statuses, {'w1': 200, 's1': 500, 'm1': 404})
+
+        stats = router.latency_stats()
+        self.assertEqual(set(stats), {'work', 'sleepy'})
+        self.assertEqual(stats['work']['count'], 1)
+        self.assertGreaterEqual(stats['work']['p99_ms'], 10)
+
+        self.assertIsNone(Router().latency_stats())
+        with self.assertRaises(ValueError):
+            router.add_hook('unknown', events.append)
+        with self.assertRaises(ValueError):
+            router.add_hook('step_end', None)
+        with self.assertRaises(ValueError):
+            Router({'histograms': 'yes'})
+
+    async def test_metrics(self):
+        await self.handle([['a1', 'basicRoute', {'testValue': 1}], ['a2', 'subRoutes/errorRoute', {'testValue': 1}], ['a3', 'missingRoute']], {})
+        await self.handle([['b1', 'timeoutRoute', {'testValue': 1}]], {})
+        results, error = await self.router.handle_stream([['c1', 'basicRoute', {'testValue': 1}]], {})
+        async for result in results:
+            pass
+        metrics = self.router.metrics()
+        self.assertEqual(metrics['batches_total'], 3)
+        self.assertEqual(metrics['batch_items']['count'], 3)
+        self.assertEqual(metrics['batch_items']['sum'], 5)
+        self.assertEqual(metrics['batch_items']['buckets'][1], 2)
+        self.assertEqual(metrics['batch_items']['buckets']['+Inf'], 3)
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertEqual(metrics['unknown_routes_total'], 1)
+        self.assertEqual(metrics['routes']['basicRoute'], {'calls_total': 2, 'errors_total': 0, 'timeouts_total': 0})
+        self.assertEqual(metrics['routes']['subRoutes/errorRoute']['errors_total'], 1)
+        self.assertEqual(metrics['routes']['timeoutRoute'], {'calls_total': 1, 'errors_total': 1, 'timeouts_total': 1})
+
+        text = render_prometheus(metrics)
+        self.assertIn('# TYPE blest_batches_total counter\nblest_batches_total 3\n', text)
+        self.assertIn('blest_batch_items_bucket{le="1"} 2', text)
+        self.assertIn('blest_batch_items_bucket{le="+Inf"} 3', text)
+        self.assertIn('# TYPE blest_in_flight gauge', text)
+        self.assertIn('blest_route_timeouts_total{route="timeoutRoute"} 1', text)
+
+        router = Router({'histograms': True, 'metrics': False})
+        router.route('greet')(lambda body, context: {'ok': True})
+        await router.handle([['d1', 'greet']])
+        metrics = router.metrics()
+        self.assertEqual(list(metrics), ['latency_ms'])
+        self.assertIn('blest_route_latency_ms_count{route="greet"} 1', render_prometheus(metrics))
+
+        with self.assertRaises(ValueError):
+            Router({'metrics': 'yes'})
+
+    async def test_abandoned_stream_metrics(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            results, error = await self.router.handle_stream([['a1', 'basicRoute', {'testValue': 1}], ['a2', 'basicRoute', {'testValue': 2}]], {})
+            del results
+            gc.collect()
+        self.assertEqual(self.router.metrics()['in_flight'], 0)
+        self.assertEqual(self.router.metrics()['batches_total'], 0)
+        self.assertEqual([str(warning.message) for warning in caught if 'never awaited' in str(warning.message)], [])
+
+    async def test_error_reporter(self):
+        reporter = ErrorReporter('blest.test', rate_limit=5)
+        router = Router({'error_reporter': reporter})
+
+        @router.route('broken')
+        def broken(body, context):
+            raise Exception('Broken')
+
+        @router.route('forbidden')
+        def forbidden(body, context):
+            raise BlestError('Forbidden', status=403)
+
+        with self.assertLogs('blest.test', logging.INFO) as logs:
+            result, error = await router.handle([[str(i), 'broken'] for i in range(50)] + [['f1', 'forbidden']])
+            router.shutdown()
+        self.assertTrue(all(item[3]['message'] == 'Broken' for item in result[:50]))
+        errors = [record for record in logs.records if record.route == 'broken']
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(all(record.exc_info and record.exc_info[1].args == ('Broken',) for record in errors))
+        self.assertNotEqual(errors[0].threadName, 'MainThread')
+        forbidden = [record for record in logs.records if record.route == 'forbidden']
+        self.assertEqual(forbidden[0].levelno, logging.INFO)
+        self.assertIsNone(forbidden[0].exc_info)
+        self.assertEqual(reporter.stats(), {'reported': 6, 'suppressed': 45})
+
+        reporter.rate_limit = 1000
+        reporter._buckets['broken'][0] = 1
+        with self.assertLogs('blest.test') as logs:
+            await router.handle([['b1', 'broken']])
+            reporter.flush()
+        self.assertIn('(45 similar messages suppressed)', logs.records[0].getMessage())
+
+        reporter = ErrorReporter('blest.test', rate_limit=None, sample_rate=0, background=False)
+        self.assertFalse(reporter.report('broken', 'Dropped'))
+        self.assertEqual(reporter.stats(), {'reported': 0, 'suppressed': 1})
+
+        with self.assertRaises(ValueError):
+            Router({'error_reporter': 'stderr'})
+        with self.assertRaises(ValueError):
+            ErrorReporter(sample_rate=2)
+        with self.assertRaises(ValueError):
+            ErrorReporter(rate_limit=0)
+
+    async def test_deadlines(self):
+        router = Router({'timeout': 5000})
+        seen = {}
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        @router.route('fast')
+        async def fast(body, context):
+            seen['remaining'] = context['cancellation'].remaining
+            return {'ok': True}
+
+        @router.route('slow')
+        async def slow(body, context):
+            seen['slow'] = context['cancellation']
+            await asyncio.sleep(1)
+            return {'ok': True}
+
+        @router.route('spin')
+        def spin(body, context):
+            while not context['cancellation'].cancelled:
+                time.sleep(0.005)
+            loop.call_soon_threadsafe(stopped.set)
+
+        started = time.monotonic()
+        result, error = await router.handle([['f1', 'fast'], ['s1', 'slow']], {}, deadline=50)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertIsNone(error)
+        self.assertEqual(result[0][2], {'ok': True})
+        self.assertLessEqual(seen['remaining'], 50)
+        self.assertEqual(result[1][3], {'message': 'Deadline exceeded', 'status': 504, 'code': 'DEADLINE_EXCEEDED'})
+        self.assertTrue(seen['slow'].cancelled)
+
+        result, error = await router.handle([['f2', 'fast'], ['s2', 'slow', None, {'_t': 30}]])
+        self.assertIsNone(seen['remaining'])
+        self.assertEqual(result[0][2], {'ok': True})
+        self.assertEqual(result[1][3]['status'], 504)
+
+        result, error = await router.handle([['p1', 'spin', None, {'_t': 30}]])
+        self.assertEqual(result[0][3]['code'], 'DEADLINE_EXCEEDED')
+        await asyncio.wait_for(stopped.wait(), 1)
+
+        results, error = await router.handle_stream([['f3', 'fast'], ['s3', 'slow']])
+        async for result in results:
+            self.assertEqual(result[0], 'f3')
+            break
+        await results.aclose()
+        self.assertTrue(seen['slow'].cancelled)
+
+        result, error = await router.handle([['x1', 'fast', None, {'_t': 'soon'}]])
+        self.assertEqual(error['status'], 400)
+        with self.assertRaises(ValueError):
+            await router.handle([['x2', 'fast']], deadline=0)
+
+    async def test_shared_call_deadlines(self):
+        calls = []
+
+        async def slow(body, context):
+            calls.append(context['request_id'])
+            await asyncio.sleep(0.2)
+            context['cancellation'].raise_if_cancelled()
+            return {'ok': True}
+
+        deduplicated = Router({'deduplicate': True})
+        deduplicated.route('slow')(slow)
+        cached = Router()
+        cached.route('slow')(slow)
+        cached.describe('slow', {'cache': {'ttl': 60}})
+        for router in [deduplicated, cached]:
+            for deadlines in [(50, 1000), (1000, 50)]:
+                calls.clear()
+                started = time.monotonic()
+                result, error = await router.handle([
+                    ['a1', 'slow', {'deadlines': deadlines}, {'_t': deadlines[0]}],
+                    ['a2', 'slow', {'deadlines': deadlines}, {'_t': deadlines[1]}]
+                ])
+                self.assertEqual(len(calls), 1)
+                codes = [item[3]['code'] if item[3] else None for item in result]
+                self.assertEqual(codes, ['DEADLINE_EXCEEDED' if deadline == 50 else None for deadline in deadlines])
+                self.assertLess(time.monotonic() - started, 0.4)
+
+    async def test_concurrency_limits(self):
+        router = Router()
+        state = {'active': 0, 'peak': 0}
+
+        @router.route('database')
+        async def database(body, context):
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            await asyncio.sleep(0.05)
+            state['active'] -= 1
+            return {'ok': True}
+
+        @router.route('cheap')
+        async def cheap(body, context):
+            return {'ok': True}
+
+        router.describe('database', {'max_concurrency': 2, 'queue_limit': 2})
+        started = time.monotonic()
+        result, error = await router.handle([[f'd{i}', 'database'] for i in range(6)] + [['c1', 'cheap']])
+        self.assertIsNone(error)
+        self.assertEqual(state['peak'], 2)
+        self.assertEqual([item[3]['code'] if item[3] else None for item in result], [None, None, None, None, 'OVERLOADED', 'OVERLOADED', None])
+        self.assertEqual(result[4][3]['status'], 503)
+        stats = router.concurrency_stats()['routes']['database']
+        self.assertEqual({key: stats[key] for key in ['max_concurrency', 'queue_limit', 'active', 'queued', 'rejected']}, {'max_concurrency': 2, 'queue_limit': 2, 'active': 0, 'queued': 0, 'rejected': 2})
+
+        result, error = await router.handle([['d6', 'database'], ['d7', 'database'], ['d8', 'database', None, {'_t': 20}]])
+        self.assertEqual(result[2][3]['code'], 'DEADLINE_EXCEEDED')
+        self.assertEqual(router.concurrency_stats()['routes']['database']['queued'], 0)
+
+        router.describe('database', {'max_concurrency': None})
+        self.assertIsNone(router.concurrency_stats()['global'])
+        self.assertEqual(router.concurrency_stats()['routes'], {})
+
+        router = Router({'max_in_flight': 1, 'queue_limit': 0})
+        router.route('database')(database)
+        result, error = await router.handle([['g1', 'database'], ['g2', 'database']])
+        self.assertIsNone(result[0][3])
+        self.assertEqual(result[1][3]['code'], 'OVERLOADED')
+        self.assertEqual(router.concurrency_stats()['global']['rejected'], 1)
+
+        with self.assertRaises(ValueError):
+            router.describe('database', {'queue_limit': 5})
+        with self.assertRaises(ValueError):
+            router.describe('database', {'max_concurrency': 0})
+        with self.assertRaises(ValueError):
+            Router({'max_in_flight': -1})
+
+    async def test_priorities(self):
+        router = Router({'max_in_flight': 1})
+        order = []
+
+        @router.route('render')
+        async def render(body, context):
+            order.append(context['request_id'])
+            await asyncio.sleep(0.01)
+            return {'ok': True}
+
+        @router.route('analytics')
+        async def analytics(body, context):
+            order.append(context['request_id'])
+            await asyncio.sleep(0.01)
+            return {'ok': True}
+
+        router.describe('render', {'priority': 10})
+
+        result, error = await router.handle([['a1', 'analytics'], ['a2', 'analytics'], ['r1', 'render'], ['u1', 'analytics', None, {'_p': 20}], ['r2', 'render']])
+        self.assertIsNone(error)
+        self.assertEqual([item[0] for item in result], ['a1', 'a2', 'r1', 'u1', 'r2'])
+        self.assertEqual(order, ['u1', 'r1', 'r2', 'a1', 'a2'])
+
+        order.clear()
+        first = asyncio.ensure_future(router.handle([['a3', 'analytics'], ['a4', 'analytics']]))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(router.handle([['r3', 'render']]))
+        await asyncio.gather(first, second)
+        self.assertEqual(order, ['a3', 'r3', 'a4'])
+
+        stats = router.concurrency_stats()['priorities']
+        self.assertEqual(list(stats), [20, 10, 0])
+        self.assertEqual(stats[10]['calls'], 3)
+        self.assertGreater(stats[0]['wait_avg_ms'], stats[20]['wait_avg_ms'])
+
+        router = Router({'max_in_flight': 2})
+        router.route('render')(render)
+        router.describe('render', {'max_concurrency': 1})
+        await router.handle([['r1', 'render'], ['r2', 'render'], ['r3', 'render']])
+        stats = router.concurrency_stats()
+        self.assertEqual(stats['priorities'][0]['calls'], 3)
+        self.assertEqual(stats['routes']['render']['priorities'][0]['calls'], 3)
+        self.assertEqual(stats['global']['priorities'][0]['calls'], 3)
+        self.assertGreater(stats['priorities'][0]['wait_avg_ms'], 5)
+
+        router = Router({'max_in_flight': 1, 'queue_limit': 1})
+        router.route('analytics')(analytics)
+        result, error = await router.handle([['a5', 'analytics'], ['a6', 'analytics'], ['u2', 'analytics', None, {'_p': 5}]])
+        self.assertEqual([item[3]['code'] if item[3] else None for item in result], [None, 'OVERLOADED', None])
+
+        limiter = ConcurrencyLimiter(1, 1)
+        await limiter.acquire()
+        evicted = asyncio.ensure_future(limiter.acquire(0))
+        await asyncio.sleep(0)
+        admitted = asyncio.ensure_future(limiter.acquire(1))
+        await asyncio.sleep(0)
+        evicted.cancel()
+        await asyncio.gather(evicted, return_exceptions=True)
+        self.assertEqual((limiter.active, limiter.queued), (1, 1))
+        self.assertFalse(admitted.done())
+        limiter.release()
+        await admitted
+        self.assertEqual((limiter.active, limiter.queued), (1, 0))
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+        result, error = await router.handle([['x1', 'analytics', None, {'_p': 'high'}]])
+        self.assertEqual(error['status'], 400)
+        with self.assertRaises(ValueError):
+            router.describe('analytics', {'priority': 'high'})
+
+    async def test_loaders(self):
+        router = Router()
+        calls = []
+
+        @router.loader('users')
+        async def load_users(keys, context):
+            calls.append((keys, context['batch_id']))
+            return {key: {'id': key, 'name': f'User {key}'} for key in keys if key != 'missing'}
+
+        @router.loader('scores', max_batch_size=2)
+        def load_scores(keys, context):
+            calls.append(keys)
+            return [ValueError('No score') if key == 'bad' else key * 10 for key in keys]
+
+        @router.route('profile')
+        async def profile(body, context):
+            user = await context['loaders']['users'].load(body['id'])
+            return {'user': user}
+
+        @router.route('scores')
+        async def scores(body, context):
+            return {'scores': await context['loaders']['scores'].load_many(body['ids'])}
+
+        result, error = await router.handle([[f'p{i}', 'profile', {'id': i % 10}] for i in range(30)] + [['m1', 'profile', {'id': 'missing'}]])
+        self.assertIsNone(error)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0][0], key=str), list(range(10)) + ['missing'])
+        self.assertEqual(result[13][2], {'user': {'id': 3, 'name': 'User 3'}})
+        self.assertEqual(result[30][2], {'user': None})
+        self.assertEqual(router.loader_stats()['users'], {'loads': 31, 'cache_hits': 20, 'batches': 1, 'keys': 11})
+
+        await router.handle([['p1', 'profile', {'id': 1}]])
+        self.assertEqual(len(calls), 2)
+        self.assertNotEqual(calls[0][1], calls[1][1])
+
+        calls.clear()
+        result, error = await router.handle([['s1', 'scores', {'ids': [1, 2, 3]}], ['s2', 'scores', {'ids': [4, 'bad']}]])
+        self.assertEqual(result[0][2], {'scores': [10, 20, 30]})
+        self.assertEqual(result[1][3]['message'], 'No score')
+        self.assertEqual(calls, [[1, 2], [3, 4], ['bad']])
+        self.assertEqual(router.executor_stats()['routes']['loader:scores']['thread']['calls'], 3)
+
+        other = Router()
+        other.route('other')(profile)
+        other.add_loader('users', load_users)
+        with self.assertRaises(ValueError):
+            router.merge(other)
+        parent = Router()
+        parent.namespace('accounts', router)
+        result, error = await parent.handle([['n1', 'accounts/profile', {'id': 2}]])
+        self.assertEqual(result[0][2]['user']['id'], 2)
+
+        with self.assertRaises(ValueError):
+            router.add_loader('users', load_users)
+        with self.assertRaises(ValueError):
+            router.add_loader('other', None)
+        with self.assertRaises(ValueError):
+            router.add_loader('other', load_users, max_batch_size=0)
+
+    async def test_invalid_middleware(self):
+        with self.assertRaises(ValueError):
+            self.router.add_middleware('notAFunction')
+
+        with self.assertRaises(ValueError):
+            self.router.add_afterware(None)
+
     async def test_invalid_routes(self):
         with self.assertRaises(ValueError):
             @self.router.route('a')